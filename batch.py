@@ -0,0 +1,136 @@
+import os
+import select
+from queue import Queue
+from threading import Thread
+
+
+class Batch:
+    '''
+    Transactions requested from the remote host and not answered yet.
+    Requests are queued and sent back to back by a writer thread while the host reads the
+    responses, each response carries the id of its transaction
+    '''
+
+    def __init__(self, send_frame, end_op):
+        self.send_frame = send_frame
+        self.end_op = end_op
+        self.transactions = {}
+        # path: number of pending transactions about it
+        self.paths = {}
+        # folder: number of pending transactions about paths inside it
+        self.folders = {}
+        self.next_id = 0
+        self.queue = Queue()
+        self.writer = Thread(target=self.send_requests, daemon=True)
+        self.writer.start()
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def add(self, event, request, data=None):
+        '''
+        Registers a transaction and returns its id, data is kept until the response arrives
+        '''
+        transaction = self.next_id
+        self.next_id = self.next_id + 1
+        self.transactions[transaction] = (event, request, data)
+        self.count_path(event[0], 1)
+        return transaction
+
+    def pop(self, transaction):
+        if transaction not in self.transactions:
+            raise IOError("Response to an unknown transaction " + str(transaction))
+        event, request, data = self.transactions.pop(transaction)
+        self.count_path(event[0], -1)
+        return event, request, data
+
+    def count_path(self, rel_path, step):
+        self.increment(self.paths, rel_path, step)
+        for folder in self.get_parents(rel_path):
+            self.increment(self.folders, folder, step)
+
+    def increment(self, counts, key, step):
+        count = counts.get(key, 0) + step
+        if count:
+            counts[key] = count
+        else:
+            del counts[key]
+
+    def get_parents(self, rel_path):
+        folder, sep, name = rel_path.rpartition(os.sep)
+        while sep:
+            yield folder
+            folder, sep, name = folder.rpartition(os.sep)
+
+    def is_pending(self, rel_path):
+        '''
+        True if a pending transaction is about the path, a path inside it or one of its parents
+        '''
+        if rel_path in self.paths or rel_path in self.folders:
+            return True
+        return any(x in self.paths for x in self.get_parents(rel_path))
+
+    def send(self, op, payload):
+        self.queue.put((op, payload))
+
+    def send_requests(self):
+        op, payload = self.queue.get()
+        while op is not None:
+            self.send_frame(op, payload)
+            op, payload = self.queue.get()
+        self.send_frame(self.end_op)
+
+    def finish(self):
+        '''
+        Sends the end of the batch once every queued request has been sent
+        '''
+        self.queue.put((None, None))
+        self.writer.join()
+
+
+class Scheduler:
+    '''
+    Batches of the data channels of a session. A transaction goes to the channel with the fewest
+    pending transactions and the responses are read from whichever channel has one ready.
+    Channels are hosts sharing the session, each with its own connection
+    '''
+
+    def __init__(self, channels, end_op):
+        self.channels = [(x, Batch(x.send_frame, end_op)) for x in channels]
+        # channel the next ready one is looked for from, so that none waits behind the others
+        self.next_channel = 0
+
+    def __len__(self):
+        return sum(len(batch) for channel, batch in self.channels)
+
+    def pick(self):
+        '''
+        Batch of the least busy channel
+        '''
+        return min((batch for channel, batch in self.channels), key=len)
+
+    def find(self, rel_path):
+        '''
+        Returns the (channel, batch) with a pending transaction about the path or None
+        '''
+        for channel, batch in self.channels:
+            if batch.is_pending(rel_path):
+                return channel, batch
+        return None
+
+    def ready(self):
+        '''
+        Waits for a response and returns the (channel, batch) it can be read from
+        '''
+        if len(self.channels) == 1:
+            return self.channels[0]
+        pending = self.channels[self.next_channel:] + self.channels[:self.next_channel]
+        pending = [x for x in pending if len(x[1])]
+        readable = select.select([channel.socket for channel, batch in pending], [], [])[0]
+        channel, batch = next(x for x in pending if x[0].socket in readable)
+        self.next_channel = (self.channels.index((channel, batch)) + 1) % len(self.channels)
+        return channel, batch
+
+    def finish(self):
+        for channel, batch in self.channels:
+            batch.finish()
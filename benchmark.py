@@ -0,0 +1,677 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import pickle
+import random
+import socket
+import tempfile
+import time
+from threading import Thread
+
+from watchdog import events
+
+import numpy as np
+
+from hash import Hash
+from host import Host
+from codec import Codec
+from compression import Compression
+from chunker import Chunker
+from chunk_store import ChunkStore
+from file_manager import FileManager
+from signature import SignatureIndex
+from path_index import PathIndex
+
+
+class LegacyHash(Hash):
+    '''
+    Byte sum weak hash used before the rsync weak hash, kept for comparison
+    '''
+
+    def get_byte_weak_hash(self, file_bytes):
+        return int(np.sum(np.multiply(5, list(bytes(file_bytes)))))
+
+    def get_block_weak_hashes(self, data, block_size):
+        return np.array([self.get_byte_weak_hash(data[offset:offset + block_size])
+                         for offset in range(0, len(data), block_size)], dtype=np.uint32)
+
+    def get_rolling_weak_hashes(self, data, block_size):
+        if len(data) < block_size:
+            return np.empty(0, dtype=np.uint32)
+        sums = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(data, dtype=np.int64, out=sums[1:])
+        return ((sums[block_size:] - sums[:-block_size]) * 5).astype(np.uint32)
+
+
+def count_strong_calls(hash_impl):
+    '''
+    Wrap get_byte_strong_hash so that hash_impl.strong_calls counts its calls
+    '''
+    strong_hash = hash_impl.get_byte_strong_hash
+    hash_impl.strong_calls = 0
+
+    def counted(file_bytes):
+        hash_impl.strong_calls = hash_impl.strong_calls + 1
+        return strong_hash(file_bytes)
+
+    hash_impl.get_byte_strong_hash = counted
+    return hash_impl
+
+
+def source_data(rng, size):
+    words = ["self", "return", "def", "import", "if", "else", "for", "in", "range", "len", "data", "value",
+             "index", "result", "print", "None", "True", "False", "list", "dict"]
+    lines = []
+    total = 0
+    while total < size:
+        indent = " " * (4 * rng.randint(0, 3))
+        line = indent + " ".join(rng.choice(words) for _ in range(rng.randint(2, 9))) + "\n"
+        lines.append(line)
+        total = total + len(line)
+    return "".join(lines).encode()[:size]
+
+
+def csv_data(rng, size):
+    rows = ["id,date,amount,status\n"]
+    total = len(rows[0])
+    index = 0
+    while total < size:
+        row = "%d,2020-%02d-%02d,%d.%02d,%s\n" % (index, rng.randint(1, 12), rng.randint(1, 28),
+                                                 rng.randint(0, 9999), rng.randint(0, 99),
+                                                 rng.choice(["ok", "failed", "pending"]))
+        rows.append(row)
+        total = total + len(row)
+        index = index + 1
+    return "".join(rows).encode()[:size]
+
+
+def binary_data(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def edit(rng, data, edits=20):
+    data = bytearray(data)
+    for _ in range(edits):
+        pos = rng.randint(0, len(data))
+        data[pos:pos] = bytes(rng.getrandbits(8) for _ in range(rng.randint(1, 64)))
+    return bytes(data)
+
+
+def bench_weak_collisions(args):
+    '''
+    Count the strong hash calls compute_delta_2 makes with the byte sum and the rsync weak hash
+    '''
+    rng = random.Random(0)
+    size = args.size
+    block_size = Hash(args.block_size).get_block_size(size)
+    print("weak hash collisions (%d bytes per file, %d bytes per block)" % (size, block_size))
+    print("%-8s %-8s %12s %12s %12s %10s" % ("data", "hash", "blocks", "strong calls", "false hits", "time"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, generator in (("source", source_data), ("csv", csv_data), ("binary", binary_data)):
+            basis = generator(rng, size)
+            new = edit(rng, basis)
+            basis_path = os.path.join(tmp, "basis")
+            new_path = os.path.join(tmp, "new")
+            with open(basis_path, "wb") as f:
+                f.write(basis)
+            with open(new_path, "wb") as f:
+                f.write(new)
+
+            for hash_name, hash_impl in (("bytesum", LegacyHash()), ("rsync", Hash())):
+                counting = count_strong_calls(hash_impl)
+                host = Host()
+                host.hash = counting
+                weak, strong = counting.get_file_hashes(basis_path, block_size)
+                signature = SignatureIndex(weak, strong, block_size, counting.strong_hash_size)
+                counting.strong_calls = 0
+                start = time.perf_counter()
+                delta = list(host.compute_delta_2(new_path, signature))
+                elapsed = time.perf_counter() - start
+                matched = sum(1 for x in delta if isinstance(x, int))
+                print("%-8s %-8s %12d %12d %12d %9.3fs" % (name, hash_name, len(weak), counting.strong_calls,
+                                                         counting.strong_calls - matched, elapsed))
+
+
+def bench_signature_size(args):
+    '''
+    Compare the delta_1 wire size of the packed signature with the former pickled dictionary
+    '''
+    rng = random.Random(0)
+    size = args.size
+    hash_impl = Hash(args.block_size)
+    print("signature wire size")
+    print("%-14s %13s %10s %14s %10s %8s" % ("format", "file size", "blocks", "signature", "per block", "of file"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "file")
+        with open(path, "wb") as f:
+            f.write(binary_data(rng, size))
+        block_size = hash_impl.get_block_size(size)
+        checksum, weak, strong = hash_impl.get_file_signature(path, block_size)
+
+        legacy = {}
+        for index, weak_hash in enumerate(weak.tolist()):
+            digest = strong[index * hash_impl.strong_hash_size:(index + 1) * hash_impl.strong_hash_size]
+            legacy.setdefault(weak_hash, []).append((digest.hex(), index))
+        legacy_size = len(pickle.dumps(legacy))
+        print("%-14s %13d %10d %14d %10.1f %7.2f%%" % ("pickled dict", size, len(weak), legacy_size,
+                                                     legacy_size / len(weak), 100.0 * legacy_size / size))
+
+        signature = SignatureIndex(weak, strong, block_size, hash_impl.get_strong_hash_size(size, block_size),
+                                   hash_impl.strong_hash_size)
+        packed_size = signature.get_wire_size()
+        print("%-14s %13d %10d %14d %10.1f %7.2f%%" % ("packed", size, len(weak), packed_size,
+                                                     packed_size / len(weak), 100.0 * packed_size / size))
+
+    # bigger files, size computed from the format
+    for file_size in (1 << 30, 10 << 30, 100 << 30):
+        block_size = hash_impl.get_block_size(file_size)
+        blocks = -(-file_size // block_size)
+        per_block = SignatureIndex.WEAK_WIRE_TYPE.itemsize + hash_impl.get_strong_hash_size(file_size, block_size)
+        packed_size = SignatureIndex.HEADER.size + blocks * per_block
+        print("%-14s %13d %10d %14d %10.1f %7.2f%%" % ("packed", file_size, blocks, packed_size, per_block,
+                                                     100.0 * packed_size / file_size))
+
+
+def bench_strong_hash(args):
+    '''
+    Time hashing and comparing one block with every block hash, against the former sha1 hex digests
+    '''
+    rng = random.Random(0)
+    data = binary_data(rng, args.size)
+    view = memoryview(data)
+    block_sizes = [args.block_size] if args.block_size else [Hash.MIN_BLOCK_SIZE, 4096, 32768]
+    print("block hash speed (%d bytes of data)" % len(data))
+    print("%-10s %-12s %8s %14s %8s" % ("block", "hash", "digest", "per block", "speedup"))
+    for block_size in block_sizes:
+        offsets = range(0, len(data) - block_size + 1, block_size)
+        functions = [("sha1 hex", lambda x: hashlib.sha1(x).hexdigest())]
+        for name in sorted(Hash.STRONG_HASHES):
+            functions.append((name, Hash(strong_hash=name).get_byte_strong_hash))
+        legacy_time = None
+        for name, function in functions:
+            digest = function(view[:block_size])
+            elapsed = None
+            for _ in range(3):
+                start = time.perf_counter()
+                for offset in offsets:
+                    if function(view[offset:offset + block_size]) == digest:
+                        pass
+                run_time = (time.perf_counter() - start) / len(offsets)
+                elapsed = min(elapsed or run_time, run_time)
+            legacy_time = legacy_time or elapsed
+            print("%-10d %-12s %8d %12.2fus %7.2fx" % (block_size, name, len(digest), elapsed * 1e6,
+                                                     legacy_time / elapsed))
+
+
+def receive_concatenating(sock, length):
+    '''
+    Receive loop used before the framed receive helper, every chunk copies the whole buffer
+    '''
+    data_rcv = b""
+    while len(data_rcv) < length:
+        data_rcv = data_rcv + sock.recv(8192)
+    return data_rcv
+
+
+def bench_frame_receive(args):
+    '''
+    Receive large frames over a local socket pair and check they arrive intact
+    '''
+    print("frame receive")
+    print("%-14s %13s %10s %10s" % ("receive", "payload", "time", "MB/s"))
+    for size in sorted(set([x for x in (1 << 20, 16 << 20) if x < args.size] + [args.size])):
+        payload = (os.urandom(1 << 20) * (size // (1 << 20) + 1))[:size]
+        sender, receiver = Host(), Host()
+        sender.socket, receiver.socket = socket.socketpair()
+        writer = Thread(target=sender.send_frame, args=(Host.Op.MESSAGE, payload))
+        start = time.perf_counter()
+        writer.start()
+        received = receiver.receive_frame(Host.Op.MESSAGE)
+        elapsed = time.perf_counter() - start
+        writer.join()
+        if received != payload:
+            raise SystemExit("Frame of %d bytes was corrupted" % size)
+        print("%-14s %13d %9.3fs %10.0f" % ("preallocated", size, elapsed, size / elapsed / 1e6))
+
+        # the concatenating loop is quadratic, only time it on the small payloads
+        if size <= 16 << 20:
+            writer = Thread(target=sender.socket.sendall, args=(payload,))
+            start = time.perf_counter()
+            writer.start()
+            received = receive_concatenating(receiver.socket, size)
+            elapsed = time.perf_counter() - start
+            writer.join()
+            print("%-14s %13d %9.3fs %10.0f" % ("concatenating", size, elapsed, size / elapsed / 1e6))
+        sender.socket.close()
+        receiver.socket.close()
+
+
+def tree_paths(rng, count):
+    '''
+    Relative paths of a generated source tree, deep directories sharing long prefixes
+    '''
+    names = ["src", "lib", "test", "include", "docs", "build", "module", "core", "util", "data"]
+    paths = []
+    directory = "project"
+    while len(paths) < count:
+        if rng.random() < 0.1:
+            directory = os.path.join(*(["project"] + [rng.choice(names) + str(rng.randint(0, 9))
+                                                        for _ in range(rng.randint(1, 6))]))
+        paths.append(os.path.join(directory, "file_%d.%s" % (len(paths), rng.choice(["py", "c", "h", "txt"]))))
+    return paths
+
+
+def bench_codec(args):
+    '''
+    Encode and decode the protocol messages with pickle and with the binary codec, plain and deflated
+    '''
+    rng = random.Random(0)
+    plain, deflated = Codec(compress=False), Codec()
+    paths = tree_paths(rng, args.paths)
+    manifest = {x: (rng.randint(0, 1 << 30), 1600000000000000000 + rng.randint(0, 1 << 50)) for x in paths}
+    folders = {x: os.urandom(20) for x in set(os.path.dirname(x) for x in paths)}
+    types = [events.EVENT_TYPE_CREATED, events.EVENT_TYPE_DELETED, events.EVENT_TYPE_MODIFIED,
+             events.EVENT_TYPE_MOVED]
+    checksums = [os.urandom(20).hex() if i % 3 else None for i in range(len(paths))]
+    # message, what the binary codec decodes it to when it differs, and the codecs it is encoded with
+    messages = (
+        ("listing", (manifest, folders), ((paths, [manifest[x][0] for x in paths],
+                                           [manifest[x][1] for x in paths]), folders),
+         (("binary", plain), ("deflated", deflated))),
+        ("events", [(x, x + ".moved" if i % 4 == 3 else None, False, types[i % 4]) for i, x in enumerate(paths)],
+         None, (("binary", plain),)),
+        ("checksums", checksums, [bytes(20) if x is None else bytes.fromhex(x) for x in checksums],
+         (("binary", plain),)),
+    )
+    print("message codec (%d entries)" % len(paths))
+    print("%-10s %-9s %12s %10s %10s" % ("message", "codec", "bytes", "encode", "decode"))
+    for name, message, expected, binary_codecs in messages:
+        codecs = [("pickle", pickle.dumps, pickle.loads, message)]
+        for codec_name, codec in binary_codecs:
+            encode = getattr(codec, "encode_" + name)
+            # the listing is encoded from the manifest and the folder hashes
+            if name == "listing":
+                encode = lambda x, encode=encode: encode(*x)
+            codecs.append((codec_name, encode, getattr(codec, "decode_" + name),
+                           message if expected is None else expected))
+        for codec_name, dumps, loads, expected_message in codecs:
+            encode_time = decode_time = None
+            for _ in range(3):
+                start = time.perf_counter()
+                data = dumps(message)
+                run_time = time.perf_counter() - start
+                encode_time = min(encode_time or run_time, run_time)
+                start = time.perf_counter()
+                decoded = loads(data)
+                run_time = time.perf_counter() - start
+                decode_time = min(decode_time or run_time, run_time)
+            if decoded != expected_message:
+                raise SystemExit("%s codec changed the %s message" % (codec_name, name))
+            print("%-10s %-9s %12d %9.3fs %9.3fs" % (name, codec_name, len(data), encode_time, decode_time))
+
+
+def bench_tree_diff(args):
+    '''
+    Initial sync of two trees with a few changed files: tree diff against sending the whole manifest
+    '''
+    rng = random.Random(0)
+    paths = tree_paths(rng, args.paths)
+    manifest = {x: (rng.randint(0, 1 << 20), 1600000000000000000 + rng.randint(0, 1 << 50)) for x in paths}
+    print("tree diff (%d files)" % len(paths))
+    print("%-8s %-10s %8s %12s %10s" % ("changed", "method", "frames", "bytes", "time"))
+    for changed in (0, 10, 1000):
+        remote_manifest = dict(manifest)
+        for x in rng.sample(paths, changed):
+            remote_manifest[x] = (remote_manifest[x][0] + 1, remote_manifest[x][1])
+        # both hosts send their manifest, the rows count the frames and bytes of one host and the time of both
+        start = time.perf_counter()
+        data = Codec().encode_listing(manifest, {})
+        Codec().decode_listing(data)
+        Codec().decode_listing(Codec().encode_listing(remote_manifest, {}))
+        print("%-8d %-10s %8d %12d %9.3fs" % (changed, "manifest", 1, len(data), time.perf_counter() - start))
+
+        local, remote = FileManager(), FileManager()
+        local.local_manifest, remote.local_manifest = manifest, remote_manifest
+        sender, receiver = Host(), Host()
+        sender.socket, receiver.socket = socket.socketpair()
+        frames = []
+        send_frame = sender.send_frame
+        sender.send_frame = lambda op, payload=b"": frames.append(len(payload)) or send_frame(op, payload)
+        remote_diff = Thread(target=receiver.diff_trees, args=(remote, False))
+        start = time.perf_counter()
+        remote_diff.start()
+        sender.diff_trees(local, True)
+        remote_diff.join()
+        elapsed = time.perf_counter() - start
+        local.calc_matched_files()
+        if sum(1 for x in local.matched if local.local_manifest[x] != local.remote_manifest[x]) != changed:
+            raise SystemExit("Tree diff missed changed files")
+        print("%-8d %-10s %8d %12d %9.3fs" % (changed, "tree", len(frames), sum(frames), elapsed))
+        sender.socket.close()
+        receiver.socket.close()
+
+
+def bench_path_index(args):
+    '''
+    Membership checks and a folder rename on the local file list, as a list and as a PathIndex
+    '''
+    rng = random.Random(0)
+    paths = tree_paths(rng, args.paths)
+    lookups = rng.sample(paths, 100)
+    folder = os.path.dirname(paths[0])
+    print("path index (%d files)" % len(paths))
+    print("%-10s %12s %12s" % ("index", "100 lookups", "folder move"))
+    for name, index in (("list", list(paths)), ("PathIndex", PathIndex(paths))):
+        start = time.perf_counter()
+        for x in lookups:
+            if x not in index:
+                raise SystemExit("%s lost %s" % (name, x))
+        lookup_time = time.perf_counter() - start
+        start = time.perf_counter()
+        if isinstance(index, list):
+            # what a folder move used to cost: every file of the index checked and renamed
+            index[:] = ["renamed" + x[len(folder):] if x.startswith(folder + os.sep) else x for x in index]
+        else:
+            index.move(folder, "renamed")
+        move_time = time.perf_counter() - start
+        print("%-10s %11.6fs %11.6fs" % (name, lookup_time, move_time))
+
+
+def scan_walking(shared_folder):
+    '''
+    Startup scan used before the scandir scanner: os.walk, a stat per file and a listdir per folder
+    '''
+    manifest = {}
+    empty_folders = []
+    for root, dirs, files in os.walk(shared_folder):
+        for name in files:
+            abs_path = os.path.join(os.path.abspath(root), name)
+            try:
+                stat = os.stat(abs_path)
+            except OSError:
+                continue
+            manifest[abs_path.split(shared_folder, 1)[1]] = (stat.st_size, stat.st_mtime_ns)
+        for directory in dirs:
+            directory_path = os.path.join(os.path.abspath(root), directory)
+            if len(os.listdir(directory_path)) == 0:
+                empty_folders.append(directory_path.split(shared_folder, 1)[1])
+    return manifest
+
+
+def bench_scan(args):
+    '''
+    Startup scan of a shared folder, a generated tree unless --folder is given
+    '''
+    with tempfile.TemporaryDirectory() as temp_folder:
+        shared_folder = args.folder
+        if shared_folder is None:
+            shared_folder = temp_folder
+            rng = random.Random(0)
+            for rel_path in tree_paths(rng, args.files):
+                path = os.path.join(shared_folder, rel_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(b"x" * rng.randint(0, 64))
+        shared_folder = os.path.join(os.path.abspath(shared_folder), "")
+        print("startup scan of", shared_folder)
+        print("%-10s %8s %10s %10s" % ("scanner", "threads", "files", "time"))
+        start = time.perf_counter()
+        files = len(scan_walking(shared_folder))
+        print("%-10s %8d %10d %9.3fs" % ("os.walk", 1, files, time.perf_counter() - start))
+        for threads in sorted(set([1, 4, FileManager.SCAN_THREADS, 32])):
+            start = time.perf_counter()
+            files = len(FileManager(shared_folder, threads).local_manifest)
+            print("%-10s %8d %10d %9.3fs" % ("scandir", threads, files, time.perf_counter() - start))
+
+
+def bench_workers(args):
+    '''
+    Batch of modified files synced with the signatures and deltas computed in place and by workers
+    '''
+    rng = random.Random(0)
+    count = 32
+    print("workers (%d modified files of %d bytes, %d cpus)" % (count, args.size, os.cpu_count()))
+    print("%-8s %10s %12s" % ("workers", "time", "MiB/s"))
+    for workers in sorted(set([0, 1, 2, Host.WORKERS])):
+        with tempfile.TemporaryDirectory() as local_folder, tempfile.TemporaryDirectory() as remote_folder:
+            event_list = []
+            remote_files = {}
+            for i in range(count):
+                rel_path = "f%d" % i
+                data = rng.randbytes(args.size)
+                remote_files[rel_path] = edit(rng, data)
+                with open(os.path.join(local_folder, rel_path), "wb") as f:
+                    f.write(data)
+                with open(os.path.join(remote_folder, rel_path), "wb") as f:
+                    f.write(remote_files[rel_path])
+                event_list.append((rel_path, None, False, events.EVENT_TYPE_MODIFIED))
+            receiver, sender = Host(args.block_size, workers=workers), Host(workers=workers)
+            receiver.shared_folder, sender.shared_folder = os.path.join(local_folder, ""), remote_folder
+            receiver.socket, sender.socket = socket.socketpair()
+            receiver.start_workers()
+            sender.start_workers()
+            fm = FileManager()
+            serving = Thread(target=sender.serve_batch)
+            # the worker processes are started outside of the timing
+            for host in (receiver, sender):
+                if host.hash.pool is not None:
+                    list(host.hash.pool.map(abs, range(workers)))
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                serving.start()
+                receiver.request_batch(event_list, fm)
+                serving.join()
+                elapsed = time.perf_counter() - start
+            for rel_path, data in remote_files.items():
+                with open(os.path.join(local_folder, rel_path), "rb") as f:
+                    if f.read() != data:
+                        raise SystemExit("Workers changed the synced file " + rel_path)
+            for host in (receiver, sender):
+                host.socket.close()
+                if host.hash.pool is not None:
+                    host.hash.pool.shutdown()
+            print("%-8d %9.3fs %12.1f" % (workers, elapsed, count * args.size / elapsed / (1 << 20)))
+
+
+def small_files(shared_folder, count):
+    '''
+    Writes count files of up to 4 KiB and returns their created events
+    '''
+    rng = random.Random(0)
+    event_list = []
+    for rel_path in tree_paths(rng, count):
+        path = os.path.join(shared_folder, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(rng.randint(0, 4096)))
+        event_list.append((rel_path, None, False, events.EVENT_TYPE_CREATED))
+    return event_list
+
+
+def bench_pack(args):
+    '''
+    Batch of created small files, answered one response per file and in packs
+    '''
+    count = 5000
+    print("pack (%d created files of up to 4096 bytes)" % count)
+    print("%-10s %8s %10s %12s" % ("responses", "frames", "time", "files/s"))
+    with tempfile.TemporaryDirectory() as remote_folder:
+        event_list = small_files(remote_folder, count)
+        for name, pack_file_size in (("per file", 0), ("packed", Host.PACK_FILE_SIZE)):
+            with tempfile.TemporaryDirectory() as local_folder:
+                receiver, sender = Host(use_cache=False), Host(use_cache=False)
+                receiver.shared_folder, sender.shared_folder = os.path.join(local_folder, ""), remote_folder
+                receiver.socket, sender.socket = socket.socketpair()
+                sender.PACK_FILE_SIZE = pack_file_size
+                frames = []
+                send_frame = sender.send_frame
+                sender.send_frame = lambda op, payload=b"": frames.append(op) or send_frame(op, payload)
+                serving = Thread(target=sender.serve_batch)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    serving.start()
+                    receiver.request_batch(event_list, FileManager())
+                    serving.join()
+                    elapsed = time.perf_counter() - start
+                if len(FileManager(receiver.shared_folder).local_manifest) != count:
+                    raise SystemExit("Packs lost files")
+                receiver.close_channels()
+                sender.close_channels()
+                print("%-10s %8d %9.3fs %12.1f" % (name, len(frames), elapsed, count / elapsed))
+
+
+def bench_channels(args):
+    '''
+    Batch of created small files, sent over one connection and over several data channels
+    '''
+    count = 5000
+    print("channels (%d created files of up to 4096 bytes)" % count)
+    print("%-8s %10s %12s" % ("channels", "time", "files/s"))
+    with tempfile.TemporaryDirectory() as remote_folder:
+        event_list = small_files(remote_folder, count)
+        for channels in (1, 2, 4, 8):
+            with tempfile.TemporaryDirectory() as local_folder:
+                receiver, sender = Host(use_cache=False), Host(use_cache=False)
+                receiver.shared_folder, sender.shared_folder = os.path.join(local_folder, ""), remote_folder
+                receiver.socket, sender.socket = socket.socketpair()
+                for x in range(channels - 1):
+                    receiver_socket, sender_socket = socket.socketpair()
+                    receiver.channels.append(receiver.new_channel(receiver_socket))
+                    sender.channels.append(sender.new_channel(sender_socket))
+                serving = Thread(target=sender.serve_channels)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    serving.start()
+                    receiver.request_batch(event_list, FileManager())
+                    serving.join()
+                    elapsed = time.perf_counter() - start
+                if len(FileManager(receiver.shared_folder).local_manifest) != count:
+                    raise SystemExit("Channels lost files")
+                receiver.close_channels()
+                sender.close_channels()
+                print("%-8d %9.3fs %12.1f" % (channels, elapsed, count / elapsed))
+
+
+def bench_compression(args):
+    '''
+    Ratio and cpu cost of the compression methods on generated files, random data is skipped
+    after the trial compression
+    '''
+    rng = random.Random(0)
+    files = {"source": source_data(rng, args.size), "csv": csv_data(rng, args.size),
+             "random": rng.randbytes(args.size)}
+    print("compression (%d bytes files)" % args.size)
+    print("%-8s %-6s %6s %8s %12s %12s" % ("data", "method", "level", "ratio", "compress", "decompress"))
+    for name, data in files.items():
+        for method in Compression.get_methods()[1:]:
+            for level in (1, 6, 9):
+                compression = Compression(method, level)
+                start = time.perf_counter()
+                compressed = None
+                if compression.trial(data[:Compression.TRIAL_SIZE]):
+                    compressed = compression.compress(data)
+                compress_time = time.perf_counter() - start
+                start = time.perf_counter()
+                if compressed is not None and compression.decompress(compressed, len(data)) != data:
+                    raise SystemExit("%s changed the data" % method)
+                decompress_time = time.perf_counter() - start
+                if compressed is None:
+                    ratio, decompress_rate = 1, "-"
+                else:
+                    ratio = len(compressed) / len(data)
+                    decompress_rate = "%.1fMB/s" % (len(data) / decompress_time / 1e6)
+                print("%-8s %-6s %6d %7.1f%% %10.1fMB/s %12s" % (name, method, level, 100 * ratio,
+                                                                len(data) / compress_time / 1e6, decompress_rate))
+
+
+def bench_dedup(args):
+    '''
+    Created files sharing data with a local file: bytes left to send once the chunks found in
+    the local file are copied, and the transfer time of the whole file and of its chunks
+    '''
+    rng = random.Random(0)
+    size = 16 * args.size
+    base = binary_data(rng, size)
+    files = {"renamed": base, "edited": edit(rng, base), "rotated": base[size // 2:] + base[:size // 2],
+             "random": rng.randbytes(size)}
+    start = time.perf_counter()
+    chunks = list(Chunker().get_chunks(io.BytesIO(base)))
+    elapsed = time.perf_counter() - start
+    print("dedup (%d bytes files, %d chunks of %d bytes on average, chunked at %.1fMB/s)" %
+          (size, len(chunks), size // len(chunks), size / elapsed / 1e6))
+    print("%-8s %12s %12s %12s" % ("file", "sent bytes", "whole", "chunked"))
+    digests = set(ChunkStore.get_digest(x) for x in chunks)
+    for name, data in files.items():
+        missing = sum(len(x) for x in Chunker().get_chunks(io.BytesIO(data)) if ChunkStore.get_digest(x) not in digests)
+        times = []
+        for dedup in (False, True):
+            with tempfile.TemporaryDirectory() as local_folder, tempfile.TemporaryDirectory() as remote_folder:
+                local_folder = os.path.join(local_folder, "shared", "")
+                os.makedirs(local_folder)
+                with open(os.path.join(local_folder, "base"), "wb") as f:
+                    f.write(base)
+                with open(os.path.join(remote_folder, name), "wb") as f:
+                    f.write(data)
+                receiver, sender = Host(use_cache=False, dedup=dedup), Host(use_cache=False, dedup=dedup)
+                receiver.shared_folder, sender.shared_folder = local_folder, remote_folder
+                receiver.socket, sender.socket = socket.socketpair()
+                serving = Thread(target=sender.serve_batch)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fm = FileManager(local_folder)
+                    if dedup:
+                        receiver.open_chunk_store()
+                        receiver.index_chunks(fm)
+                    start = time.perf_counter()
+                    serving.start()
+                    receiver.request_batch([(name, None, False, events.EVENT_TYPE_CREATED)], fm)
+                    serving.join()
+                    times.append(time.perf_counter() - start)
+                with open(os.path.join(local_folder, name), "rb") as f:
+                    if f.read() != data:
+                        raise SystemExit("Dedup changed the data")
+                if receiver.chunk_store is not None:
+                    receiver.chunk_store.close()
+                receiver.close_channels()
+                sender.close_channels()
+        print("%-8s %12d %11.3fs %11.3fs" % (name, missing, times[0], times[1]))
+
+
+BENCHMARKS = {
+    "weak": bench_weak_collisions,
+    "signature": bench_signature_size,
+    "strong": bench_strong_hash,
+    "frame": bench_frame_receive,
+    "codec": bench_codec,
+    "tree": bench_tree_diff,
+    "index": bench_path_index,
+    "scan": bench_scan,
+    "workers": bench_workers,
+    "channels": bench_channels,
+    "pack": bench_pack,
+    "compression": bench_compression,
+    "dedup": bench_dedup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', default=sorted(BENCHMARKS),
+                        help='benchmarks to run: ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--size', dest='size', type=int,
+                        help='size of the generated files', default=1 << 20)
+    parser.add_argument('--paths', dest='paths', type=int,
+                        help='number of paths of the generated trees', default=200000)
+    parser.add_argument('--block-size', dest='block_size', type=int,
+                        help='delta block size in bytes, 0 picks it from the file size', default=0)
+    parser.add_argument('--files', dest='files', type=int,
+                        help='number of files of the generated shared folder', default=20000)
+    parser.add_argument('--folder', dest='folder',
+                        help='existing folder to scan instead of a generated one', default=None)
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            raise SystemExit("Unknown benchmark: " + name)
+    for name in args.names:
+        BENCHMARKS[name](args)
@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+
+import numpy as np
+
+
+class HashCache:
+    '''
+    Persistent cache of file checksums and block signatures.
+    Entries are stored by path relative to the shared folder and are only used while the inode,
+    size and modification time of the file are unchanged. The database lives in a hidden
+    directory next to the shared folder so that it is never synced
+    '''
+    DIRECTORY = ".fs-cache"
+    # files modified this close to being hashed can change again without a new mtime
+    RACY_NS = 2 * 10 ** 9
+    WEAK_TYPE = np.dtype("<u4")
+
+    def __init__(self, shared_folder):
+        self.shared_folder = os.path.abspath(shared_folder)
+        directory = os.path.join(os.path.dirname(self.shared_folder), self.DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, os.path.basename(self.shared_folder) + ".sqlite")
+        # a data channel serves each batch from a new thread, one at a time
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # a lost cache only costs a rehash
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "rel_path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                        "checksum TEXT, block_size INTEGER, strong_hash TEXT, weak BLOB, strong BLOB)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def get_rel_path(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.shared_folder)
+
+    def get_key(self, filename):
+        '''
+        Returns the (inode, size, mtime_ns) of the file
+        '''
+        stat = os.stat(filename)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, filename):
+        '''
+        Returns the cached row of the file if it is still valid or None
+        '''
+        try:
+            key = self.get_key(filename)
+        except OSError:
+            return None
+        row = self.db.execute("SELECT inode, size, mtime_ns, checksum, block_size, strong_hash, weak, strong "
+                              "FROM files WHERE rel_path = ?", (self.get_rel_path(filename),)).fetchone()
+        if row is None or tuple(row[:3]) != key:
+            return None
+        return row
+
+    def get_entry(self, rel_path):
+        '''
+        Returns the (inode, size, mtime_ns, checksum) cached for a path without checking the file,
+        which may be gone, or None
+        '''
+        row = self.db.execute("SELECT inode, size, mtime_ns, checksum FROM files WHERE rel_path = ?",
+                              (os.path.normpath(rel_path),)).fetchone()
+        return None if row is None else tuple(row)
+
+    def get_checksum(self, filename):
+        row = self.lookup(filename)
+        return row[3] if row else None
+
+    def get_signature(self, filename, block_size, strong_hash):
+        '''
+        Returns the cached (checksum, weak, strong) file signature or None
+        '''
+        row = self.lookup(filename)
+        if row is None or row[4] != block_size or row[5] != strong_hash:
+            return None
+        weak = np.frombuffer(row[6], dtype=self.WEAK_TYPE).astype(np.uint32)
+        return row[3], weak, row[7]
+
+    def store(self, filename, key, checksum, block_size=0, strong_hash=None, weak=None, strong=None):
+        '''
+        Cache the hashes computed from the file as it was when key was read.
+        Nothing is stored if the file changed meanwhile or its mtime is too recent to be trusted
+        '''
+        try:
+            if self.get_key(filename) != key:
+                return
+        except OSError:
+            return
+        if key[2] + self.RACY_NS >= time.time_ns():
+            return
+        if weak is not None:
+            weak = np.asarray(weak, dtype=self.WEAK_TYPE).tobytes()
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.get_rel_path(filename), key[0], key[1], key[2], checksum, block_size, strong_hash,
+                         weak, strong))
+        self.db.commit()
+
+    def invalidate(self, rel_path, is_dir=False):
+        '''
+        Drop the entry of a file, or of every file below a directory
+        '''
+        rel_path = os.path.normpath(rel_path)
+        if is_dir:
+            self.db.execute("DELETE FROM files WHERE substr(rel_path, 1, ?) = ?",
+                            (len(rel_path) + 1, rel_path + os.sep))
+        self.db.execute("DELETE FROM files WHERE rel_path = ?", (rel_path,))
+        self.db.commit()
+
+    def move(self, src, dest, is_dir=False):
+        '''
+        Follow a rename, the inode and mtime stay valid so the hashes do too
+        '''
+        src = os.path.normpath(src)
+        dest = os.path.normpath(dest)
+        self.invalidate(dest, is_dir)
+        if is_dir:
+            self.db.execute("UPDATE files SET rel_path = ? || substr(rel_path, ?) WHERE substr(rel_path, 1, ?) = ?",
+                            (dest + os.sep, len(src) + 2, len(src) + 1, src + os.sep))
+        self.db.execute("UPDATE files SET rel_path = ? WHERE rel_path = ?", (dest, src))
+        self.db.commit()
@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+import hashlib
+
+from cache import HashCache
+from chunker import Chunker
+
+
+class ChunkStore:
+    '''
+    Index of the content defined chunks of the shared files: chunk digest to the file and offset
+    holding it. A file received as a list of chunks is built from the local copies of its chunks,
+    whatever file they are in. Entries go stale as files change, chunks are checked against their
+    digest when read and the stale entries of a file are dropped
+    '''
+    # files smaller than this are sent whole
+    MIN_FILE_SIZE = 1024 * 1024
+    DIGEST_SIZE = 20
+    # chunk entries looked at before giving up on a chunk
+    MAX_CANDIDATES = 4
+
+    def __init__(self, shared_folder):
+        self.shared_folder = os.path.abspath(shared_folder)
+        directory = os.path.join(os.path.dirname(self.shared_folder), HashCache.DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, os.path.basename(self.shared_folder) + ".chunks.sqlite")
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # a lost index only costs a rechunk
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "rel_path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                        "digest BLOB, rel_path TEXT, offset INTEGER, length INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_digest ON chunks (digest)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_rel_path ON chunks (rel_path)")
+        self.db.commit()
+        # file the last chunk was read from, the chunks of a file often come from the same one
+        self.file = None
+        self.file_path = None
+
+    def close(self):
+        self.close_file()
+        self.db.close()
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.file_path = None
+
+    @staticmethod
+    def get_digest(data):
+        return hashlib.sha1(data).digest()
+
+    @staticmethod
+    def chunk_file(path):
+        '''
+        Worker process job: returns the (inode, size, mtime_ns) key and the checksum of the file
+        with the (digest, offset, length) of its chunks, in a single read of the file
+        '''
+        chunks = []
+        checksum = hashlib.sha1()
+        offset = 0
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            for chunk in Chunker().get_chunks(f):
+                checksum.update(chunk)
+                chunks.append((ChunkStore.get_digest(chunk), offset, len(chunk)))
+                offset = offset + len(chunk)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns), checksum.hexdigest(), chunks
+
+    def is_indexed(self, rel_path, key):
+        row = self.db.execute("SELECT inode, size, mtime_ns FROM files WHERE rel_path = ?", (rel_path,)).fetchone()
+        return row is not None and tuple(row) == key
+
+    def add_file(self, rel_path, key, chunks):
+        '''
+        Replaces the chunks of a file with the (digest, offset, length) chunks of its version of key.
+        The file is chunked again next time if its mtime is too recent to be trusted
+        '''
+        self.remove_file(rel_path, False)
+        self.db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                            ((digest, rel_path, offset, length) for digest, offset, length in chunks))
+        if key[2] + HashCache.RACY_NS < time.time_ns():
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (rel_path,) + tuple(key))
+        self.db.commit()
+
+    def remove_file(self, rel_path, commit=True):
+        if rel_path == self.file_path:
+            self.close_file()
+        self.db.execute("DELETE FROM chunks WHERE rel_path = ?", (rel_path,))
+        self.db.execute("DELETE FROM files WHERE rel_path = ?", (rel_path,))
+        if commit:
+            self.db.commit()
+
+    def prune(self, rel_paths):
+        '''
+        Drops the files that are not among the given ones
+        '''
+        for row in self.db.execute("SELECT rel_path FROM files").fetchall():
+            if row[0] not in rel_paths:
+                self.remove_file(row[0], False)
+        self.db.commit()
+
+    def read(self, digest, length):
+        '''
+        Returns the data of a chunk from the local files, None if no file holds it anymore
+        '''
+        rows = self.db.execute("SELECT rel_path, offset FROM chunks WHERE digest = ? AND length = ? LIMIT ?",
+                               (digest, length, self.MAX_CANDIDATES)).fetchall()
+        for rel_path, offset in rows:
+            try:
+                if rel_path != self.file_path:
+                    self.close_file()
+                    self.file = open(os.path.join(self.shared_folder, rel_path), "rb")
+                    self.file_path = rel_path
+                self.file.seek(offset)
+                data = self.file.read(length)
+            except IOError:
+                data = None
+            if data is not None and self.get_digest(data) == digest:
+                return data
+            self.remove_file(rel_path)
+        return None
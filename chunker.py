@@ -0,0 +1,76 @@
+import hashlib
+
+import numpy as np
+
+
+class Chunker:
+    '''
+    Content defined chunking with the FastCDC gear hash. A chunk ends where the hash of the 32 bytes
+    before it matches a mask, so the chunks of some data do not depend on its offset: data shifted
+    by an insert, or copied into another file, gives the same chunks
+    '''
+    MIN_SIZE = 16 * 1024
+    AVERAGE_SIZE = 64 * 1024
+    MAX_SIZE = 256 * 1024
+    # normalized chunking: a harder mask before the average size and an easier one after it,
+    # the high bits of the hash depend on the whole window
+    MASK_S = np.uint32(0xffffc000)
+    MASK_L = np.uint32(0xfffc0000)
+    READ_SIZE = 8 * 1024 * 1024
+    GEAR = np.array([int.from_bytes(hashlib.sha1(bytes([x])).digest()[:4], "big") for x in range(256)],
+                    dtype=np.uint32)
+
+    def get_gear_hashes(self, data):
+        '''
+        Gear hash of the window ending at every byte, sum of GEAR[byte] << distance to the end.
+        The window is doubled until it is 32 bytes, the hashes of the first 31 bytes cover less
+        '''
+        hashes = self.GEAR[np.frombuffer(data, dtype=np.uint8)]
+        width = 1
+        while width < 32:
+            # numpy buffers the overlapping operands
+            hashes[width:] += hashes[:-width] << np.uint32(width)
+            width = width * 2
+        return hashes
+
+    def find_cut(self, small, large, start, length, eof):
+        '''
+        Returns the end of the chunk starting at start, None if more data is needed to know it.
+        small and large are the offsets whose hashes match MASK_S and MASK_L
+        '''
+        # a match at offset x ends the chunk after x, windows always lie inside the chunk
+        index = np.searchsorted(small, start + self.MIN_SIZE - 1)
+        if index < len(small) and small[index] < start + self.AVERAGE_SIZE - 1:
+            return int(small[index]) + 1
+        if length < start + self.AVERAGE_SIZE and not eof:
+            return None
+        index = np.searchsorted(large, start + self.AVERAGE_SIZE - 1)
+        if index < len(large) and large[index] < start + self.MAX_SIZE - 1:
+            return int(large[index]) + 1
+        if length < start + self.MAX_SIZE and not eof:
+            return None
+        return min(start + self.MAX_SIZE, length)
+
+    def get_chunks(self, file):
+        '''
+        Yields the chunks of the open file
+        '''
+        buffer = b""
+        eof = False
+        while not eof:
+            data = file.read(self.READ_SIZE)
+            eof = len(data) == 0
+            # the buffer starts with a chunk, the hashes of its first bytes are never used
+            buffer = buffer + data
+            hashes = self.get_gear_hashes(buffer)
+            # the bits of MASK_L are among the ones of MASK_S
+            large = np.flatnonzero((hashes & self.MASK_L) == 0)
+            small = large[(hashes[large] & self.MASK_S) == 0]
+            start = 0
+            while start < len(buffer):
+                cut = self.find_cut(small, large, start, len(buffer), eof)
+                if cut is None:
+                    break
+                yield buffer[start:cut]
+                start = cut
+            buffer = buffer[start:]
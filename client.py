@@ -12,9 +12,11 @@ from host import Host
 
 
 class Client(Thread, Host):
-    def __init__(self, shared_folder, ip='0.0.0.0', port=60000):
+    def __init__(self, shared_folder, ip='0.0.0.0', port=60000, use_cache=True, chunk_size=Host.FILE_CHUNK_SIZE,
+                 workers=Host.WORKERS, channel_count=Host.CHANNELS):
         Thread.__init__(self)
-        Host.__init__(self)
+        Host.__init__(self, use_cache=use_cache, chunk_size=chunk_size, workers=workers,
+                      channel_count=channel_count)
         self.ip = ip
         self.port = port
         self.socket = None
@@ -26,37 +28,41 @@ class Client(Thread, Host):
         Sync the offline content with the server
         '''
         if self.sync_mode == self.SyncMode.SERVER_OVERWRITING_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_receive_modified(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_DELETED):
-                self.transaction_remove(x, fm)
-            for x in fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True):
-                self.transaction_created_folders(x, fm)
-            for x in fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED):
-                self.transaction_receive_created(x, fm)
+            self.request_batch(fm.list_to_event(fm.modified, events.EVENT_TYPE_MODIFIED) +
+                               fm.list_to_event(fm.local_only, events.EVENT_TYPE_DELETED) +
+                               fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True) +
+                               fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED), fm)
         elif self.sync_mode == self.SyncMode.CLIENT_OVERWRITING_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_send_modified(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_CREATED):
-                self.transaction_send_created(x, fm)
-        if self.sync_mode == self.SyncMode.SERVER_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_receive_modified(x, fm)
-            for x in fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED):
-                self.transaction_receive_created(x, fm)
-            for x in fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True):
-                self.transaction_created_folders(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_CREATED):
-                self.transaction_send_created(x, fm)
+            self.serve_channels()
+        elif self.sync_mode == self.SyncMode.SERVER_PRIORITY:
+            self.request_batch(fm.list_to_event(fm.modified, events.EVENT_TYPE_MODIFIED) +
+                               fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED) +
+                               fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True), fm)
+            self.serve_channels()
         elif self.sync_mode == self.SyncMode.CLIENT_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_send_modified(x, fm)
-            for x in fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED):
-                self.transaction_receive_created(x, fm)
-            for x in fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True):
-                self.transaction_created_folders(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_CREATED):
-                self.transaction_send_created(x, fm)
+            self.serve_channels()
+            self.request_batch(fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED) +
+                               fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True), fm)
+
+    def open_channels(self):
+        '''
+        Opens the extra data channels the server accepts, the ones that can not connect are left out
+        '''
+        count, session = self.receive_message().split()
+        for x in range(min(int(count), self.channel_count) - 1):
+            channel_socket = socket.socket()
+            try:
+                channel_socket.connect((self.ip, self.port))
+                channel = self.new_channel(channel_socket)
+                channel.accept_protocol()
+                channel.send_message(session)
+            except (IOError, ValueError) as e:
+                print("Could not open data channel", e)
+                channel_socket.close()
+                break
+            self.channels.append(channel)
+        self.send_message(str(len(self.channels)))
+        print("Data channels:", len(self.channels))
 
     def run(self):
         self.socket = socket.socket()
@@ -66,16 +72,38 @@ class Client(Thread, Host):
         except socket.error as e:
             print("Could not connect to server", str(e))
 
-        self.sync_mode = int(self.receive_fixed_string_size())
+        try:
+            self.accept_protocol()
+        except (IOError, ValueError) as e:
+            print("Server protocol not supported", e)
+            self.socket.close()
+            return
+        # a new session, data channels send the session of the server instead
+        self.send_message("")
+        self.sync_mode = int(self.receive_message())
+        self.hash.block_size = int(self.receive_message())
+        self.accept_strong_hash()
+        self.accept_compression()
+        self.accept_dedup()
+        self.open_cache()
+        if self.dedup:
+            self.open_chunk_store()
+        self.start_workers()
+        self.open_channels()
         event_list = []
 
-        # send file list
+        # compare the folder trees, only the differing folders are listed
         fm = FileManager(self.shared_folder)
-        fm.remote_rel_paths = self.receive_object()
-        self.send_object(fm.local_rel_paths)
-        fm.remote_empty_folders = self.receive_object()
-        self.send_object(fm.local_empty_folder)
+        if self.chunk_store is not None:
+            self.index_chunks(fm)
+        self.diff_trees(fm, False)
         fm.calc_matched_files()
+        # checksums are only exchanged for the files the quick check can not decide
+        unsure_files = fm.get_unsure_files()
+        local_checksums = self.get_local_checksums(unsure_files)
+        remote_checksums = self.receive_checksums()
+        self.send_checksums(local_checksums)
+        fm.calc_modified_files(unsure_files, local_checksums, remote_checksums)
         self.total_sync(fm)
         fm.clear_exceptions()
 
@@ -85,9 +113,9 @@ class Client(Thread, Host):
 
         msg = self.Msg.e
         while True:
-            msg = self.receive_fixed_string_size()
+            msg = self.receive_message()
             if watchdog.q.empty():
-                self.send_fixed_string_size(str(msg))
+                self.send_message(str(msg))
             else:
                 if IsReadyToSync.ready:
                     event_list = self.filter_queue(watchdog.q, fm)
@@ -99,7 +127,7 @@ class Client(Thread, Host):
                     else:
                         if event_list:
                             msg = self.Msg.c
-                self.send_fixed_string_size(str(msg))
+                self.send_message(str(msg))
 
             time.sleep(1)
             if msg == self.Msg.e:
@@ -119,18 +147,28 @@ class Client(Thread, Host):
                 self.receive_all_data(fm)
                 self.send_all_data(event_list, fm)
             elif msg == self.Msg.x:
-                self.socket.close()
+                self.close_channels()
             else:
                 print("Fatal exception, message incorrect", msg)
-                self.socket.close()
+                self.close_channels()
             msg = self.Msg.e
 
 
 def main(args):
     if not args.shared_folder.endswith(os.sep):
         args.shared_folder = args.shared_folder + os.sep
+    if args.channels <= 0:
+        raise ValueError("Channels have to be positive")
+    if args.workers < 0:
+        raise ValueError("Workers can not be negative")
+    if args.chunk_size <= 0:
+        raise ValueError("Chunk size has to be positive")
     shared_folder = os.path.join(os.path.abspath(os.curdir), args.shared_folder)
-    Client(shared_folder, args.ip, args.port).start()
+    client = Client(shared_folder, args.ip, args.port, not args.no_cache, args.chunk_size, args.workers,
+                    args.channels)
+    client.start()
+    # the startup scan uses a thread pool, which refuses work once the main thread has exited
+    client.join()
 
 
 def dir_path(string):
@@ -149,6 +187,16 @@ if __name__ == "__main__":
                         help='ip', default='0.0.0.0', nargs='?')
     parser.add_argument('--port', dest='port', type=int,
                         help='port number', default=50000, nargs='?')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='rehash files instead of caching their checksums next to the shared folder')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        help='size in bytes of the socket reads of file data', default=Host.FILE_CHUNK_SIZE)
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='processes hashing and diffing files ahead of the transfers, 0 for none',
+                        default=Host.WORKERS)
+    parser.add_argument('--channels', dest='channels', type=int,
+                        help='connections carrying the file transfers, the server may accept fewer',
+                        default=Host.CHANNELS)
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,194 @@
+import gc
+import itertools
+import struct
+import zlib
+
+import numpy as np
+from watchdog import events
+
+from file_manager import FileManager
+
+
+class Codec:
+    '''
+    Binary encoding of the protocol messages, replaces pickle so that a peer can only send data.
+    Strings are utf-8 joined by NUL, which can not appear in a path, and numbers are packed in
+    arrays, so encoding and decoding are a few calls into C whatever the number of entries.
+    Paths are strings like the others, large messages are deflated, which takes out most of the
+    prefixes the paths of a folder share
+    '''
+    COUNT = struct.Struct("!I")
+    COMPRESS_MIN_SIZE = 1 << 12
+    COMPRESS_LEVEL = 1
+    PLAIN = b"\0"
+    DEFLATED = b"\1"
+    SIZE_TYPE = np.dtype("<u8")
+    MTIME_TYPE = np.dtype("<i8")
+    EVENT_TYPES = (events.EVENT_TYPE_CREATED, events.EVENT_TYPE_DELETED,
+                   events.EVENT_TYPE_MODIFIED, events.EVENT_TYPE_MOVED, FileManager.EVENT_TYPE_COPIED)
+    # event flag byte: type index, plus EVENT_IS_DIR for folders and EVENT_HAS_DESTINATION for the
+    # events with a destination. The flags are decoded as an array, the types looked up all at once
+    EVENT_IS_DIR = 0x10
+    EVENT_HAS_DESTINATION = 0x20
+    EVENT_TYPE_MASK = EVENT_IS_DIR - 1
+    EVENT_TYPE_TABLE = np.array(EVENT_TYPES + (None,) * (EVENT_IS_DIR - len(EVENT_TYPES)), dtype=object)
+    EVENT_FLAGS = (np.arange(len(EVENT_TYPES), dtype=np.uint8) |
+                   np.array([0, EVENT_IS_DIR, EVENT_HAS_DESTINATION, EVENT_IS_DIR | EVENT_HAS_DESTINATION],
+                            dtype=np.uint8)[:, None]).tobytes()
+    CHECKSUM_SIZE = 20
+    MISSING_CHECKSUM = "00" * CHECKSUM_SIZE
+    DIGEST_TYPE = np.dtype("V%d" % CHECKSUM_SIZE)
+    # folder hashes of the tree diff are SHA1 too
+    FOLDER_HASH_SIZE = CHECKSUM_SIZE
+
+    def __init__(self, compress=True):
+        self.compress = compress
+
+    def encode_strings(self, strings):
+        return self.COUNT.pack(len(strings)) + "\0".join(strings).encode("utf-8")
+
+    def decode_strings(self, data, offset=0):
+        '''
+        Returns the strings and the offset after them, the string data has to end the buffer
+        '''
+        count = self.COUNT.unpack_from(data, offset)[0]
+        offset = offset + self.COUNT.size
+        if count == 0:
+            return [], offset
+        strings = str(memoryview(data)[offset:], "utf-8").split("\0")
+        if len(strings) != count:
+            raise IOError("Expected " + str(count) + " strings, got " + str(len(strings)))
+        return strings, len(data)
+
+    def pack(self, data):
+        '''
+        Prefixes the data with a flag byte, deflating it when it is large enough to gain from it
+        '''
+        if self.compress and len(data) >= self.COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(data, self.COMPRESS_LEVEL)
+            if len(compressed) < len(data):
+                return self.DEFLATED + compressed
+        return self.PLAIN + data
+
+    def unpack(self, data):
+        flag = data[:1]
+        if flag == self.PLAIN:
+            return memoryview(data)[1:]
+        if flag == self.DEFLATED:
+            try:
+                return zlib.decompress(memoryview(data)[1:])
+            except zlib.error as e:
+                raise IOError("Corrupted compressed message: " + str(e))
+        raise IOError("Unknown message encoding " + str(flag))
+
+    def encode_stats(self, manifest):
+        '''
+        rel_path: (size, mtime_ns) dictionary as the sizes, the mtimes and then the paths
+        '''
+        count = len(manifest)
+        stats = np.fromiter(itertools.chain.from_iterable(manifest.values()), dtype=np.int64,
+                            count=2 * count).reshape(count, 2)
+        return (self.COUNT.pack(count) + stats[:, 0].astype(self.SIZE_TYPE).tobytes() +
+                stats[:, 1].astype(self.MTIME_TYPE).tobytes() + self.encode_strings(list(manifest)))
+
+    def decode_stats(self, data):
+        count = self.COUNT.unpack_from(data)[0]
+        offset = self.COUNT.size
+        sizes = np.frombuffer(data, dtype=self.SIZE_TYPE, count=count, offset=offset).tolist()
+        offset = offset + count * self.SIZE_TYPE.itemsize
+        mtimes = np.frombuffer(data, dtype=self.MTIME_TYPE, count=count, offset=offset).tolist()
+        offset = offset + count * self.MTIME_TYPE.itemsize
+        paths = self.decode_strings(data, offset)[0]
+        if len(paths) != count:
+            raise IOError("Manifest paths do not match its stats")
+        return paths, sizes, mtimes
+
+    def encode_listing(self, manifest, folders):
+        '''
+        Part of a folder tree: the manifest of the files and the rel_path: hash dictionary of the folders
+        '''
+        folder_data = (self.COUNT.pack(len(folders)) + b"".join(folders.values()) +
+                       self.encode_strings(list(folders)))
+        return self.pack(self.COUNT.pack(len(folder_data)) + folder_data + self.encode_stats(manifest))
+
+    def decode_listing(self, data):
+        '''
+        Returns the (paths, sizes, mtimes) of the files and the rel_path: hash dictionary of the folders
+        '''
+        data = memoryview(self.unpack(data))
+        folder_size = self.COUNT.unpack_from(data)[0]
+        offset = self.COUNT.size
+        folder_data = data[offset:offset + folder_size]
+        count = self.COUNT.unpack_from(folder_data)[0]
+        hashes_end = self.COUNT.size + count * self.FOLDER_HASH_SIZE
+        if len(folder_data) != folder_size or len(folder_data) < hashes_end:
+            raise IOError("Folder listing is corrupted")
+        paths = self.decode_strings(folder_data, hashes_end)[0]
+        if len(paths) != count:
+            raise IOError("Folder listing is corrupted")
+        hashes = bytes(folder_data[self.COUNT.size:hashes_end])
+        folders = dict(zip(paths, (hashes[x:x + self.FOLDER_HASH_SIZE]
+                                   for x in range(0, len(hashes), self.FOLDER_HASH_SIZE))))
+        return self.decode_stats(data[offset + folder_size:]), folders
+
+    def encode_events(self, event_list):
+        '''
+        (src, dest, is_dir, type) events as one flag byte each, then the sources and the destinations
+        of the events flagged with one
+        '''
+        flags = bytes(self.EVENT_TYPES.index(type) | (self.EVENT_IS_DIR if is_dir else 0) |
+                      (0 if dest is None else self.EVENT_HAS_DESTINATION)
+                      for src, dest, is_dir, type in event_list)
+        sources = self.encode_strings([src for src, dest, is_dir, type in event_list])
+        destinations = self.encode_strings([dest for src, dest, is_dir, type in event_list if dest is not None])
+        return self.COUNT.pack(len(flags)) + flags + self.COUNT.pack(len(sources)) + sources + destinations
+
+    def decode_events(self, data):
+        count = self.COUNT.unpack_from(data)[0]
+        offset = self.COUNT.size
+        flags = data[offset:offset + count]
+        offset = offset + count
+        sources_size = self.COUNT.unpack_from(data, offset)[0]
+        offset = offset + self.COUNT.size
+        sources = self.decode_strings(memoryview(data)[offset:offset + sources_size])[0]
+        destination_list = self.decode_strings(data, offset + sources_size)[0]
+        if len(flags) != count or len(sources) != count:
+            raise IOError("Event list is corrupted")
+        if flags.translate(None, self.EVENT_FLAGS):
+            raise IOError("Unknown event type")
+        flags = np.frombuffer(flags, dtype=np.uint8)
+        has_destination = (flags & self.EVENT_HAS_DESTINATION) != 0
+        if np.count_nonzero(has_destination) != len(destination_list):
+            raise IOError("Event list is corrupted")
+        destinations = np.full(count, None, dtype=object)
+        destinations[has_destination] = destination_list
+        destinations = destinations.tolist()
+        is_dirs = ((flags & self.EVENT_IS_DIR) != 0).tolist()
+        types = self.EVENT_TYPE_TABLE[flags & self.EVENT_TYPE_MASK].tolist()
+        # the event tuples only hold strings, bools and None, the collections triggered by their
+        # allocation would walk all of them to free nothing
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return list(zip(sources, destinations, is_dirs, types))
+        finally:
+            if enabled:
+                gc.enable()
+
+    def encode_checksums(self, checksums):
+        '''
+        Hex SHA1 checksums as binary digests, a missing checksum is sent as a digest of zeros
+        '''
+        digests = "".join([self.MISSING_CHECKSUM if checksum is None else checksum for checksum in checksums])
+        return self.COUNT.pack(len(checksums)) + bytes.fromhex(digests)
+
+    def decode_checksums(self, data):
+        '''
+        Returns the checksums as binary digests, they are only compared. A missing checksum is a
+        digest of zeros, which no file has
+        '''
+        count = self.COUNT.unpack_from(data)[0]
+        offset = self.COUNT.size
+        if len(data) != offset + count * self.CHECKSUM_SIZE:
+            raise IOError("Checksum list is corrupted")
+        return np.frombuffer(data, dtype=self.DIGEST_TYPE, offset=offset).tolist()
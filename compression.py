@@ -0,0 +1,144 @@
+import os
+import bz2
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+class Compression:
+    '''
+    Compression of the file data sent to the remote host, the method is negotiated at connection.
+    Data that does not shrink enough is sent as is: files of already compressed formats are
+    recognized by their extension and the others are tried on their first bytes
+    '''
+    NONE = "none"
+    DEFAULT_METHOD = "zlib"
+    # fast levels, the data has to be compressed faster than the network sends it
+    DEFAULT_LEVEL = 1
+    # data smaller than this is not worth compressing
+    MIN_SIZE = 256
+    # sent compressed only if it shrinks below this part of its size
+    MAX_RATIO = 0.9
+    # bytes of a file compressed to decide if the whole file is
+    TRIAL_SIZE = 64 * 1024
+    COMPRESSED_EXTENSIONS = {".7z", ".apk", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".jar", ".jpeg", ".jpg",
+                             ".lz4", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".pdf", ".png", ".pptx", ".rar", ".tgz",
+                             ".webm", ".webp", ".woff2", ".xlsx", ".xz", ".zip", ".zst"}
+
+    def __init__(self, method=NONE, level=DEFAULT_LEVEL):
+        self.method = method
+        self.level = level
+        # bytes before and after compression and thread cpu seconds spent since the last take_stats
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.cpu_time = 0
+
+    @classmethod
+    def get_methods(cls):
+        '''
+        Compression methods known by this host, lzma is optional in python builds
+        '''
+        methods = [cls.NONE, "zlib", "bz2"]
+        if lzma is not None:
+            methods.append("lzma")
+        return methods
+
+    def is_enabled(self):
+        return self.method != self.NONE
+
+    def new_compressor(self):
+        if self.method == "zlib":
+            return zlib.compressobj(self.level)
+        if self.method == "bz2":
+            return bz2.BZ2Compressor(self.level)
+        return lzma.LZMACompressor(preset=self.level)
+
+    def new_decompressor(self):
+        if self.method == "zlib":
+            return zlib.decompressobj()
+        if self.method == "bz2":
+            return bz2.BZ2Decompressor()
+        return lzma.LZMADecompressor()
+
+    def get_errors(self):
+        '''
+        Exceptions raised by the decompressors on corrupted data
+        '''
+        if lzma is None:
+            return zlib.error, OSError, EOFError
+        return zlib.error, OSError, EOFError, lzma.LZMAError
+
+    def is_compressible(self, path):
+        '''
+        False if compression is off or the file is of a compressed format
+        '''
+        return self.is_enabled() and os.path.splitext(path)[1].lower() not in self.COMPRESSED_EXTENSIONS
+
+    def run(self, compressor, data, flush=False):
+        start = time.thread_time()
+        output = compressor.compress(data)
+        if flush:
+            output = output + compressor.flush()
+        self.cpu_time = self.cpu_time + time.thread_time() - start
+        return output
+
+    def trial(self, data):
+        '''
+        True if the data shrinks enough to be sent compressed
+        '''
+        return len(self.run(self.new_compressor(), data, True)) < len(data) * self.MAX_RATIO
+
+    def compress(self, data):
+        '''
+        Returns the compressed data, None if it is not worth sending compressed
+        '''
+        if not self.is_enabled():
+            return None
+        self.raw_bytes = self.raw_bytes + len(data)
+        if len(data) < self.MIN_SIZE:
+            self.sent_bytes = self.sent_bytes + len(data)
+            return None
+        output = self.run(self.new_compressor(), data, True)
+        if len(output) >= len(data) * self.MAX_RATIO:
+            self.sent_bytes = self.sent_bytes + len(data)
+            return None
+        self.sent_bytes = self.sent_bytes + len(output)
+        return output
+
+    def count(self, raw_size, sent_size):
+        '''
+        Adds data compressed by a stream compressor to the stats
+        '''
+        self.raw_bytes = self.raw_bytes + raw_size
+        self.sent_bytes = self.sent_bytes + sent_size
+
+    def decompress(self, data, size):
+        '''
+        Returns the decompressed data, it has to be size bytes long
+        '''
+        try:
+            # a corrupted stream is not decompressed past the expected size
+            output = self.new_decompressor().decompress(data, size + 1)
+        except self.get_errors() as e:
+            raise IOError("Corrupted compressed data: " + str(e))
+        if len(output) != size:
+            raise IOError("Corrupted compressed data size")
+        return output
+
+    def take_stats(self):
+        '''
+        Returns the stats of the data compressed since the last call, None if nothing was
+        '''
+        if not self.raw_bytes:
+            self.cpu_time = 0
+            return None
+        stats = "%d -> %d bytes (%.1f%%), %.3fs cpu" % (self.raw_bytes, self.sent_bytes,
+                                                       100 * self.sent_bytes / self.raw_bytes, self.cpu_time)
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.cpu_time = 0
+        return stats
@@ -1,53 +1,150 @@
 import os.path
+from concurrent.futures import ThreadPoolExecutor
+from watchdog import events
+
+from path_index import PathIndex
 
 
 class FileManager:
-    def __init__(self, shared_folder=""):
+    TEMP_PREFIX = ".~fs-"
+    # a created file with the content of another file of the batch, copied by the remote host
+    EVENT_TYPE_COPIED = "copied"
+    # folders listed at the same time by the startup scan
+    SCAN_THREADS = 8
+    SCAN_CHUNKS_PER_THREAD = 4
+
+    def __init__(self, shared_folder="", scan_threads=SCAN_THREADS):
         self.shared_folder = shared_folder
+        self.scan_threads = scan_threads
         self.local_abs_paths = []
-        self.local_rel_paths = []
+        self.local_rel_paths = PathIndex()
         self.local_empty_folder = []
         self.remote_empty_folders = []
         self.remote_rel_paths = []
+        # local files the tree diff could not rule out, the ones to match with the remote files
+        self.compared_rel_paths = []
+        # rel_path: (size, mtime_ns) of the files found at startup, then followed through the local events
+        self.local_manifest = {}
+        self.local_inodes = {}
+        self.remote_manifest = {}
         self.matched = []
+        self.modified = []
         self.local_only = []
         self.remote_only = []
-        self.files_just_received = []
+        # events of the local changes made by the sync, not to be sent back
+        self.files_just_received = set()
 
         self.get_local_files()
 
     def get_local_files(self):
-        if self.shared_folder and os.path.isdir(self.shared_folder):
-            for root, dirs, files in os.walk(self.shared_folder):
-                for name in files:
-                    abs_path = os.path.join(os.path.abspath(root), name)
-                    rel_path = abs_path.split(self.shared_folder, 1)[1]
-                    self.local_abs_paths.append(abs_path)
-                    self.local_rel_paths.append(rel_path)
-                for directory in dirs:
-                    directory_path = os.path.join(os.path.abspath(root), directory)
-                    if len(os.listdir(directory_path)) == 0:
-                        self.local_empty_folder.append(directory_path.split(self.shared_folder, 1)[1])
-
-    def update_local_files_from_dir(self, dir_path, files_needed=True):
-        if os.path.isdir(dir_path):
-            for root, dirs, files in os.walk(self.shared_folder):
-                for name in files:
-                    rel_path = os.path.join(os.path.abspath(root), name).split(self.shared_folder, 1)[1]
-                    try:
-                        if rel_path not in self.local_rel_paths:
-                            if files_needed:
-                                self.local_rel_paths.append(rel_path)
-
-                            else:
-                                self.local_rel_paths.remove(rel_path)
-                    except ValueError:
-                        pass
+        """
+        Scans the shared folder with scandir, one level of folders at a time. The folders of a level
+        are split in chunks listed in parallel
+        """
+        if not self.shared_folder or not os.path.isdir(self.shared_folder):
+            return
+        with ThreadPoolExecutor(self.scan_threads) as executor:
+            level = [""]
+            while level:
+                chunk_size = -(-len(level) // (self.scan_threads * self.SCAN_CHUNKS_PER_THREAD))
+                chunks = [level[x:x + chunk_size] for x in range(0, len(level), chunk_size)]
+                level = []
+                for files, folders, empty_folders in executor.map(self.scan_folders, chunks):
+                    for rel_path, abs_path, size, mtime, inode in files:
+                        self.local_manifest[rel_path] = (size, mtime)
+                        self.local_inodes[rel_path] = inode
+                        self.local_abs_paths.append(abs_path)
+                        self.local_rel_paths.add(rel_path)
+                    self.local_empty_folder.extend(empty_folders)
+                    level.extend(folders)
+
+    def scan_folders(self, rel_folders):
+        """
+        Lists the folders, returns the (rel_path, abs_path, size, mtime_ns, inode) of their files,
+        their sub folders and the ones that are empty
+        """
+        files = []
+        folders = []
+        empty_folders = []
+        for rel_folder in rel_folders:
+            try:
+                with os.scandir(os.path.join(self.shared_folder, rel_folder)) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            if rel_folder and not entries:
+                empty_folders.append(rel_folder)
+            for entry in entries:
+                rel_path = os.path.join(rel_folder, entry.name)
+                try:
+                    if entry.is_dir():
+                        # like os.walk, linked folders are not followed
+                        if not entry.is_symlink():
+                            folders.append(rel_path)
+                    elif not self.is_temp_file(entry.name):
+                        stat = entry.stat()
+                        files.append((rel_path, entry.path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+                except OSError:
+                    continue
+        return files, folders, empty_folders
+
+    def update_manifest(self, rel_path, dest_rel_path, event_type):
+        """
+        Follows a local file event in the manifest. Returns the last known (inode, size, mtime_ns)
+        of a deleted file, None for the other events
+        """
+        if event_type == events.EVENT_TYPE_DELETED:
+            state = self.local_manifest.pop(rel_path, None)
+            inode = self.local_inodes.pop(rel_path, None)
+            return None if state is None or inode is None else (inode,) + state
+        if event_type == events.EVENT_TYPE_MOVED:
+            if rel_path in self.local_manifest:
+                self.local_manifest[dest_rel_path] = self.local_manifest.pop(rel_path)
+            if rel_path in self.local_inodes:
+                self.local_inodes[dest_rel_path] = self.local_inodes.pop(rel_path)
+            return None
+        try:
+            stat = os.stat(os.path.join(self.shared_folder, rel_path))
+        except OSError:
+            return None
+        self.local_manifest[rel_path] = (stat.st_size, stat.st_mtime_ns)
+        self.local_inodes[rel_path] = stat.st_ino
+        return None
+
+    def is_temp_file(self, path):
+        return os.path.basename(path).startswith(self.TEMP_PREFIX)
+
+    def set_remote_manifest(self, paths, sizes, mtimes):
+        """
+        Takes the decoded manifest of the remote host, its paths are sorted
+        """
+        self.remote_rel_paths = paths
+        self.remote_manifest = dict(zip(paths, zip(sizes, mtimes)))
 
     def calc_matched_files(self):
-        self.matched = list(set(self.local_rel_paths) & set(self.remote_rel_paths))
-        self.local_only = list(set(self.local_rel_paths) - set(self.remote_rel_paths))
-        self.remote_only = list(set(self.remote_rel_paths) - set(self.local_rel_paths))
+        # sorted so that both hosts walk the lists in the same order
+        self.matched = sorted(set(self.compared_rel_paths) & set(self.remote_rel_paths))
+        self.local_only = sorted(set(self.compared_rel_paths) - set(self.remote_rel_paths))
+        self.remote_only = sorted(set(self.remote_rel_paths) - set(self.compared_rel_paths))
+
+    def get_unsure_files(self):
+        """
+        Quick check of the matched files: a different size means the content differs, the same
+        size and mtime means it is the same. The remaining files need their checksums compared
+        """
+        return [x for x in self.matched
+                if self.local_manifest[x][0] == self.remote_manifest[x][0]
+                and self.local_manifest[x][1] != self.remote_manifest[x][1]]
+
+    def calc_modified_files(self, unsure_files, local_checksums, remote_checksums):
+        """
+        Matched files whose content differs, a missing checksum counts as different.
+        The remote checksums are binary digests, the missing ones are zeros and match no file
+        """
+        same = set(x for x, local, remote in zip(unsure_files, local_checksums, remote_checksums)
+                   if local is not None and bytes.fromhex(local) == remote)
+        self.modified = [x for x in self.matched
+                         if x not in same and self.local_manifest[x] != self.remote_manifest[x]]
 
     def list_to_event(self, input_list, event_type, is_folder=False):
         event_list = []
@@ -56,13 +153,11 @@ class FileManager:
         return event_list
 
     def add_unique_exception(self, elem):
-        if elem not in self.files_just_received:
-            self.files_just_received.append(elem)
+        self.files_just_received.add(elem)
 
     def rm_unique_exception(self, elem):
-        if elem in self.files_just_received:
-            self.files_just_received.remove(elem)
+        self.files_just_received.discard(elem)
 
     def clear_exceptions(self):
         if self.files_just_received:
-            self.files_just_received = []
\ No newline at end of file
+            self.files_just_received = set()
\ No newline at end of file
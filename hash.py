@@ -1,56 +1,307 @@
+import os
+import math
+import mmap
+import time
 import hashlib
-from array import array
+import multiprocessing
+from threading import Thread
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 
 class Hash:
-    HASH_BLOCK_SIZE = 256
+    MIN_BLOCK_SIZE = 700
+    MAX_BLOCK_SIZE = 128 * 1024
+    SEGMENT_SIZE = 8 * 1024 * 1024
+    MIN_STRONG_HASH_SIZE = 2
+    STRONG_HASH_BIAS = 10
+    # block hashes by name, the digests are truncated on the wire so a long digest buys nothing.
+    # sha1 is the fastest on cpus with sha extensions, blake2b on the ones without
+    STRONG_HASHES = {
+        "blake2b": partial(hashlib.blake2b, digest_size=16),
+        "md5": hashlib.md5,
+        "sha1": hashlib.sha1,
+    }
+    DEFAULT_STRONG_HASH = "sha1"
+    # smaller files are hashed in place, a worker process would cost more than the hashing
+    PREFETCH_MIN_SIZE = 256 * 1024
 
-    def get_file_bytes(self, filename):
+    def __init__(self, block_size=0, strong_hash=DEFAULT_STRONG_HASH):
+        # 0 picks the block size from the file size
+        self.block_size = block_size
+        # optional HashCache consulted before hashing whole files
+        self.cache = None
+        self.set_strong_hash(strong_hash)
+        # optional process pool hashing files before they are needed
+        self.pool = None
+        # (filename, block_size): future of a prefetched hash, block_size is 0 for a checksum
+        self.prefetched = {}
+
+    def start_pool(self, workers):
         '''
-        Convert given filename into bytearray
+        Start the worker processes of prefetch_checksum and prefetch_signature, none for 0 workers
         '''
-        bytes_list = []
-        with open(filename, "rb") as f:
-            file_bytes = f.read(self.HASH_BLOCK_SIZE)
-            while file_bytes != b"":
-                bytes_list.append(file_bytes)
-                file_bytes = f.read(self.HASH_BLOCK_SIZE)
-        return bytes_list
+        if workers > 0 and self.pool is None:
+            # forkserver as the hosts run threads, which a forked worker would inherit mid-operation
+            self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"),
+                                            initializer=Hash.watch_host, initargs=(os.getpid(),))
+
+    @staticmethod
+    def watch_host(pid):
+        '''
+        Worker process initializer: the worker exits once the host process is gone, a killed
+        host would leave it waiting for jobs otherwise
+        '''
+        def watch():
+            while True:
+                time.sleep(1)
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    os._exit(0)
+        Thread(target=watch, daemon=True).start()
+
+    def prefetch_checksum(self, filename):
+        '''
+        Start computing the file checksum in a worker, get_file_checksum picks up the result
+        '''
+        self.prefetch(filename, 0)
+
+    def prefetch_signature(self, filename):
+        '''
+        Start computing the file signature in a worker, get_file_signature picks up the result
+        '''
+        try:
+            self.prefetch(filename, self.get_block_size(os.path.getsize(filename)))
+        except OSError:
+            pass
+
+    def prefetch(self, filename, block_size):
+        if self.pool is None or (filename, block_size) in self.prefetched:
+            return
+        try:
+            if os.path.getsize(filename) < self.PREFETCH_MIN_SIZE:
+                return
+        except OSError:
+            return
+        if self.cache is not None:
+            if block_size == 0 and self.cache.get_checksum(filename) is not None:
+                return
+            if block_size and self.cache.get_signature(filename, block_size, self.strong_hash) is not None:
+                return
+        self.prefetched[(filename, block_size)] = self.pool.submit(Hash.hash_file, self.strong_hash,
+                                                                   filename, block_size)
+
+    @staticmethod
+    def hash_file(strong_hash, filename, block_size):
+        '''
+        Worker process job: returns the cache key of the file, as HashCache.get_key, with its
+        checksum or with its signature if a block size is given
+        '''
+        stat = os.stat(filename)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        hash_impl = Hash(0, strong_hash)
+        if block_size:
+            return key, hash_impl.compute_file_signature(filename, block_size)
+        return key, hash_impl.compute_file_checksum(filename)
+
+    def get_prefetched(self, filename, block_size):
+        '''
+        Returns the (key, hash) computed by a worker, None if it was not prefetched or failed
+        '''
+        future = self.prefetched.pop((filename, block_size), None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            # hashed again in place, which reports the error if there is one
+            return None
+
+    def clear_prefetched(self):
+        '''
+        Drop the prefetched hashes that were not used
+        '''
+        for future in self.prefetched.values():
+            future.cancel()
+        self.prefetched = {}
+
+    def set_strong_hash(self, name):
+        '''
+        Select the block hash used by the file signatures, both hosts have to use the same one
+        '''
+        if name not in self.STRONG_HASHES:
+            raise ValueError("Unknown block hash: " + name)
+        self.strong_hash = name
+        self.strong_hash_function = self.STRONG_HASHES[name]
+        self.strong_hash_size = self.strong_hash_function().digest_size
 
     def get_file_checksum(self, filename):
         '''
-        Calculate file checksum
+        Calculate file checksum, always SHA1 whatever the block hash is since it is the final
+        check of every reconstructed file
         '''
+        prefetched = self.get_prefetched(filename, 0)
+        if prefetched is not None:
+            key, checksum = prefetched
+            if self.cache is not None:
+                self.cache.store(filename, key, checksum)
+            return checksum
+        if self.cache is not None:
+            checksum = self.cache.get_checksum(filename)
+            if checksum is not None:
+                return checksum
+            key = self.cache.get_key(filename)
+        checksum = self.compute_file_checksum(filename)
+        if self.cache is not None:
+            self.cache.store(filename, key, checksum)
+        return checksum
+
+    def compute_file_checksum(self, filename):
         with open(filename, "rb") as f:
-            file_hash = hashlib.sha1()
+            file_hash = self.new_file_checksum()
             chunk = f.read(8192)
             while chunk:
                 file_hash.update(chunk)
                 chunk = f.read(8192)
         return file_hash.hexdigest()
 
-    def get_file_hashes(self, filename):
+    def new_file_checksum(self):
+        '''
+        Returns a hash object for the whole file checksum
+        '''
+        return hashlib.sha1()
 
-        weak_list = array("I")
-        strong_list = []
+    def get_block_size(self, file_size):
+        '''
+        Block size used for the file signature, rsync's heuristic: the square root of the
+        file size rounded down to a multiple of 8, between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE
+        '''
+        if self.block_size:
+            return self.block_size
+        if file_size <= self.MIN_BLOCK_SIZE * self.MIN_BLOCK_SIZE:
+            return self.MIN_BLOCK_SIZE
+        return min(math.isqrt(file_size) & ~7, self.MAX_BLOCK_SIZE)
+
+    def get_strong_hash_size(self, file_size, block_size):
+        '''
+        Number of strong digest bytes sent per block, rsync's heuristic: enough bits for the
+        number of blocks squared times the number of window offsets, minus the weak hash bits
+        '''
+        bits = self.STRONG_HASH_BIAS + 2 * max(file_size.bit_length() - 1, 0)
+        bits = max(bits - (block_size.bit_length() - 1), 0)
+        size = (bits + 1 - 32 + 7) // 8
+        return min(max(size, self.MIN_STRONG_HASH_SIZE), self.strong_hash_size)
+
+    def get_file_hashes(self, filename, block_size):
+        '''
+        Calculate the weak and strong hash of every block of the file
+        '''
+        file_checksum, weak, strong = self.get_file_signature(filename, block_size)
+        return weak, strong
+
+    def get_file_signature(self, filename, block_size):
+        '''
+        Returns the file checksum together with the weak and strong hash of every block,
+        from the cache when the file did not change since it was last hashed
+        '''
+        prefetched = self.get_prefetched(filename, block_size)
+        if prefetched is not None:
+            key, (checksum, weak, strong) = prefetched
+            if self.cache is not None:
+                self.cache.store(filename, key, checksum, block_size, self.strong_hash, weak, strong)
+            return checksum, weak, strong
+        if self.cache is None:
+            return self.compute_file_signature(filename, block_size)
+        signature = self.cache.get_signature(filename, block_size, self.strong_hash)
+        if signature is not None:
+            return signature
+        key = self.cache.get_key(filename)
+        checksum, weak, strong = self.compute_file_signature(filename, block_size)
+        self.cache.store(filename, key, checksum, block_size, self.strong_hash, weak, strong)
+        return checksum, weak, strong
 
+    def compute_file_signature(self, filename, block_size):
+        '''
+        Calculate the file checksum together with the weak and strong hash of every block,
+        reading the file only once. Weak hashes are returned as an uint32 array and the
+        strong_hash_size strong digests concatenated in block order
+        '''
+        file_hash = self.new_file_checksum()
+        weak_parts = []
+        strong_digests = bytearray()
+        segment_size = max(self.SEGMENT_SIZE - self.SEGMENT_SIZE % block_size, block_size)
+        with self.map_file(filename) as data:
+            for start in range(0, len(data), segment_size):
+                segment = data[start:start + segment_size]
+                file_hash.update(segment)
+                weak_parts.append(self.get_block_weak_hashes(segment, block_size))
+                view = memoryview(segment)
+                for offset in range(0, len(segment), block_size):
+                    strong_digests += self.get_byte_strong_hash(view[offset:offset + block_size])
+        weak = np.concatenate(weak_parts) if weak_parts else np.empty(0, dtype=np.uint32)
+        return file_hash.hexdigest(), weak, bytes(strong_digests)
+
+    @contextmanager
+    def map_file(self, filename):
+        '''
+        Memory map the file for reading, empty files map to empty bytes
+        '''
         with open(filename, "rb") as f:
-            file_bytes = f.read(self.HASH_BLOCK_SIZE)
-            while file_bytes != b"":
-                weak_list.append(self.get_byte_weak_hash(file_bytes))
-                strong_list.append(self.get_byte_strong_hash(file_bytes))
-                file_bytes = f.read(self.HASH_BLOCK_SIZE)
-        return weak_list, strong_list
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    yield data
 
     def get_byte_strong_hash(self, file_bytes):
         '''
-        Calculate strong hash for given bytes
+        Calculate the binary block hash for given bytes
         '''
-        return hashlib.sha1(file_bytes).hexdigest()
+        return self.strong_hash_function(file_bytes).digest()
 
     def get_byte_weak_hash(self, file_bytes):
         '''
-        Calculate weak hash for given bytes
+        Calculate the rsync weak hash for given bytes: a is the sum of the bytes, b the sum of the
+        bytes weighted by their distance to the end of the block, both modulo 2^16
+        '''
+        data = np.frombuffer(bytes(file_bytes), dtype=np.uint8).astype(np.uint32)
+        a = int(data.sum(dtype=np.uint32))
+        b = int(np.dot(np.arange(len(data), 0, -1, dtype=np.uint32), data))
+        return (a & 0xffff) | ((b & 0xffff) << 16)
+
+    def get_block_weak_hashes(self, data, block_size):
+        '''
+        Calculate the weak hash of every consecutive block_size block of data, the last one can be shorter
+        '''
+        full_blocks = len(data) // block_size
+        blocks = np.frombuffer(data, dtype=np.uint8, count=full_blocks * block_size)
+        blocks = blocks.reshape(full_blocks, block_size).astype(np.uint32)
+        a = blocks.sum(axis=1, dtype=np.uint32)
+        b = blocks @ np.arange(block_size, 0, -1, dtype=np.uint32)
+        weak = (a & 0xffff) | ((b & 0xffff) << 16)
+        if len(data) % block_size:
+            weak = np.append(weak, np.uint32(self.get_byte_weak_hash(data[full_blocks * block_size:])))
+        return weak
+
+    def get_rolling_weak_hashes(self, data, block_size):
+        '''
+        Calculate the weak hash of every block_size window of the given uint8 array.
+        Element i of the result is the weak hash of data[i:i + block_size], the windows are rolled
+        all at once from prefix sums instead of one byte at a time
         '''
-        return np.sum(np.multiply(5, list(bytes(file_bytes))))
\ No newline at end of file
+        if len(data) < block_size:
+            return np.empty(0, dtype=np.uint32)
+        # prefix sums of x[j] and j * x[j], only the low 16 bits are needed so uint32 overflow is harmless
+        values = data.astype(np.uint32)
+        a_sums = np.zeros(len(data) + 1, dtype=np.uint32)
+        np.cumsum(values, dtype=np.uint32, out=a_sums[1:])
+        b_sums = np.zeros(len(data) + 1, dtype=np.uint32)
+        np.cumsum(values * np.arange(len(data), dtype=np.uint32), dtype=np.uint32, out=b_sums[1:])
+
+        a = a_sums[block_size:] - a_sums[:-block_size]
+        ends = np.arange(block_size, len(data) + 1, dtype=np.uint32)
+        b = ends * a - (b_sums[block_size:] - b_sums[:-block_size])
+        return (a & 0xffff) | ((b & 0xffff) << 16)
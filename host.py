@@ -1,17 +1,74 @@
 import os
-import pickle
 import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+from queue import Queue
+from threading import Thread
+from collections import deque
 from pathlib import Path
 
+import numpy as np
+
 from watchdog import events
 from hash import Hash
+from cache import HashCache
+from file_manager import FileManager
+from signature import SignatureIndex
+from batch import Scheduler
+from codec import Codec
+from compression import Compression
+from chunk_store import ChunkStore
+from merkle import MerkleTree
+
+# mkstemp creates private files, rebuilt files get the mode open would give a new file
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 class Host:
     '''
     Base class for client and server
     '''
-    MSG_LEN = 256
+    PROTOCOL_VERSION = 14
+    MIN_PROTOCOL_VERSION = 14
+    FILE_CHUNK_SIZE = 1024 * 1024
+    # transaction id, request type, path length
+    REQUEST_HEADER = struct.Struct("!IBH")
+    # transaction id, result type
+    RESPONSE_HEADER = struct.Struct("!IB")
+    # file size, file mtime_ns
+    FILE_HEADER = struct.Struct("!Qq")
+    MTIME = struct.Struct("!q")
+    # entry count of a pack and whether its data is compressed, then transaction id, result type,
+    # file size and file mtime_ns of every entry
+    PACK_HEADER = struct.Struct("!IB")
+    PACK_ENTRY = struct.Struct("!IBQq")
+    # length of a chunk of a compressed file, an empty chunk ends the file
+    CHUNK_HEADER = struct.Struct("!I")
+    # content defined chunks of a chunked file: digest and length of every chunk after their count.
+    # Missing chunks are requested as (offset, length) ranges of the file
+    CHUNK_COUNT = struct.Struct("!I")
+    CHUNK_REF = struct.Struct("!%dsI" % ChunkStore.DIGEST_SIZE)
+    CHUNK_RANGE = struct.Struct("!QQ")
+    # requested files up to this size are sent together in packs of up to PACK_SIZE bytes
+    PACK_FILE_SIZE = 64 * 1024
+    PACK_SIZE = 1024 * 1024
+    SCAN_BUFFER_SIZE = 8 * 1024 * 1024
+    DELTA_OP_HEADER = struct.Struct("!BQQ")
+    # largest payload a frame, a delta literal, a compressed chunk or a pack may announce, a bigger
+    # one is taken for a corrupt or hostile stream
+    MAX_FRAME_SIZE = 1024 * 1024 * 1024
+    # processes computing checksums, signatures and deltas ahead of the transfers
+    WORKERS = os.cpu_count() or 1
+    # deltas are kept in memory until sent, larger files are diffed in place
+    PREPARE_DELTA_MAX_SIZE = 64 * 1024 * 1024
+    # requests prepared ahead of their turn per worker, the deltas they hold in memory stay bounded
+    PREPARE_AHEAD = 2
+    # connections carrying the file transfers of a session, the first one also carries the control messages.
+    # More help when a single connection can not fill the link, over a long distance link for instance
+    CHANNELS = 1
 
     class SyncMode:
         CLIENT_PRIORITY = 0
@@ -23,6 +80,38 @@ class Host:
         SUCCESS = "-1"
         FAILURE = "-2"
 
+    class DeltaOp:
+        END = 0
+        LITERAL = 1
+        BLOCKS = 2
+        ABORT = 3
+        COMPRESSED = 4  # literal of count bytes compressed to value bytes
+
+    class Op:
+        HELLO = 0
+        MESSAGE = 1
+        REQUEST = 2
+        RESPONSE = 3
+        END = 4
+        LISTING = 5
+        EVENTS = 6
+        CHECKSUMS = 7
+        PACK = 8
+
+    class Request:
+        FILE = 0
+        DELTA = 1
+        CHUNKS = 2  # ranges of a chunked file, answered as a file of their data
+        WHOLE_FILE = 3  # a file request never answered with chunks
+
+    class Result:
+        FAILURE = 0
+        FILE = 1  # followed by the file size and mtime, the file data and a status byte
+        DELTA = 2  # followed by the file checksum and mtime, then the delta_2 ops
+        SAME = 3  # followed by the file mtime
+        COMPRESSED_FILE = 4  # followed by the file size and mtime, the compressed chunks and a status byte
+        CHUNKED = 5  # followed by the file size, mtime and checksum, then its chunk list
+
     class Msg:
         x = 'x'  # exit
         e = 'e'  # empty
@@ -31,359 +120,1156 @@ class Host:
         sc = 'sc'  # server first, then client
         cs = 'cs'  # client first, then server
 
-    def __init__(self):
+    def __init__(self, block_size=0, strong_hash=Hash.DEFAULT_STRONG_HASH, use_cache=True,
+                 chunk_size=FILE_CHUNK_SIZE, workers=WORKERS, channel_count=CHANNELS,
+                 compression=Compression.DEFAULT_METHOD, compression_level=Compression.DEFAULT_LEVEL, dedup=False):
         self.socket = None
-        self.hash = Hash()
+        self.protocol_version = None
+        self.hash = Hash(block_size, strong_hash)
+        self.codec = Codec()
+        # compression of the file data, the one picked by the server is used by both hosts
+        self.compression = Compression(compression, compression_level)
+        self.use_cache = use_cache
+        # file data is received into one buffer reused for every file
+        self.chunk_size = chunk_size
+        self.receive_buffer = None
+        self.workers = workers
+        # transaction: future of a delta prepared by a worker, see prepare_delta
+        self.prepared_deltas = {}
+        # files are sent as lists of content defined chunks, the ones found in the local files are not sent
+        self.dedup = dedup
+        self.chunk_store = None
+        # transaction: future of the chunks of a file, see ChunkStore.chunk_file
+        self.prepared_chunks = {}
+        self.channel_count = channel_count
+        # hosts of the data channels of the session, this one first
+        self.channels = [self]
 
-    def send_fixed_string_size(self, string=""):
+    def new_channel(self, channel_socket):
         """
-        Sends the bytearray of size MSG_LEN containing the string
+        Returns a host for an extra data channel of the session, it shares the worker pool of this one
         """
-        if len(string) > self.MSG_LEN:
-            raise RuntimeError("Input string size is bigger than the MSG_LEN")
-        send_msg = bytes(string, encoding='utf-8') + b' ' * (self.MSG_LEN - len(string))
-        self.socket.sendall(send_msg)
+        channel = Host(self.hash.block_size, self.hash.strong_hash, self.use_cache, self.chunk_size, 0, 1,
+                       self.compression.method, self.compression.level)
+        channel.socket = channel_socket
+        channel.shared_folder = self.shared_folder
+        channel.protocol_version = self.protocol_version
+        channel.hash.pool = self.hash.pool
+        # sizes the prepared requests window, the pool is the one of this host
+        channel.workers = self.workers
+        channel.dedup = self.dedup
+        channel.open_cache()
+        if channel.dedup:
+            # its own index connection, the responses of the channels are received in turns
+            channel.open_chunk_store()
+        return channel
 
-    def receive_fixed_string_size(self):
+    def close_channels(self):
+        for channel in self.channels:
+            channel.socket.close()
+
+    def start_workers(self):
         """
-        Reads bytes of size MSG_LEN and returns a string
+        Starts the worker processes, syncing works without them
         """
-        total_bytes_rcv = 0
-        string = b""
-        while total_bytes_rcv < self.MSG_LEN:
-            bytes_rcv = self.socket.recv(self.MSG_LEN)
-            if bytes_rcv == b"":
-                return ''
-            if string == b"":
-                string = bytes_rcv
-            else:
-                string = bytes_rcv + bytes(string, encoding='utf-8')
-            total_bytes_rcv = total_bytes_rcv + len(bytes_rcv)
+        try:
+            self.hash.start_pool(self.workers)
+        except (OSError, ValueError) as e:
+            print("Could not start workers", e)
+
+    def open_cache(self):
+        """
+        Opens the checksum and signature cache of the shared folder, syncing works without it
+        """
+        if not self.use_cache:
+            return
+        try:
+            self.hash.cache = HashCache(self.shared_folder)
+        except (OSError, sqlite3.Error) as e:
+            print("Could not open hash cache", e)
+
+    def open_chunk_store(self):
+        """
+        Opens the chunk index of the shared folder, files are sent whole without it
+        """
+        try:
+            self.chunk_store = ChunkStore(self.shared_folder)
+        except (OSError, sqlite3.Error) as e:
+            print("Could not open chunk index", e)
+            self.dedup = False
+
+    def index_chunks(self, fm):
+        """
+        Adds the files changed since the last run to the chunk index, chunked by the workers
+        """
+        self.chunk_store.prune(fm.local_manifest)
+        rel_paths = [x for x, (size, mtime) in fm.local_manifest.items()
+                     if size >= ChunkStore.MIN_FILE_SIZE
+                     and not self.chunk_store.is_indexed(x, (fm.local_inodes[x], size, mtime))]
+        if self.hash.pool is not None:
+            results = [self.hash.pool.submit(ChunkStore.chunk_file, os.path.join(self.shared_folder, x))
+                       for x in rel_paths]
+        else:
+            results = [os.path.join(self.shared_folder, x) for x in rel_paths]
+        for rel_path, result in zip(rel_paths, results):
             try:
-                string = string.decode("utf-8")
-            except UnicodeDecodeError:
-                raise OSError
-        if string == b"":
+                if self.hash.pool is not None:
+                    key, checksum, chunks = result.result()
+                else:
+                    key, checksum, chunks = ChunkStore.chunk_file(result)
+            except Exception:
+                # not indexed, it is chunked again next time
+                continue
+            self.chunk_store.add_file(rel_path, key, chunks)
+        print("Chunk index:", len(rel_paths), "files chunked")
+
+    def offer_strong_hash(self):
+        """
+        Sends the block hashes this host knows, the selected one first, and switches to the one picked by the peer
+        """
+        names = [self.hash.strong_hash] + [x for x in sorted(Hash.STRONG_HASHES) if x != self.hash.strong_hash]
+        self.send_message(",".join(names))
+        self.hash.set_strong_hash(self.receive_message())
+
+    def accept_strong_hash(self):
+        """
+        Picks the first offered block hash this host knows, sha1 is known by every version
+        """
+        names = self.receive_message().split(",")
+        name = next((x for x in names if x in Hash.STRONG_HASHES), "sha1")
+        self.hash.set_strong_hash(name)
+        self.send_message(name)
+
+    def offer_compression(self):
+        """
+        Sends the compression methods this host knows, the selected one first, and its level.
+        Switches to the method picked by the peer
+        """
+        names = [self.compression.method] + [x for x in Compression.get_methods() if x != self.compression.method]
+        self.send_message(",".join(names))
+        self.send_message(str(self.compression.level))
+        self.compression.method = self.receive_message()
+
+    def accept_compression(self):
+        """
+        Picks the first offered compression method this host knows, none if there is no such method
+        """
+        names = self.receive_message().split(",")
+        self.compression.level = int(self.receive_message())
+        self.compression.method = next((x for x in names if x in Compression.get_methods()), Compression.NONE)
+        self.send_message(self.compression.method)
+
+    def offer_dedup(self):
+        """
+        Tells the peer whether files are sent as chunk lists, the server decides for both hosts
+        """
+        self.send_message("1" if self.dedup else "0")
+
+    def accept_dedup(self):
+        self.dedup = self.receive_message() == "1"
+
+    def print_compression(self):
+        stats = self.compression.take_stats()
+        if stats is not None:
+            print("Compressed :", stats)
+
+    def offer_protocol(self):
+        """
+        Sends the protocol version of this host, the peer answers with the version both speak
+        """
+        self.send_frame(self.Op.HELLO, str(self.PROTOCOL_VERSION).encode())
+        version = int(self.receive_frame(self.Op.HELLO))
+        if version < self.MIN_PROTOCOL_VERSION or version > self.PROTOCOL_VERSION:
+            raise IOError("Unsupported protocol version " + str(version))
+        self.protocol_version = version
+
+    def accept_protocol(self):
+        """
+        Answers the protocol version offered by the peer with the highest version both speak
+        """
+        version = min(int(self.receive_frame(self.Op.HELLO)), self.PROTOCOL_VERSION)
+        self.send_frame(self.Op.HELLO, str(version).encode())
+        if version < self.MIN_PROTOCOL_VERSION:
+            raise IOError("Unsupported protocol version " + str(version))
+        self.protocol_version = version
+
+    def send_frame(self, op, payload=b""):
+        """
+        Sends a frame: varint payload length, opcode byte and payload
+        """
+        length = len(payload)
+        header = bytearray()
+        while length >= 0x80:
+            header.append(length & 0x7f | 0x80)
+            length = length >> 7
+        header.append(length)
+        header.append(op)
+        self.socket.sendall(bytes(header) + payload)
+
+    def receive_any_frame(self):
+        """
+        Receives a frame and returns its opcode and payload
+        """
+        # the varint is usually a single byte, read it together with the opcode
+        header = self.receive_bytes(2)
+        while header[-2] & 0x80:
+            header = header + self.receive_bytes(1)
+        length = 0
+        for shift, byte in enumerate(header[:-1]):
+            length = length | (byte & 0x7f) << (7 * shift)
+        return header[-1], self.receive_bytes(self.check_length(length, "Frame"))
+
+    def check_length(self, length, name):
+        """
+        Returns a length read from the wire, raises IOError if it is larger than any the remote host
+        sends as it would be allocated. The stream can not be read further
+        """
+        if length > self.MAX_FRAME_SIZE:
+            raise IOError(name + " of " + str(length) + " bytes is too large")
+        return length
+
+    def receive_frame(self, op):
+        """
+        Receives a frame and returns its payload, the frame has to be of the given opcode
+        """
+        frame_op, payload = self.receive_any_frame()
+        if frame_op != op:
+            raise IOError("Unexpected frame " + str(frame_op) + ", expected " + str(op))
+        return payload
+
+    def send_message(self, string=""):
+        """
+        Sends a control message string
+        """
+        self.send_frame(self.Op.MESSAGE, string.encode("utf-8"))
+
+    def receive_message(self):
+        """
+        Receives a control message string, empty if the connection was closed
+        """
+        try:
+            return self.receive_frame(self.Op.MESSAGE).decode("utf-8")
+        except UnicodeDecodeError:
+            raise OSError("Control message is not utf-8")
+        except ConnectionError:
             return ''
-        else:
-            return string.rstrip()
 
-    def send_object(self, obj):
+    def send_listing(self, manifest, folders):
+        self.send_frame(self.Op.LISTING, self.codec.encode_listing(manifest, folders))
+
+    def receive_listing(self):
+        return self.codec.decode_listing(self.receive_frame(self.Op.LISTING))
+
+    def exchange_listing(self, manifest, folders, send_first):
+        """
+        Sends the local listing and returns the remote one, one host sends first and the other receives first
+        """
+        if send_first:
+            self.send_listing(manifest, folders)
+            return self.receive_listing()
+        remote_listing = self.receive_listing()
+        self.send_listing(manifest, folders)
+        return remote_listing
+
+    def diff_trees(self, fm, send_first):
+        """
+        Finds the files to compare with the remote host from the hash trees of both shared folders.
+        Starting from the root, every round exchanges the files and sub folder hashes of the folders
+        whose hashes differ, and everything below the folders only one host has
+        """
+        tree = MerkleTree(fm.local_manifest, fm.local_empty_folder)
+        remote_manifest = {}
+        remote_empty_folders = []
+        compared_rel_paths = []
+        # the first round only compares the roots
+        expanded = None
+        whole = []
+        while True:
+            if expanded is None:
+                files, local_children = {}, {"": tree.get_hash("")}
+            else:
+                files, local_children = {}, {}
+                for folder in expanded:
+                    files.update(tree.get_files(folder))
+                    local_children.update(tree.get_folders(folder))
+            folders = dict(local_children)
+            for folder in whole:
+                subtree_files, subtree_folders = tree.get_subtree(folder)
+                files.update(subtree_files)
+                folders.update(subtree_folders)
+            compared_rel_paths.extend(files)
+
+            (paths, sizes, mtimes), remote_folders = self.exchange_listing(files, folders, send_first)
+            remote_manifest.update(zip(paths, zip(sizes, mtimes)))
+            remote_empty_folders.extend(x for x, folder_hash in remote_folders.items()
+                                        if x != "" and folder_hash == MerkleTree.EMPTY_HASH)
+            if expanded is None:
+                remote_children = {x: remote_folders[x] for x in remote_folders if x == ""}
+            else:
+                remote_children = {x: remote_folders[x] for x in remote_folders
+                                   if x != "" and os.path.dirname(x) in expanded}
+
+            expanded = set(x for x in local_children
+                           if x in remote_children and local_children[x] != remote_children[x])
+            whole = [x for x in local_children if x not in remote_children]
+            # the remote host sends the folders only it has in the next round
+            if not expanded and not whole and all(x in local_children for x in remote_children):
+                break
+
+        fm.compared_rel_paths = compared_rel_paths
+        fm.set_remote_manifest(list(remote_manifest), [x[0] for x in remote_manifest.values()],
+                               [x[1] for x in remote_manifest.values()])
+        fm.remote_empty_folders = remote_empty_folders
+
+    def send_events(self, event_list):
+        self.send_frame(self.Op.EVENTS, self.codec.encode_events(event_list))
+
+    def receive_events(self):
+        return self.codec.decode_events(self.receive_frame(self.Op.EVENTS))
+
+    def send_checksums(self, checksums):
+        self.send_frame(self.Op.CHECKSUMS, self.codec.encode_checksums(checksums))
+
+    def receive_checksums(self):
+        return self.codec.decode_checksums(self.receive_frame(self.Op.CHECKSUMS))
+
+    def get_local_checksums(self, files):
         """
-        Send serialised object
+        Checksums of the given shared files, None for the ones that can not be read
         """
-        serialized = pickle.dumps(obj)
-        self.send_fixed_string_size(str(len(serialized)))
-        self.receive_fixed_string_size()
-        self.socket.sendall(serialized)
-        self.receive_fixed_string_size()
+        checksums = []
+        for x in files:
+            self.hash.prefetch_checksum(os.path.join(self.shared_folder, x))
+        for x in files:
+            try:
+                checksums.append(self.hash.get_file_checksum(os.path.join(self.shared_folder, x)))
+            except IOError:
+                checksums.append(None)
+        return checksums
 
-    def receive_object(self):
+    def receive_bytes(self, length):
         """
-        Receive serialised object
+        Receive exactly length bytes, read straight into a preallocated buffer
         """
-        files_len = self.receive_fixed_string_size()
-        self.send_fixed_string_size("")
-        data_rcv = b""
-        while len(data_rcv) < int(files_len):
-            data = self.socket.recv(8192)
-            data_rcv = data_rcv + data
-        self.send_fixed_string_size("")
-        obj = pickle.loads(data_rcv)
-        return obj
+        data = bytearray(length)
+        self.receive_into(memoryview(data))
+        return data
 
-    def send_file(self, file_path):
+    def receive_into(self, view):
+        """
+        Fill the writable memoryview with bytes from the socket
         """
-        Send file through socket.
+        received = 0
+        while received < len(view):
+            count = self.socket.recv_into(view[received:])
+            if count == 0:
+                raise ConnectionError("Connection closed")
+            received = received + count
+
+    def serve_channels(self):
         """
-        size = 0
+        Answers the batch of the remote host on every data channel, the extra ones from their own threads
+        """
+        threads = [Thread(target=x.serve_batch) for x in self.channels[1:]]
+        for thread in threads:
+            thread.start()
+        self.serve_batch()
+        for thread in threads:
+            thread.join()
+
+    def serve_batch(self):
+        """
+        Answers the requests of the remote host in order until it ends the batch. The requests are
+        read by another thread, the deltas of the next ones waiting for their turn are prepared by the workers
+        """
+        requests = Queue()
+        Thread(target=self.read_requests, args=(requests,), daemon=True).start()
+        pending = deque()
+        # requests at the front of pending already looked at by prepare_request
+        examined = 0
         try:
-            size = str(os.path.getsize(file_path))
-            self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-        except IOError:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
+            while True:
+                if not pending:
+                    pending.append(self.get_request(requests))
+                while not requests.empty():
+                    pending.append(self.get_request(requests))
+                while examined < min(len(pending), self.workers * self.PREPARE_AHEAD):
+                    self.prepare_request(pending[examined])
+                    examined = examined + 1
+                request = pending.popleft()
+                if request is None:
+                    break
+                pack = self.take_pack(request, pending)
+                examined = max(examined - len(pack), 0)
+                if len(pack) > 1:
+                    self.send_pack(pack)
+                else:
+                    self.serve_request(*request)
+        finally:
+            self.clear_prepared()
+        self.send_frame(self.Op.END)
+
+    def read_requests(self, requests):
+        """
+        Puts the parsed requests of a batch in the queue, then None for its end or the error that stopped it
+        """
+        try:
+            op, payload = self.receive_any_frame()
+            while op == self.Op.REQUEST:
+                transaction, request, path_length = self.REQUEST_HEADER.unpack_from(payload)
+                offset = self.REQUEST_HEADER.size
+                rel_path = bytes(payload[offset:offset + path_length]).decode("utf-8")
+                requests.put((transaction, request, rel_path, payload[offset + path_length:]))
+                op, payload = self.receive_any_frame()
+            if op != self.Op.END:
+                raise IOError("Unexpected frame " + str(op) + " in batch")
+            requests.put(None)
+        except Exception as e:
+            # raised again by the serving thread
+            requests.put(e)
+
+    def get_request(self, requests):
+        """
+        Returns the next request read, raises the error that stopped the reading
+        """
+        request = requests.get()
+        if isinstance(request, Exception):
+            raise request
+        return request
+
+    def prepare_request(self, request):
+        """
+        Hands the delta or the chunking of a request to a worker, the request is answered later by serve_request
+        """
+        if request is None or self.hash.pool is None:
+            return
+        transaction, request_type, rel_path, payload = request
+        if request_type != self.Request.DELTA and (request_type != self.Request.FILE or not self.dedup):
             return
-        self.send_fixed_string_size(str(size))
-        if int(size) == 0:
+        path = os.path.join(self.shared_folder, rel_path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
             return
+        if request_type == self.Request.FILE:
+            if size >= ChunkStore.MIN_FILE_SIZE:
+                self.prepared_chunks[transaction] = self.hash.pool.submit(ChunkStore.chunk_file, path)
+        elif Hash.PREFETCH_MIN_SIZE <= size <= self.PREPARE_DELTA_MAX_SIZE:
+            self.prepared_deltas[transaction] = self.hash.pool.submit(
+                Host.prepare_delta, self.hash.strong_hash, path, bytes(payload))
+
+    def take_pack(self, request, pending):
+        """
+        Returns the request with the file requests of small files following it in the queue,
+        as many as fit in a pack
+        """
+        pack = [request]
+        pack_size = self.get_pack_size(request)
+        if pack_size is None:
+            return pack
+        while pending:
+            size = self.get_pack_size(pending[0])
+            if size is None or pack_size + size > self.PACK_SIZE:
+                break
+            pack.append(pending.popleft())
+            pack_size = pack_size + size
+        return pack
+
+    def get_pack_size(self, request):
+        """
+        Size of the file of a file request small enough to be packed, None for the other requests
+        """
+        if request is None or request[1] != self.Request.FILE:
+            return None
+        try:
+            size = os.path.getsize(os.path.join(self.shared_folder, request[2]))
+        except OSError:
+            # answered as a failure entry of the pack
+            return 0
+        return size if size <= self.PACK_FILE_SIZE else None
+
+    def send_pack(self, requests):
+        """
+        Answers file requests of small files with a single frame: the entries of the files
+        followed by their data
+        """
+        entries = []
+        contents = []
+        for transaction, request, rel_path, payload in requests:
+            path = os.path.join(self.shared_folder, rel_path)
+            print("Send file :", path)
+            try:
+                with open(path, "rb") as f:
+                    mtime = os.fstat(f.fileno()).st_mtime_ns
+                    data = f.read()
+            except IOError:
+                entries.append(self.PACK_ENTRY.pack(transaction, self.Result.FAILURE, 0, 0))
+                continue
+            entries.append(self.PACK_ENTRY.pack(transaction, self.Result.FILE, len(data), mtime))
+            contents.append(data)
+        contents = b"".join(contents)
+        compressed = self.compression.compress(contents)
+        self.print_compression()
+        if compressed is None:
+            header = self.PACK_HEADER.pack(len(entries), False)
+        else:
+            header = self.PACK_HEADER.pack(len(entries), True)
+            contents = compressed
+        self.send_frame(self.Op.PACK, header + b"".join(entries) + contents)
+
+    def serve_request(self, transaction, request, rel_path, payload):
+        if request == self.Request.FILE:
+            self.send_file(transaction, rel_path, self.dedup)
+        elif request == self.Request.WHOLE_FILE:
+            self.send_file(transaction, rel_path)
+        elif request == self.Request.CHUNKS:
+            self.send_chunks(transaction, rel_path, payload)
+        elif request == self.Request.DELTA:
+            checksum_size = self.hash.new_file_checksum().digest_size
+            remote_file_checksum = bytes(payload[:checksum_size]).hex()
+            delta_1_signature = SignatureIndex.from_bytes(payload[checksum_size:])
+            self.send_delta2_file(transaction, rel_path, remote_file_checksum, delta_1_signature)
+        else:
+            self.send_response(transaction, self.Result.FAILURE)
+
+    @staticmethod
+    def prepare_delta(strong_hash, path, payload):
+        """
+        Worker process job: returns the cache key, checksum and mtime of the file with its delta_2
+        ops for the delta request payload, no ops if the remote file is the same
+        """
+        host = Host(strong_hash=strong_hash)
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        checksum = host.hash.compute_file_checksum(path)
+        checksum_size = host.hash.new_file_checksum().digest_size
+        if checksum == bytes(payload[:checksum_size]).hex():
+            return key, checksum, None
+        return key, checksum, list(host.get_delta_ops(path, SignatureIndex.from_bytes(payload[checksum_size:])))
+
+    def get_prepared(self, prepared, transaction):
+        """
+        Returns the result of the job prepared by a worker for the transaction, None if there is none or it failed
+        """
+        future = prepared.pop(transaction, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            # diffed again in place, which reports the error if there is one
+            return None
 
+    def clear_prepared(self):
+        for future in list(self.prepared_deltas.values()) + list(self.prepared_chunks.values()):
+            future.cancel()
+        self.prepared_deltas = {}
+        self.prepared_chunks = {}
+
+    def send_response(self, transaction, result, payload=b""):
+        self.send_frame(self.Op.RESPONSE, self.RESPONSE_HEADER.pack(transaction, result) + payload)
+
+    def send_file(self, transaction, rel_path, chunked=False):
+        """
+        Answers a file request: file size, file data and a status byte telling if all of it could be read.
+        The data goes from the file to the socket with sendfile, without being copied through python,
+        unless it is sent compressed. Large files are answered with their chunk list if chunked
+        """
+        path = os.path.join(self.shared_folder, rel_path)
+        print("Send file :", path)
+        if chunked and self.send_chunk_list(transaction, path) == self.ReturnCode.SUCCESS:
+            return
         try:
-            with open(os.path.join(file_path), 'rb') as file:
-                self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-                if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
-                    data = file.read(8192)
-                    while data:
-                        self.socket.send(data)
-                        data = file.read(8192)
-            self.receive_fixed_string_size()
+            file = open(path, 'rb')
         except IOError:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
-            self.receive_fixed_string_size()
+            self.send_response(transaction, self.Result.FAILURE)
+            return
+        with file:
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
+            if size >= self.compression.MIN_SIZE and self.compression.is_compressible(path):
+                try:
+                    compress = self.compression.trial(file.read(self.compression.TRIAL_SIZE))
+                    file.seek(0)
+                except IOError:
+                    compress = False
+                if compress:
+                    self.send_compressed_file(transaction, file, size, stat.st_mtime_ns)
+                    self.print_compression()
+                    return
+            self.send_response(transaction, self.Result.FILE, self.FILE_HEADER.pack(size, stat.st_mtime_ns))
+            complete = self.send_file_data(file, 0, size)
+        self.socket.sendall(bytes([self.Result.FILE if complete else self.Result.FAILURE]))
 
-    def receive_file(self, path):
+    def send_file_data(self, file, offset, size):
         """
-        Send file through socket
+        Sends size bytes of the file from offset, False if they could not all be read
         """
-        if self.receive_fixed_string_size() == self.ReturnCode.FAILURE:
-            return self.ReturnCode.FAILURE
-        length = int(self.receive_fixed_string_size())
-        if length != 0:
-            length = int(length)
-            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        sent = 0
+        if size:
             try:
-                with open(path, 'wb+') as file:
-                    if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
-                        self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-                        file.seek(0)
-                        while length > 0:
-                            data = self.socket.recv(8192)
-                            if data == b"":
-                                break
-                            length = length - len(data)
-                            file.write(bytearray(data))
-                        self.send_fixed_string_size("")
-                    else:
-                        self.send_fixed_string_size(self.ReturnCode.FAILURE)
-                        return self.ReturnCode.FAILURE
+                file.seek(offset)
+                sent = self.socket.sendfile(file, offset, size)
+            except IOError:
+                # the file position tells how much was sent
+                sent = max(file.tell() - offset, 0)
+        if sent < size:
+            # the size was promised, pad it and mark the file as incomplete
+            padding = bytes(min(self.chunk_size, size - sent))
+            while sent < size:
+                self.socket.sendall(padding[:size - sent])
+                sent = sent + min(len(padding), size - sent)
+            return False
+        return True
 
+    def send_chunk_list(self, transaction, path):
+        """
+        Answers a file request with the chunk list of the file, prepared by a worker or chunked in place.
+        Nothing is sent if the file is too small to be chunked or can not be read
+        """
+        prepared = self.get_prepared(self.prepared_chunks, transaction)
+        if prepared is None:
+            try:
+                if os.path.getsize(path) < ChunkStore.MIN_FILE_SIZE:
+                    return self.ReturnCode.FAILURE
+                prepared = ChunkStore.chunk_file(path)
             except IOError:
-                self.receive_fixed_string_size()
-                self.send_fixed_string_size(self.ReturnCode.FAILURE)
                 return self.ReturnCode.FAILURE
-
-        # empty file
-        else:
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
-            with open(path, 'wb+') as file:
-                file.write(b"")
+        key, checksum, chunks = prepared
+        payload = [self.FILE_HEADER.pack(key[1], key[2]), bytes.fromhex(checksum), self.CHUNK_COUNT.pack(len(chunks))]
+        payload.extend(self.CHUNK_REF.pack(digest, length) for digest, offset, length in chunks)
+        self.send_response(transaction, self.Result.CHUNKED, b"".join(payload))
         return self.ReturnCode.SUCCESS
 
-    # ____________
+    def send_chunks(self, transaction, rel_path, payload):
+        """
+        Answers a chunks request with the data of the requested ranges of a chunked file, like a file
+        """
+        path = os.path.join(self.shared_folder, rel_path)
+        print("Send chunks :", path)
+        count = self.CHUNK_COUNT.unpack_from(payload)[0]
+        ranges = [self.CHUNK_RANGE.unpack_from(payload, self.CHUNK_COUNT.size + x * self.CHUNK_RANGE.size)
+                  for x in range(count)]
+        try:
+            file = open(path, 'rb')
+        except IOError:
+            self.send_response(transaction, self.Result.FAILURE)
+            return
+        with file:
+            mtime = os.fstat(file.fileno()).st_mtime_ns
+            self.send_response(transaction, self.Result.FILE, self.FILE_HEADER.pack(sum(x[1] for x in ranges), mtime))
+            complete = all([self.send_file_data(file, offset, length) for offset, length in ranges])
+        self.socket.sendall(bytes([self.Result.FILE if complete else self.Result.FAILURE]))
 
-    def reconstruct_file(self, file):
+    def send_compressed_file(self, transaction, file, size, mtime):
         """
-        Reconstruct file using delta_1 and delta_2
+        Answers a file request with the file compressed in chunks, then a status byte telling
+        if all of the file could be read
         """
-        abs_path = os.path.join(self.shared_folder, file)
-        if not os.path.exists(abs_path):
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
-            return self.ReturnCode.FAILURE
+        self.send_response(transaction, self.Result.COMPRESSED_FILE, self.FILE_HEADER.pack(size, mtime))
+        compressor = self.compression.new_compressor()
+        status = self.Result.FILE
+        read = 0
+        sent = 0
         try:
-            # check checksum, quick exit if matched
-            file_checksum = self.hash.get_file_checksum(abs_path)
-            self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-            self.send_object((file, file_checksum))
-            if self.receive_fixed_string_size() == file_checksum:
-                return self.ReturnCode.SUCCESS
+            while read < size:
+                data = file.read(min(self.chunk_size, size - read))
+                if not data:
+                    break
+                read = read + len(data)
+                output = self.compression.run(compressor, data)
+                if output:
+                    self.socket.sendall(self.CHUNK_HEADER.pack(len(output)) + output)
+                    sent = sent + len(output)
         except IOError:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
-            return self.ReturnCode.FAILURE
+            pass
+        if read < size:
+            # the file shrank or could not be read, the receiver drops it
+            status = self.Result.FAILURE
+        output = self.compression.run(compressor, b"", True)
+        if output:
+            self.socket.sendall(self.CHUNK_HEADER.pack(len(output)) + output)
+            sent = sent + len(output)
+        self.compression.count(read, sent)
+        self.socket.sendall(self.CHUNK_HEADER.pack(0) + bytes([status]))
 
+    def receive_compressed_file(self, path, size):
+        """
+        Receives the compressed chunks of a file response into path, the file has to be size bytes
+        """
+        file = None
         try:
-            data_list = self.hash.get_file_bytes(abs_path)
-            weak, strong = self.hash.get_file_hashes(abs_path)
-            delta_1_hash_dict = self.create_dict(weak, strong)
-            self.send_fixed_string_size(self.ReturnCode.SUCCESS)
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            file = open(path, 'wb')
         except IOError:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
+            pass
+        decompressor = self.compression.new_decompressor()
+        # no file has a size the decompression limit can not hold, the chunks are still read
+        failed = file is None or size >= sys.maxsize
+        written = 0
+        length = self.CHUNK_HEADER.unpack(self.receive_bytes(self.CHUNK_HEADER.size))[0]
+        length = self.check_length(length, "Compressed chunk")
+        while length:
+            data = self.receive_bytes(length)
+            if not failed:
+                try:
+                    # a corrupted stream is not decompressed past the expected size, output
+                    # short of the limit means the whole chunk was consumed
+                    data = decompressor.decompress(data, size - written + 1)
+                    written = written + len(data)
+                    if written > size:
+                        raise IOError("Decompressed file is larger than its size")
+                    file.write(data)
+                except (IOError,) + self.compression.get_errors():
+                    failed = True
+            length = self.CHUNK_HEADER.unpack(self.receive_bytes(self.CHUNK_HEADER.size))[0]
+            length = self.check_length(length, "Compressed chunk")
+        status = self.receive_bytes(1)[0]
+        if file is None:
             return self.ReturnCode.FAILURE
-        return self.send_delta_1(data_list, file, delta_1_hash_dict)
-
-    def send_delta_1(self, data_list, file_name, delta_1_hash_dict):
-        """
-        Sends the local delta_1 hashes, receives the remote delta_2 and
-        reconstructs the files
-        """
-        # send delta_1
-        delta_1_data = delta_1_hash_dict
-        delta_1_size = str(len(pickle.dumps(delta_1_data)))
-        self.send_fixed_string_size(delta_1_size)
-        self.socket.send(pickle.dumps(delta_1_data))
-
-        # receive delta_2
-        if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
-            delta_2_size = self.receive_fixed_string_size()
-            delta_2_obj = b""
-            while len(delta_2_obj) < int(delta_2_size):
-                tmp = self.socket.recv(8192)
-                delta_2_obj = delta_2_obj + tmp
-            delta_2_data = pickle.loads(delta_2_obj)
-            delta_2_file_name, delta_2_data = delta_2_data
-
-            # only indexes means that local file == remote file
-            complete = True
-            for x in range(0, len(delta_2_data)):
-                if not isinstance(delta_2_data[x], int):
-                    if x != delta_2_data[x]:
-                        complete = False
-            # no need to write
-            if complete:
-                self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-                return self.ReturnCode.SUCCESS
+        file.close()
+        if failed or status != self.Result.FILE or written != size:
+            os.remove(path)
+            return self.ReturnCode.FAILURE
+        return self.ReturnCode.SUCCESS
 
-            # remake the file using old data and delta_2
-            new_file = os.path.join(self.shared_folder, file_name)
-            try:
-                with open(new_file, "wb+") as f:
-                    for x in range(0, len(delta_2_data)):
-                        if isinstance(delta_2_data[x], bytes):
-                            f.write(delta_2_data[x])
-                        elif isinstance(delta_2_data[x], int):
-                            f.write(data_list[delta_2_data[x]])
-                        else:
-                            raise RuntimeError("Data has been corrupted")
-                self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-            except IOError:
-                self.send_fixed_string_size(self.ReturnCode.FAILURE)
-                return self.ReturnCode.FAILURE
-            return self.ReturnCode.SUCCESS
-        else:
+    def get_receive_buffer(self):
+        if self.receive_buffer is None:
+            self.receive_buffer = memoryview(bytearray(self.chunk_size))
+        return self.receive_buffer
+
+    def receive_file(self, path, size):
+        """
+        Receives the file data of a file response into path, reading the socket into a reused buffer
+        """
+        file = None
+        try:
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            file = open(path, 'wb')
+        except IOError:
+            pass
+        file = self.receive_file_data(file, size)
+        status = self.receive_bytes(1)[0]
+        if file is None:
+            return self.ReturnCode.FAILURE
+        file.close()
+        if status != self.Result.FILE:
+            os.remove(path)
             return self.ReturnCode.FAILURE
+        return self.ReturnCode.SUCCESS
 
-    def receive_delta_1(self):
+    def receive_file_data(self, file, size):
         """
-        Received the hashes for delta_1
+        Receives size bytes of file data into the open file, the data is still read once the file
+        can not be written. Returns the file, None if it was closed on a write error
         """
-        delta_1_size = self.receive_fixed_string_size()
-        delta_1_obj = b""
-        while len(delta_1_obj) < int(delta_1_size):
-            tmp = self.socket.recv(8192)
-            delta_1_obj = delta_1_obj + tmp
-        delta_1_data = pickle.loads(delta_1_obj)
-        return delta_1_data
+        buffer = self.get_receive_buffer()
+        while size > 0:
+            received = self.socket.recv_into(buffer, min(len(buffer), size))
+            if received == 0:
+                raise ConnectionError("Connection closed")
+            size = size - received
+            if file is not None:
+                try:
+                    file.write(buffer[:received])
+                except IOError:
+                    file.close()
+                    file = None
+        return file
 
-    def send_delta2_file(self):
+    def receive_chunk_list(self, batch, event, payload):
         """
-        Create delta2 based on delta1
+        Builds a chunked file from the copies of its chunks found in the local files, the missing
+        ones are requested as ranges of the remote file. The file is requested whole on failure
         """
-        # file checksum check, quick exit if they match
-        if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
+        src = event[0]
+        path = os.path.join(self.shared_folder, src)
+        offset = self.RESPONSE_HEADER.size
+        size, mtime = self.FILE_HEADER.unpack_from(payload, offset)
+        offset = offset + self.FILE_HEADER.size
+        checksum = bytes(payload[offset:offset + ChunkStore.DIGEST_SIZE]).hex()
+        offset = offset + ChunkStore.DIGEST_SIZE
+        count = self.CHUNK_COUNT.unpack_from(payload, offset)[0]
+        offset = offset + self.CHUNK_COUNT.size
+        chunks = [self.CHUNK_REF.unpack_from(payload, offset + x * self.CHUNK_REF.size) for x in range(count)]
+        temp_file = None
+        try:
+            if sum(x[1] for x in chunks) != size:
+                raise IOError("Chunk list does not match the file size")
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            fd, temp_file = self.create_temp_file(path)
+            with open(fd, "wb") as f:
+                ranges, repeats = self.copy_local_chunks(f, chunks)
+                f.truncate(size)
+            print("Local chunks :", size - sum(x[1] for x in ranges), "of", size, "bytes")
+            if ranges:
+                payload = self.CHUNK_COUNT.pack(len(ranges)) + b"".join(self.CHUNK_RANGE.pack(*x) for x in ranges)
+                self.send_request(batch, event, self.Request.CHUNKS, payload,
+                                  (temp_file, mtime, checksum, chunks, ranges, repeats))
+                return
+            if self.finish_chunked_file(src, temp_file, mtime, checksum, chunks) == self.ReturnCode.SUCCESS:
+                return
+        except IOError:
+            pass
+        if temp_file and os.path.exists(temp_file):
+            os.remove(temp_file)
+        print("Failed. Receive file :", src)
+        self.send_request(batch, event, self.Request.WHOLE_FILE)
+
+    def copy_local_chunks(self, f, chunks):
+        """
+        Writes the chunks found in the local files at their offsets. Returns the (offset, length)
+        ranges of the missing ones and the (offset, source offset, length) of the missing chunks
+        repeated in the file, copied from their first occurrence once it is received
+        """
+        ranges = []
+        repeats = []
+        # digest: offset of the first occurrence of a missing chunk
+        missing = {}
+        offset = 0
+        for digest, length in chunks:
+            data = self.chunk_store.read(digest, length) if self.chunk_store is not None else None
+            if data is not None:
+                f.seek(offset)
+                f.write(data)
+            elif digest in missing:
+                repeats.append((offset, missing[digest], length))
+            elif ranges and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+            if data is None:
+                missing.setdefault(digest, offset)
+            offset = offset + length
+        if self.chunk_store is not None:
+            self.chunk_store.close_file()
+        return ranges, repeats
+
+    def receive_chunks(self, temp_file, ranges, repeats, size):
+        """
+        Receives the data of the missing ranges of a chunked file into the file being built,
+        then copies the repeated chunks
+        """
+        if size != sum(x[1] for x in ranges):
+            raise IOError("Chunks response does not match the requested ranges")
+        file = None
+        try:
+            file = open(temp_file, "r+b")
+        except IOError:
+            pass
+        for offset, length in ranges:
+            if file is not None:
+                try:
+                    file.seek(offset)
+                except IOError:
+                    file.close()
+                    file = None
+            file = self.receive_file_data(file, length)
+        status = self.receive_bytes(1)[0]
+        if file is None:
+            return self.ReturnCode.FAILURE
+        with file:
+            if status != self.Result.FILE:
+                return self.ReturnCode.FAILURE
             try:
-                remote_rel_path, remote_file_checksum = self.receive_object()
-                delta_2_file_name = os.path.join(self.shared_folder, remote_rel_path)
-                local_file_checksum = self.hash.get_file_checksum(delta_2_file_name)
-                self.send_fixed_string_size(local_file_checksum)
-                if remote_file_checksum == local_file_checksum:
-                    return self.ReturnCode.SUCCESS
+                for offset, source, length in repeats:
+                    file.seek(source)
+                    data = file.read(length)
+                    file.seek(offset)
+                    file.write(data)
             except IOError:
-                self.send_fixed_string_size(self.ReturnCode.FAILURE)
-        else:
+                return self.ReturnCode.FAILURE
+        return self.ReturnCode.SUCCESS
+
+    def finish_chunked_file(self, src, temp_file, mtime, checksum, chunks):
+        """
+        Checks a built chunked file against the remote checksum and moves it in place, its chunks are indexed
+        """
+        path = os.path.join(self.shared_folder, src)
+        try:
+            if self.hash.compute_file_checksum(temp_file) != checksum:
+                raise IOError("Built file checksum mismatch")
+            os.replace(temp_file, path)
+        except IOError:
             return self.ReturnCode.FAILURE
+        self.set_mtime(path, mtime)
+        self.cache_checksum(path, checksum)
+        if self.chunk_store is not None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return self.ReturnCode.SUCCESS
+            offsets = np.cumsum([0] + [x[1] for x in chunks[:-1]]).tolist()
+            self.chunk_store.add_file(src, (stat.st_ino, stat.st_size, stat.st_mtime_ns),
+                                      [(digest, offset, length) for (digest, length), offset in zip(chunks, offsets)])
+        return self.ReturnCode.SUCCESS
 
-        if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
-            delta_1_data = self.receive_delta_1()
-            delta_1_hash_dict = delta_1_data
+    # ____________
 
-            delta_2_data = self.compute_delta_2(delta_2_file_name, delta_1_hash_dict)
-            if delta_2_data == self.ReturnCode.FAILURE:
-                return self.ReturnCode.FAILURE
-            delta_2_obj = pickle.dumps((delta_2_file_name, delta_2_data))
-            delta_2_size = str(len(delta_2_obj))
-            self.send_fixed_string_size(delta_2_size)
-            self.socket.sendall(delta_2_obj)
-            if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
-                return self.ReturnCode.SUCCESS
+    def send_delta2_file(self, transaction, rel_path, remote_file_checksum, delta_1_signature):
+        """
+        Answers a delta request: nothing if the checksums match, otherwise the
+        local file checksum followed by the delta_2 ops
+        """
+        path = os.path.join(self.shared_folder, rel_path)
+        print("Send modified file :", rel_path)
+        prepared = self.get_prepared(self.prepared_deltas, transaction)
+        ops = None
+        try:
+            if prepared is None:
+                mtime = self.MTIME.pack(os.stat(path).st_mtime_ns)
+                local_file_checksum = self.hash.get_file_checksum(path)
             else:
-                return self.ReturnCode.FAILURE
-        else:
-            return self.ReturnCode.FAILURE
+                key, local_file_checksum, ops = prepared
+                mtime = self.MTIME.pack(key[2])
+                if self.hash.cache is not None:
+                    self.hash.cache.store(path, key, local_file_checksum)
+        except IOError:
+            self.send_response(transaction, self.Result.FAILURE)
+            return
+        if local_file_checksum == remote_file_checksum:
+            self.send_response(transaction, self.Result.SAME, mtime)
+            return
+        self.send_response(transaction, self.Result.DELTA, bytes.fromhex(local_file_checksum) + mtime)
+        if ops is None:
+            ops = self.get_delta_ops(path, delta_1_signature)
+        self.send_delta_ops(ops, self.compression.is_compressible(path))
+        self.print_compression()
 
-    def compute_delta_2(self, file, delta_1_hash_dict):
+    def receive_delta_2(self, new_file, delta_1_signature, remote_file_checksum):
         """
-        Calculates the delta_2 hashes based on the remote delta_1 using a rolling checksum algorithm
+        Receives the remote delta_2 and reconstructs the file. The result is checked against the
+        remote file checksum as the truncated strong hashes can match the wrong block
         """
-        delta_2_list = []
+        # apply delta_2 ops as they arrive, the temporary file is only created once the
+        # remote file stops being the local blocks in order
+        temp_file = None
+        f = None
+        checksum = self.hash.new_file_checksum()
+        next_block = 0
+        op = None
+        # False while an op header is read, the stream can not be skipped after a corrupted one
+        in_step = True
         try:
-            with open(file, "rb") as f:
-                file_bytes = f.read(1)
-                windows_hash = 0
-                prefix = b""
-                window = b""
-                found = False
-
-                while file_bytes != b"":
-                    if len(window) < self.hash.HASH_BLOCK_SIZE:
-                        windows_hash = windows_hash + ord(file_bytes) * 5
-                        window = window + file_bytes
-
-                    elif len(window) == self.hash.HASH_BLOCK_SIZE:
-                        found = False
-                        if windows_hash in delta_1_hash_dict:
-                            if isinstance(delta_1_hash_dict[windows_hash], tuple):
-                                if self.hash.get_byte_strong_hash(window) == delta_1_hash_dict[windows_hash][0]:
-                                    if prefix != b"":
-                                        delta_2_list.append(prefix)
-                                        prefix = b""
-                                    delta_2_list.append(delta_1_hash_dict[windows_hash][1])
-                                    window = b""
-                                    windows_hash = 0
-                                    found = True
-                                    continue
-                            # multiple elems
-                            else:
-                                for elem in delta_1_hash_dict[windows_hash]:
-                                    if self.hash.get_byte_strong_hash(window) == elem[0]:
-                                        if prefix != b"":
-                                            delta_2_list.append(prefix)
-                                            prefix = b""
-                                        delta_2_list.append(elem[1])
-                                        window = file_bytes
-                                        windows_hash = ord(file_bytes) * 5
-                                        found = True
-                                        break
-                                    else:
-                                        continue
-                        if not found:
-                            prefix = prefix + window[:1]
-                        windows_hash = windows_hash - ord(window[:1]) * 5 + ord(file_bytes) * 5
-                        window = window[1:] + file_bytes
-                    file_bytes = f.read(1)
-
-                if prefix != b"":
-                    delta_2_list.append(prefix)
-                if len(window) < self.hash.HASH_BLOCK_SIZE:
-                    found_index = -1
-                    if windows_hash in delta_1_hash_dict:
-                        if isinstance(delta_1_hash_dict[windows_hash], tuple):
-                            if self.hash.get_byte_strong_hash(window) == delta_1_hash_dict[windows_hash][0]:
-                                found_index = delta_1_hash_dict[windows_hash][1]
-                        else:
-                            for elem in delta_1_hash_dict[windows_hash]:
-                                if self.hash.get_byte_strong_hash(window) == elem[0]:
-                                    found_index = delta_1_hash_dict[windows_hash][1]
-                                    break
-                    if found_index != -1:
-                        delta_2_list.append(found_index)
+            with self.hash.map_file(new_file) as old_data:
+                in_step = False
+                op, value, count = self.receive_delta_op()
+                in_step = True
+                while op != self.DeltaOp.END and op != self.DeltaOp.ABORT:
+                    if f is None and op == self.DeltaOp.BLOCKS and value == next_block:
+                        next_block = next_block + count
                     else:
-                        delta_2_list.append(window)
-                else:
-                    delta_2_list.append(window)
+                        if f is None:
+                            fd, temp_file = self.create_temp_file(new_file)
+                            f = open(fd, "wb")
+                            self.copy_blocks(f, checksum, old_data, delta_1_signature, 0, next_block)
+                        if op == self.DeltaOp.LITERAL:
+                            data = self.receive_bytes(value)
+                            checksum.update(data)
+                            f.write(data)
+                        elif op == self.DeltaOp.COMPRESSED:
+                            data = self.compression.decompress(self.receive_bytes(value), count)
+                            checksum.update(data)
+                            f.write(data)
+                        elif op == self.DeltaOp.BLOCKS:
+                            self.copy_blocks(f, checksum, old_data, delta_1_signature, value, count)
+                        else:
+                            raise RuntimeError("Data has been corrupted")
+                    in_step = False
+                    op, value, count = self.receive_delta_op()
+                    in_step = True
 
-            self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-            return delta_2_list
+                if op == self.DeltaOp.ABORT:
+                    raise IOError("Remote host could not compute delta_2")
+                # only the local blocks in order, the checksums differing means a false block match
+                if f is None and next_block == len(delta_1_signature):
+                    raise IOError("Reconstructed file checksum mismatch")
+                if f is None:
+                    fd, temp_file = self.create_temp_file(new_file)
+                    f = open(fd, "wb")
+                    self.copy_blocks(f, checksum, old_data, delta_1_signature, 0, next_block)
+                f.close()
+            if checksum.hexdigest() != remote_file_checksum:
+                raise IOError("Reconstructed file checksum mismatch")
+            os.replace(temp_file, new_file)
         except IOError:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
+            if f is not None:
+                f.close()
+            if temp_file and os.path.exists(temp_file):
+                os.remove(temp_file)
+            if not in_step:
+                raise
+            if op != self.DeltaOp.END and op != self.DeltaOp.ABORT:
+                self.skip_delta_2()
             return self.ReturnCode.FAILURE
+        return self.ReturnCode.SUCCESS
 
-    def create_dict(self, weak, strong):
+    def create_temp_file(self, path):
         """
-        Creates the dictionary for delta_1 transaction.
-        Matches weak hash keys with (strong hash, index in the file) pair
+        Creates the temporary file path is rebuilt in, next to it. It gets the mode of the file
+        it replaces, or the mode of a new file
         """
-        hash_dict = {}
-        index = 0
-        for x in zip(weak, strong):
-            weak, strong = x
-            if weak in hash_dict:
-                if isinstance(hash_dict[weak], tuple):
-                    hash_dict[weak] = [hash_dict[weak], (strong, index)]
-                else:
-                    hash_dict[weak].append((strong, index))
+        fd, temp_file = tempfile.mkstemp(prefix=FileManager.TEMP_PREFIX, dir=os.path.dirname(path))
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~UMASK
+        try:
+            os.fchmod(fd, mode)
+        except OSError:
+            os.close(fd)
+            os.remove(temp_file)
+            raise
+        return fd, temp_file
+
+    def copy_blocks(self, f, checksum, old_data, delta_1_signature, first, count):
+        """
+        Write count blocks of the old file starting with block first
+        """
+        start = first * delta_1_signature.block_size
+        end = min((first + count) * delta_1_signature.block_size, len(old_data))
+        for offset in range(start, end, self.SCAN_BUFFER_SIZE):
+            data = old_data[offset:min(offset + self.SCAN_BUFFER_SIZE, end)]
+            checksum.update(data)
+            f.write(data)
+
+    def send_delta_ops(self, ops, compress=False):
+        """
+        Sends the (op, value, count, literal) delta_2 ops, ABORT if they could not be computed.
+        Literals are compressed when they shrink enough
+        """
+        try:
+            for op, value, count, literal in ops:
+                if literal and compress:
+                    compressed = self.compression.compress(literal)
+                    if compressed is not None:
+                        self.send_delta_op(self.DeltaOp.COMPRESSED, len(compressed), len(literal))
+                        self.socket.sendall(compressed)
+                        continue
+                self.send_delta_op(op, value, count)
+                if literal:
+                    self.socket.sendall(literal)
+            self.send_delta_op(self.DeltaOp.END)
+        except IOError:
+            self.send_delta_op(self.DeltaOp.ABORT)
+
+    def get_delta_ops(self, file, delta_1_signature):
+        """
+        Yields the delta_2 ops as (op, value, count, literal), consecutive blocks are one run
+        """
+        run_start = 0
+        run_length = 0
+        for delta in self.compute_delta_2(file, delta_1_signature):
+            if isinstance(delta, int):
+                if run_length and delta == run_start + run_length:
+                    run_length = run_length + 1
+                    continue
+                if run_length:
+                    yield self.DeltaOp.BLOCKS, run_start, run_length, None
+                run_start = delta
+                run_length = 1
             else:
-                hash_dict[weak] = (strong, index)
-            index = index + 1
-        return hash_dict
+                if run_length:
+                    yield self.DeltaOp.BLOCKS, run_start, run_length, None
+                    run_length = 0
+                yield self.DeltaOp.LITERAL, len(delta), 0, delta
+        if run_length:
+            yield self.DeltaOp.BLOCKS, run_start, run_length, None
+
+    def send_delta_op(self, op, value=0, count=0):
+        """
+        Sends the header of a delta_2 op
+        """
+        self.socket.sendall(self.DELTA_OP_HEADER.pack(op, value, count))
+
+    def receive_delta_op(self):
+        """
+        Receives the header of a delta_2 op as (op, value, count), the sizes of the data following
+        it are checked
+        """
+        op, value, count = self.DELTA_OP_HEADER.unpack(self.receive_bytes(self.DELTA_OP_HEADER.size))
+        if op == self.DeltaOp.LITERAL or op == self.DeltaOp.COMPRESSED:
+            self.check_length(value, "Delta literal")
+        if op == self.DeltaOp.COMPRESSED:
+            self.check_length(count, "Decompressed delta literal")
+        return op, value, count
+
+    def skip_delta_2(self):
+        """
+        Reads and drops the rest of a delta_2 stream
+        """
+        op, value, count = self.receive_delta_op()
+        while op != self.DeltaOp.END and op != self.DeltaOp.ABORT:
+            if op == self.DeltaOp.LITERAL or op == self.DeltaOp.COMPRESSED:
+                self.receive_bytes(value)
+            op, value, count = self.receive_delta_op()
+
+    def compute_delta_2(self, file, delta_1_signature):
+        """
+        Calculates the delta_2 based on the remote delta_1 using a rolling checksum algorithm.
+        The file is scanned in SCAN_BUFFER_SIZE buffers, the weak hash of every window offset is computed
+        in bulk and only the offsets whose weak hash is present in delta_1 get their strong hash checked.
+        Literal bytes and remote block indexes are yielded as soon as they are found
+        """
+        block_size = delta_1_signature.block_size
+        scan_size = max(self.SCAN_BUFFER_SIZE, 2 * block_size)
+        with open(file, "rb") as f:
+            buffer = b""
+            while True:
+                data = f.read(scan_size)
+                eof = len(data) == 0
+                buffer = buffer + data
+                if not eof and len(buffer) < scan_size:
+                    continue
+
+                weak = self.hash.get_rolling_weak_hashes(np.frombuffer(buffer, dtype=np.uint8), block_size)
+                candidates = delta_1_signature.find_candidates(weak)
+
+                # scan the candidate offsets, skipping the ones overlapping a matched block
+                pos = 0
+                literal_start = 0
+                i = 0
+                while i < len(candidates):
+                    offset = int(candidates[i])
+                    index = self.match_block(buffer[offset:offset + block_size], int(weak[offset]),
+                                             delta_1_signature)
+                    if index == -1:
+                        i = i + 1
+                        continue
+                    if offset > literal_start:
+                        yield buffer[literal_start:offset]
+                    yield index
+                    pos = offset + block_size
+                    literal_start = pos
+                    i = int(np.searchsorted(candidates, pos))
+
+                if eof:
+                    break
+                # every window fully inside the buffer has been checked, keep the rest for the next read
+                pos = max(pos, len(weak))
+                if pos > literal_start:
+                    yield buffer[literal_start:pos]
+                buffer = buffer[pos:]
+
+            # the last block of the remote file can be shorter than the block size
+            tail = buffer[pos:]
+            index = -1
+            if 0 < len(tail) < block_size:
+                index = self.match_block(tail, self.hash.get_byte_weak_hash(tail), delta_1_signature)
+            if index != -1:
+                if pos > literal_start:
+                    yield buffer[literal_start:pos]
+                yield index
+            elif len(buffer) > literal_start:
+                yield buffer[literal_start:]
+
+    def match_block(self, window, weak, delta_1_signature):
+        """
+        Returns the remote block index matching the window or -1 if the window is not in delta_1
+        """
+        if weak not in delta_1_signature:
+            return -1
+        return delta_1_signature.find_block(weak, self.hash.get_byte_strong_hash(window))
 
     # ____________
 
@@ -392,23 +1278,11 @@ class Host:
         Send all the modification data happening on this host
         """
         if event_list:
-            self.send_fixed_string_size(self.ReturnCode.SUCCESS)
-            self.receive_fixed_string_size()
-            self.send_object(event_list)
-
-            for event in event_list:
-                if event[3] == events.EVENT_TYPE_CREATED:
-                    if event[2]:
-                        pass
-                    else:
-                        self.transaction_send_created(event, fm)
-                elif event[3] == events.EVENT_TYPE_MOVED:
-                    self.transaction_send_move(event, fm)
-                elif event[3] == events.EVENT_TYPE_MODIFIED:
-                    self.transaction_send_modified(event, fm)
-
+            self.send_message(self.ReturnCode.SUCCESS)
+            self.send_events(event_list)
+            self.serve_channels()
         else:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
+            self.send_message(self.ReturnCode.FAILURE)
         fm.clear_exceptions()
 
     def receive_all_data(self, fm):
@@ -417,32 +1291,196 @@ class Host:
         """
 
         fm.clear_exceptions()
-        if self.receive_fixed_string_size() == self.ReturnCode.SUCCESS:
-            self.send_fixed_string_size()
-            event_list = self.receive_object()
-
-            for event in event_list:
-                if event[3] == events.EVENT_TYPE_CREATED:
-                    if event[2]:
-                        self.transaction_created_folders(event, fm)
-                    else:
-                        self.transaction_receive_created(event, fm)
-                elif event[3] == events.EVENT_TYPE_MOVED:
-                    self.transaction_receive_move(event, fm)
-                elif event[3] == events.EVENT_TYPE_MODIFIED:
-                    self.transaction_receive_modified(event, fm)
-                elif event[3] == events.EVENT_TYPE_DELETED:
-                    self.transaction_remove(event, fm)
+        if self.receive_message() == self.ReturnCode.SUCCESS:
+            event_list = self.receive_events()
+            self.request_batch(event_list, fm)
+
+    def request_batch(self, event_list, fm):
+        """
+        Applies the remote events. Local operations are done in order, file data is requested
+        on the data channels without waiting for the previous answers and the responses are
+        applied as they arrive
+        """
+        scheduler = Scheduler(self.channels, self.Op.END)
+        # the signatures of the modified files are computed by the workers while the batch runs
+        for src, dest, is_dir, type in event_list:
+            if type == events.EVENT_TYPE_MODIFIED and not is_dir:
+                self.hash.prefetch_signature(os.path.join(self.shared_folder, src))
+        for event in event_list:
+            src, dest, is_dir, type = event
+            # a local operation has to wait for the transactions of the paths it touches
+            self.wait_for_path(scheduler, src, fm)
+            if dest is not None:
+                self.wait_for_path(scheduler, dest, fm)
+
+            if type == events.EVENT_TYPE_CREATED:
+                if is_dir:
+                    self.transaction_created_folders(event, fm)
+                else:
+                    self.transaction_receive_created(scheduler.pick(), event, fm)
+            elif type == events.EVENT_TYPE_MOVED or type == FileManager.EVENT_TYPE_COPIED:
+                self.transaction_receive_move(scheduler.pick(), event, fm)
+            elif type == events.EVENT_TYPE_MODIFIED:
+                self.transaction_receive_modified(scheduler.pick(), event, fm)
+            elif type == events.EVENT_TYPE_DELETED:
+                self.transaction_remove(event, fm)
+
+        while scheduler:
+            channel, batch = scheduler.ready()
+            channel.receive_response(batch, fm)
+        scheduler.finish()
+        self.hash.clear_prefetched()
+        for channel in self.channels:
+            channel.receive_frame(self.Op.END)
+
+    def wait_for_path(self, scheduler, rel_path, fm):
+        """
+        Applies the responses of the channel with a transaction about the path until it is answered
+        """
+        pending = scheduler.find(rel_path)
+        while pending is not None:
+            channel, batch = pending
+            channel.receive_response(batch, fm)
+            pending = scheduler.find(rel_path)
+
+    def send_request(self, batch, event, request, payload=b"", data=None):
+        transaction = batch.add(event, request, data)
+        path = event[0].encode("utf-8")
+        batch.send(self.Op.REQUEST, self.REQUEST_HEADER.pack(transaction, request, len(path)) + path + payload)
+
+    def receive_response(self, batch, fm):
+        """
+        Receives the next response and completes its transaction, failed deltas and chunked files are requested
+        again as files. A pack completes the transactions of all its files
+        """
+        op, payload = self.receive_any_frame()
+        if op == self.Op.PACK:
+            self.receive_pack(batch, payload, fm)
+            return
+        if op != self.Op.RESPONSE:
+            raise IOError("Unexpected frame " + str(op) + ", expected " + str(self.Op.RESPONSE))
+        transaction, result = self.RESPONSE_HEADER.unpack_from(payload)
+        event, request, data = batch.pop(transaction)
+        src = event[0]
+        path = os.path.join(self.shared_folder, src)
+        if request == self.Request.FILE or request == self.Request.WHOLE_FILE:
+            if result == self.Result.FILE or result == self.Result.COMPRESSED_FILE:
+                size, mtime = self.FILE_HEADER.unpack_from(payload, self.RESPONSE_HEADER.size)
+                if result == self.Result.FILE:
+                    received = self.receive_file(path, size)
+                else:
+                    received = self.receive_compressed_file(path, size)
+                if received == self.ReturnCode.SUCCESS:
+                    self.set_mtime(path, mtime)
+                    return
+            elif result == self.Result.CHUNKED:
+                self.receive_chunk_list(batch, event, payload)
+                return
+            print("Failed. File not received :", src)
+            fm.local_rel_paths.discard(src)
+            fm.rm_unique_exception(event)
+        elif request == self.Request.CHUNKS:
+            temp_file, mtime, checksum, chunks, ranges, repeats = data
+            if result == self.Result.FILE:
+                size = self.FILE_HEADER.unpack_from(payload, self.RESPONSE_HEADER.size)[0]
+                if (self.receive_chunks(temp_file, ranges, repeats, size) == self.ReturnCode.SUCCESS and
+                        self.finish_chunked_file(src, temp_file, mtime, checksum, chunks) == self.ReturnCode.SUCCESS):
+                    return
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            print("Failed. Receive file :", src)
+            self.send_request(batch, event, self.Request.WHOLE_FILE)
+        elif result == self.Result.DELTA:
+            offset = self.RESPONSE_HEADER.size
+            checksum_size = self.hash.new_file_checksum().digest_size
+            remote_file_checksum = bytes(payload[offset:offset + checksum_size]).hex()
+            mtime = self.MTIME.unpack_from(payload, offset + checksum_size)[0]
+            if self.receive_delta_2(path, data, remote_file_checksum) == self.ReturnCode.SUCCESS:
+                self.set_mtime(path, mtime)
+                self.cache_checksum(path, remote_file_checksum)
+                return
+            fm.rm_unique_exception(event)
+            print("Failed. Receive file :", src)
+            self.transaction_receive_created(batch, (src, None, False, events.EVENT_TYPE_CREATED), fm)
+        elif result == self.Result.SAME:
+            self.set_mtime(path, self.MTIME.unpack_from(payload, self.RESPONSE_HEADER.size)[0])
+        elif result == self.Result.FAILURE:
+            fm.rm_unique_exception(event)
+
+    def receive_pack(self, batch, payload, fm):
+        """
+        Writes the files of a pack
+        """
+        count, compressed = self.PACK_HEADER.unpack_from(payload)
+        entries = [self.PACK_ENTRY.unpack_from(payload, self.PACK_HEADER.size + x * self.PACK_ENTRY.size)
+                   for x in range(count)]
+        contents = payload[self.PACK_HEADER.size + count * self.PACK_ENTRY.size:]
+        total = self.check_length(sum(x[2] for x in entries if x[1] == self.Result.FILE), "Pack")
+        if compressed:
+            contents = self.compression.decompress(contents, total)
+        data_offset = 0
+        for transaction, result, size, mtime in entries:
+            event = batch.pop(transaction)[0]
+            src = event[0]
+            path = os.path.join(self.shared_folder, src)
+            if result == self.Result.FILE:
+                content = contents[data_offset:data_offset + size]
+                data_offset = data_offset + size
+                if len(content) != size:
+                    raise IOError("Pack is truncated")
+                if self.write_file(path, content) == self.ReturnCode.SUCCESS:
+                    self.set_mtime(path, mtime)
+                    continue
+            print("Failed. File not received :", src)
+            fm.local_rel_paths.discard(src)
+            fm.rm_unique_exception(event)
+
+    def write_file(self, path, data):
+        try:
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        except IOError:
+            return self.ReturnCode.FAILURE
+        return self.ReturnCode.SUCCESS
+
+    def cache_checksum(self, path, checksum):
+        """
+        Caches the checksum of a received file given by the remote host, it finds the file again
+        if it is renamed through a delete and a create
+        """
+        if self.hash.cache is None:
+            return
+        try:
+            self.hash.cache.store(path, self.hash.cache.get_key(path), checksum)
+        except OSError:
+            pass
+
+    def set_mtime(self, path, mtime):
+        """
+        Gives a received file the mtime of the remote file so that both trees hash the same
+        """
+        try:
+            os.utime(path, ns=(mtime, mtime))
+        except OSError:
+            pass
 
     # ____________
 
     def filter_queue(self, event_queue, fm):
         """
         Removes duplicate events from the queue and matches files to the corresponding event.
-        Fixes modify events that appear as move events in case of buffer writes
+        Fixes modify events that appear as move events in case of buffer writes, and deleted and
+        created files of the same content that are a move or a copy
         """
 
         event_dict = {}
+        # rel_path: (inode, size, mtime_ns, checksum) of the deleted files, checksum None if not cached
+        deleted = {}
+        # files just received by delta or chunks have the checksum of the remote file cached, the
+        # events of their rebuild do not change it. A later local change gives them another key
+        received = set(src for src, dest, is_dir, type in fm.files_just_received
+                       if type in (events.EVENT_TYPE_CREATED, events.EVENT_TYPE_MODIFIED))
         size = event_queue.qsize()
         for j in range(0, size):
             event_data = event_queue.get()
@@ -450,13 +1488,32 @@ class Host:
             src = event_data.src_path.split(self.shared_folder, 1)[1]
             is_dir = event_data.is_directory
 
-            # move event
-            if hasattr(event_data, "dest_path"):
+            # temporary files of a reconstruction, only their final move matters
+            if fm.is_temp_file(src) and e_type != events.EVENT_TYPE_MOVED:
+                continue
+
+            # move event, recent watchdog versions give every event an empty dest_path
+            if e_type == events.EVENT_TYPE_MOVED:
                 dest = event_data.dest_path.split(self.shared_folder, 1)[1]
             # create, modify, delete events
             else:
                 dest = None
 
+            # the last known state of a deleted file is kept to find it among the created ones
+            if not is_dir:
+                state = fm.update_manifest(src, dest, e_type)
+                if state is not None:
+                    entry = self.hash.cache.get_entry(src) if self.hash.cache is not None else None
+                    deleted[src] = state + (entry[3] if entry is not None and entry[:3] == state else None,)
+
+            # cached hashes follow moves and are dropped for anything else, a temporary file
+            # moved in place has no hashes
+            if self.hash.cache is not None:
+                if e_type == events.EVENT_TYPE_MOVED and not fm.is_temp_file(src):
+                    self.hash.cache.move(src, dest, is_dir)
+                elif e_type == events.EVENT_TYPE_DELETED or (dest or src) not in received:
+                    self.hash.cache.invalidate(dest or src, is_dir)
+
             # create a single event type for each file
             if e_type == events.EVENT_TYPE_DELETED:
                 event_dict[(src, None, is_dir, e_type)] = e_type
@@ -479,31 +1536,84 @@ class Host:
         event_list = []
         for elem in event_dict.keys():
             if elem in fm.files_just_received:
-                fm.files_just_received.remove(elem)
+                fm.files_just_received.discard(elem)
                 continue
 
             if event_dict[elem] == events.EVENT_TYPE_CREATED:
-                if elem[2]:
-                    event_list.append(elem)
-                    fm.local_rel_paths.append(elem[0])
-                else:
-                    fm.local_rel_paths.append(elem[0])
-                    event_list.append(elem)
+                fm.local_rel_paths.add(elem[0])
+                event_list.append(elem)
             elif event_dict[elem] == events.EVENT_TYPE_DELETED:
-                if elem[0] in fm.local_rel_paths:
-                    fm.local_rel_paths.remove(elem[0])
+                fm.local_rel_paths.discard(elem[0])
                 event_list.append(elem)
             elif event_dict[elem] == events.EVENT_TYPE_MOVED:
-                if elem[0] in fm.local_rel_paths:
-                    fm.local_rel_paths.remove(elem[0])
-                fm.local_rel_paths.append(elem[1])
+                fm.local_rel_paths.move(elem[0], elem[1])
                 event_list.append(elem)
             else:
-                if elem[1] is not None and elem[0] in fm.local_rel_paths:
-                    fm.local_rel_paths.remove(elem[0])
+                if elem[1] is not None:
+                    fm.local_rel_paths.discard(elem[0])
                 event_list.append(elem)
 
-        return event_list
+        return self.match_moves(event_list, deleted)
+
+    def match_moves(self, event_list, deleted):
+        """
+        Turns a deleted file and a created file of the same content into a move, the other created
+        files of that content into copies made before it. The remote host applies them locally.
+        The content is the same for the same size and either the same inode and mtime, a rename,
+        or the same checksum when the one of the deleted file was cached
+        """
+        created = [x for x, event in enumerate(event_list) if event[3] == events.EVENT_TYPE_CREATED and not event[2]]
+        sources = set(src for src, dest, is_dir, type in event_list if type == events.EVENT_TYPE_DELETED)
+        # a path created again is not a source, nor one that exists again
+        sources = sources.intersection(deleted).difference(event_list[x][0] for x in created)
+        sources = set(x for x in sources if not os.path.lexists(os.path.join(self.shared_folder, x)))
+        by_size = {}
+        for src in sorted(sources):
+            by_size.setdefault(deleted[src][1], []).append(src)
+        # src: destinations of its content, the first one is moved to
+        matches = {}
+        for x in created:
+            dest = event_list[x][0]
+            path = os.path.join(self.shared_folder, dest)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            checksum = None
+            for src in by_size.get(stat.st_size, []):
+                inode, size, mtime, src_checksum = deleted[src]
+                if (inode, mtime) != (stat.st_ino, stat.st_mtime_ns):
+                    if src_checksum is None:
+                        continue
+                    if checksum is None:
+                        try:
+                            checksum = self.hash.get_file_checksum(path)
+                        except IOError:
+                            break
+                    if checksum != src_checksum:
+                        continue
+                matches.setdefault(src, []).append(dest)
+                break
+        if not matches:
+            return event_list
+        owners = dict((dest, src) for src, dests in matches.items() for dest in dests)
+        # the move and its copies take the place of the first event about their files, the other
+        # events of these files are dropped
+        places = {}
+        matched_list = []
+        for src, dest, is_dir, type in event_list:
+            source = owners.get(src, src if src in matches else None)
+            if is_dir or dest is not None or source is None:
+                matched_list.append((src, dest, is_dir, type))
+            elif source not in places:
+                places[source] = len(matched_list)
+                matched_list.append(None)
+        for source, x in sorted(places.items(), key=lambda x: -x[1]):
+            dests = matches[source]
+            print("Content of", source, "found in", ", ".join(dests))
+            matched_list[x:x + 1] = ([(source, y, False, FileManager.EVENT_TYPE_COPIED) for y in dests[1:]] +
+                                     [(source, dests[0], False, events.EVENT_TYPE_MOVED)])
+        return matched_list
 
     # ____________
 
@@ -516,109 +1626,79 @@ class Host:
         print("Send create folder :", path)
         if not os.path.isdir(path):
             try:
-                fm.local_rel_paths.append(src)
+                fm.local_rel_paths.add(src)
                 fm.add_unique_exception(event)
                 os.makedirs(path)
             except IOError:
-                fm.local_rel_paths.remove(src)
+                fm.local_rel_paths.discard(src)
                 fm.rm_unique_exception(event)
 
-    def transaction_send_created(self, event, fm):
+    def transaction_receive_created(self, batch, event, fm):
         """
-        Send files remotely
-        """
-        src, dest, is_dir, type = event
-        if src:
-            path = os.path.join(self.shared_folder, src)
-            print("Send create file :", path)
-            self.send_file(os.path.join(self.shared_folder, path))
-
-    def transaction_receive_created(self, event, fm):
-        """
-        Receive files
+        Request files
         """
         src, dest, is_dir, type = event
         if src:
             path = os.path.join(self.shared_folder, src)
             print("Receive file :", src, path)
-            try:
-                fm.local_rel_paths.append(src)
-                fm.add_unique_exception(event)
-                if self.receive_file(path) == self.ReturnCode.FAILURE:
-                    fm.local_rel_paths.remove(src)
-                    fm.rm_unique_exception(event)
-            except IOError:
-                fm.local_rel_paths.remove(src)
-                fm.rm_unique_exception(event)
-
-    def transaction_send_modified(self, event, fm):
-        """
-        Send file deltas. On error send the entire file
-        """
-        src, dest, is_dir, type = event
-        print("Send modified file :", src)
-        error_code = self.send_delta2_file()
-        if error_code == self.ReturnCode.FAILURE:
-            print("Failed. Sending file :", src)
-            self.transaction_send_created((src, None, False, events.EVENT_TYPE_CREATED), fm)
+            fm.local_rel_paths.add(src)
+            fm.add_unique_exception(event)
+            self.send_request(batch, event, self.Request.FILE)
 
-    def transaction_receive_modified(self, event, fm):
+    def transaction_receive_modified(self, batch, event, fm):
         """
-        Receive file deltas and reconstruct the file. On error receive the entire file
+        Request file deltas, the file is requested whole if there is no local version
         """
         src, dest, is_dir, type = event
         print("Receive modified file :", src)
+        abs_path = os.path.join(self.shared_folder, src)
         fm.add_unique_exception(event)
-        return_code = self.reconstruct_file(src)
-        if return_code == self.ReturnCode.FAILURE:
+        try:
+            # single pass over the file for the checksum and the block hashes
+            file_size = os.path.getsize(abs_path)
+            block_size = self.hash.get_block_size(file_size)
+            file_checksum, weak, strong = self.hash.get_file_signature(abs_path, block_size)
+        except IOError:
             fm.rm_unique_exception(event)
             print("Failed. Receive file :", src)
-            self.transaction_receive_created((src, None, False, events.EVENT_TYPE_CREATED), fm)
-
-    def transaction_send_move(self, event, fm):
-        """
-        Send move file/folder in case of move error
-        """
-        src, dest, is_dir, type = event
-        print("Send move file/folder :", src, dest)
-        if self.receive_fixed_string_size() == self.ReturnCode.FAILURE:
-            self.transaction_send_created((dest, None, is_dir, events.EVENT_TYPE_CREATED), fm)
+            self.transaction_receive_created(batch, (src, None, False, events.EVENT_TYPE_CREATED), fm)
+            return
+        strong_size = self.hash.get_strong_hash_size(file_size, block_size)
+        delta_1_signature = SignatureIndex(weak, strong, block_size, strong_size, self.hash.strong_hash_size)
+        self.send_request(batch, event, self.Request.DELTA,
+                          bytes.fromhex(file_checksum) + delta_1_signature.get_bytes(), delta_1_signature)
 
-    def transaction_receive_move(self, event, fm):
+    def transaction_receive_move(self, batch, event, fm):
         """
-        Receive move file/folder from remote. Receive element on move error
+        Move file/folder like the remote did, or copy a file. Request the element on move error
         """
         src_rel, dest_rel, is_dir, type = event
-        print("Receive move file/folder :", src_rel, dest_rel)
+        action = "copy" if type == FileManager.EVENT_TYPE_COPIED else "move"
+        print("Receive " + action + " file/folder :", src_rel, dest_rel)
         if src_rel is None or dest_rel is None:
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
-            self.transaction_receive_created((dest_rel, None, False, events.EVENT_TYPE_CREATED), fm)
+            self.transaction_receive_created(batch, (dest_rel, None, False, events.EVENT_TYPE_CREATED), fm)
             return
         try:
             src_abs = os.path.join(self.shared_folder, src_rel)
             dest_abs = os.path.join(self.shared_folder, dest_rel)
             if not os.path.exists(src_abs):
                 raise IOError
-            if os.path.isdir(src_abs):
-                if not os.path.exists(os.path.dirname(dest_abs)):
-                    os.makedirs(os.path.dirname(dest_abs))
+            if not os.path.exists(os.path.dirname(dest_abs)):
+                os.makedirs(os.path.dirname(dest_abs))
+            if type == FileManager.EVENT_TYPE_COPIED:
+                # the local watcher sees the copy as a created file
+                event = (dest_rel, None, False, events.EVENT_TYPE_CREATED)
                 fm.add_unique_exception(event)
-                fm.update_local_files_from_dir(src_abs, True)
-                fm.update_local_files_from_dir(dest_abs, False)
-                shutil.move(src_abs, dest_abs)
+                shutil.copy2(src_abs, dest_abs)
+                fm.local_rel_paths.add(dest_rel)
             else:
-                if not os.path.exists(os.path.dirname(dest_abs)):
-                    os.makedirs(os.path.dirname(dest_abs))
-                if src_abs in fm.local_rel_paths:
-                    fm.local_rel_paths.remove(src_rel)
                 fm.add_unique_exception(event)
-                fm.local_rel_paths.append(dest_rel)
                 shutil.move(src_abs, dest_abs)
-            self.send_fixed_string_size(self.ReturnCode.SUCCESS)
+                # a folder is renamed in the index with everything below it
+                fm.local_rel_paths.move(src_rel, dest_rel)
         except IOError:
             fm.rm_unique_exception(event)
-            self.send_fixed_string_size(self.ReturnCode.FAILURE)
-            self.transaction_receive_created((dest_rel, None, False, events.EVENT_TYPE_CREATED), fm)
+            self.transaction_receive_created(batch, (dest_rel, None, False, events.EVENT_TYPE_CREATED), fm)
 
     def transaction_remove(self, event, fm):
         """
@@ -634,7 +1714,6 @@ class Host:
                     shutil.rmtree(path)
                 else:
                     os.remove(path)
-            if src in fm.local_rel_paths:
-                fm.local_rel_paths.remove(src)
+            fm.local_rel_paths.discard(src)
         except IOError:
             fm.rm_unique_exception(event)
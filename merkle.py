@@ -0,0 +1,94 @@
+import os
+import struct
+import hashlib
+import itertools
+
+import numpy as np
+
+
+class MerkleTree:
+    '''
+    Hash tree of the shared folder. The hash of a folder covers the name, size and mtime of its files
+    and the name and hash of its sub folders, two hosts only have to list the folders whose hashes differ.
+    Folders are relative paths, the shared folder itself is ""
+    '''
+    COUNTS = struct.Struct("!II")
+    STAT_TYPE = np.dtype(">i8")
+    EMPTY_HASH = hashlib.sha1(COUNTS.pack(0, 0)).digest()
+
+    def __init__(self, manifest, empty_folders=()):
+        # folder: {name: (size, mtime_ns)} of the files directly inside it
+        self.files = {}
+        # folder: sub folders directly inside it
+        self.folders = {"": set()}
+        self.hashes = {}
+        for rel_path, stat in manifest.items():
+            folder, sep, name = rel_path.rpartition(os.sep)
+            if folder not in self.files:
+                self.files[folder] = {}
+                self.add_folder(folder)
+            self.files[folder][name] = stat
+        for folder in empty_folders:
+            self.add_folder(folder)
+        self.compute_hashes()
+
+    def add_folder(self, folder):
+        '''
+        Adds the folder and the parents missing from the tree
+        '''
+        child = None
+        while folder not in self.folders:
+            self.folders[folder] = set() if child is None else {child}
+            child = folder
+            folder = folder.rpartition(os.sep)[0]
+        if child is not None:
+            self.folders[folder].add(child)
+
+    def compute_hashes(self):
+        '''
+        Hashes the entry counts, the file names, sizes and mtimes and the sub folder names and hashes of every folder
+        '''
+        # the deepest folders first so that sub folder hashes are known
+        for folder in sorted(self.folders, key=lambda x: x.count(os.sep) + (x != ""), reverse=True):
+            files = self.files.get(folder, {})
+            names = sorted(files)
+            sub_folders = sorted(self.folders[folder])
+            folder_hash = hashlib.sha1(self.COUNTS.pack(len(names), len(sub_folders)))
+            if names:
+                folder_hash.update("\0".join(names).encode("utf-8") + b"\0")
+                folder_hash.update(np.fromiter(itertools.chain.from_iterable(map(files.__getitem__, names)),
+                                               dtype=self.STAT_TYPE, count=2 * len(names)).tobytes())
+            if sub_folders:
+                folder_hash.update("\0".join(x.rpartition(os.sep)[2] for x in sub_folders).encode("utf-8") + b"\0")
+                folder_hash.update(b"".join(map(self.hashes.__getitem__, sub_folders)))
+            self.hashes[folder] = folder_hash.digest()
+
+    def get_hash(self, folder):
+        return self.hashes.get(folder)
+
+    def get_files(self, folder):
+        '''
+        rel_path: (size, mtime_ns) of the files directly inside the folder
+        '''
+        return {os.path.join(folder, x): stat for x, stat in self.files.get(folder, {}).items()}
+
+    def get_folders(self, folder):
+        '''
+        rel_path: hash of the folders directly inside the folder
+        '''
+        return {x: self.hashes[x] for x in self.folders.get(folder, ())}
+
+    def get_subtree(self, folder):
+        '''
+        Files and folders below the folder, as get_files and get_folders return them
+        '''
+        files = {}
+        folders = {}
+        pending = [folder]
+        while pending:
+            folder = pending.pop()
+            files.update(self.get_files(folder))
+            sub_folders = self.get_folders(folder)
+            folders.update(sub_folders)
+            pending.extend(sub_folders)
+        return files, folders
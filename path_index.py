@@ -0,0 +1,102 @@
+import os
+
+
+class PathIndex:
+    '''
+    Set of relative paths kept as a folder trie. Every folder node is also indexed by its path, so
+    membership is a dictionary and a set lookup, and moving or removing a folder relinks its node
+    and only renames the folders below it, whatever the number of files they hold
+    '''
+
+    class Folder:
+        def __init__(self, path):
+            self.path = path
+            # names of the indexed entries directly inside the folder
+            self.names = set()
+            # name: Folder of the sub folders
+            self.children = {}
+
+    def __init__(self, paths=()):
+        self.folders = {"": self.Folder("")}
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        folder, sep, name = path.rpartition(os.sep)
+        node = self.folders.get(folder)
+        return node is not None and name in node.names
+
+    def __len__(self):
+        return sum(len(x.names) for x in self.folders.values())
+
+    def __iter__(self):
+        for node in list(self.folders.values()):
+            for name in list(node.names):
+                yield os.path.join(node.path, name)
+
+    def get_folder(self, path):
+        '''
+        Returns the node of the folder, creating it and its parents if needed
+        '''
+        node = self.folders.get(path)
+        if node is None:
+            parent, sep, name = path.rpartition(os.sep)
+            node = self.Folder(path)
+            self.get_folder(parent).children[name] = node
+            self.folders[path] = node
+        return node
+
+    def add(self, path):
+        folder, sep, name = path.rpartition(os.sep)
+        self.get_folder(folder).names.add(name)
+
+    def discard(self, path):
+        '''
+        Removes the path and, for a folder, everything below it
+        '''
+        folder, sep, name = path.rpartition(os.sep)
+        parent = self.folders.get(folder)
+        if parent is None:
+            return
+        parent.names.discard(name)
+        node = parent.children.pop(name, None)
+        if node is not None:
+            for sub_folder in self.get_sub_folders(node):
+                del self.folders[sub_folder.path]
+
+    def move(self, src, dest):
+        '''
+        Renames the path and, for a folder, everything below it
+        '''
+        folder, sep, name = src.rpartition(os.sep)
+        parent = self.folders.get(folder)
+        if parent is None:
+            return
+        node = parent.children.get(name)
+        if name in parent.names:
+            parent.names.discard(name)
+            self.add(dest)
+        if node is None:
+            return
+        if dest in self.folders:
+            # merging into an existing folder, move the entries one by one
+            for path in [x for x in self if x.startswith(src + os.sep)]:
+                self.add(dest + path[len(src):])
+            self.discard(src)
+            return
+        del parent.children[name]
+        dest_folder, sep, dest_name = dest.rpartition(os.sep)
+        self.get_folder(dest_folder).children[dest_name] = node
+        for sub_folder in self.get_sub_folders(node):
+            del self.folders[sub_folder.path]
+            sub_folder.path = dest + sub_folder.path[len(src):]
+            self.folders[sub_folder.path] = sub_folder
+
+    def get_sub_folders(self, node):
+        '''
+        The folder node and the nodes of every folder below it
+        '''
+        sub_folders = [node]
+        for sub_folder in sub_folders:
+            sub_folders.extend(sub_folder.children.values())
+        return sub_folders
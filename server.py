@@ -1,100 +1,170 @@
 import os
 import time
 import socket
+import secrets
 import argparse
+from queue import Queue, Empty
 from threading import Thread
 from watchdog import events
 
 from event_monitor import EventMonitor
 from event_monitor import IsReadyToSync
 from file_manager import FileManager
+from hash import Hash
 from host import Host
+from compression import Compression
 
 
 class Server:
-    def __init__(self, shared_folder='', sync_mode=0, port=60000):
+    def __init__(self, shared_folder='', sync_mode=0, port=60000, block_size=0, strong_hash=Hash.DEFAULT_STRONG_HASH,
+                 use_cache=True, chunk_size=Host.FILE_CHUNK_SIZE, workers=Host.WORKERS, channel_count=Host.CHANNELS,
+                 compression=Compression.DEFAULT_METHOD, compression_level=Compression.DEFAULT_LEVEL, dedup=False):
         self.ip = '0.0.0.0'
         self.port = port
         self.server_socket = None
         self.sync_mode = sync_mode
         self.shared_folder = shared_folder
+        self.block_size = block_size
+        self.strong_hash = strong_hash
+        self.use_cache = use_cache
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.channel_count = channel_count
+        self.compression = compression
+        self.compression_level = compression_level
+        self.dedup = dedup
+        # session: queue of the data channel sockets of a client being connected
+        self.sessions = {}
 
     def server_start(self):
         print("Starting server on port:", self.port)
         print("Shared folder:", self.shared_folder)
         print("Sync mode:", self.sync_mode)
+        print("Block size:", self.block_size if self.block_size else "auto")
+        print("Block hash:", self.strong_hash)
+        print("Hash cache:", "on" if self.use_cache else "off")
+        print("Chunk size:", self.chunk_size)
+        print("Workers:", self.workers)
+        print("Channels:", self.channel_count)
+        print("Compression:", self.compression, self.compression_level)
+        print("Dedup:", "on" if self.dedup else "off")
         try:
             self.server_socket = socket.socket()
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.ip, self.port))
-            self.server_socket.listen(1)
+            # the data channels of a client connect back to back
+            self.server_socket.listen(self.channel_count)
         except socket.error as e:
             print("Could not establish server", e)
 
         while True:
             client_socket, client_address = self.server_socket.accept()
             print('Connected to: ' + client_address[0] + ':' + str(client_address[1]))
-            ServerConn(client_socket, self.shared_folder, self.sync_mode).start()
+            ServerConn(client_socket, self.shared_folder, self.sync_mode, self.block_size,
+                       self.strong_hash, self.use_cache, self.chunk_size, self.workers, self.channel_count,
+                       self.compression, self.compression_level, self.dedup, self.sessions).start()
 
 
 class ServerConn(Thread, Host):
-    def __init__(self, server_socket, shared_folder, sync_mode):
+    # seconds the data channels of a client have to connect
+    CHANNEL_TIMEOUT = 30
+
+    def __init__(self, server_socket, shared_folder, sync_mode, block_size=0, strong_hash=Hash.DEFAULT_STRONG_HASH,
+                 use_cache=True, chunk_size=Host.FILE_CHUNK_SIZE, workers=Host.WORKERS, channel_count=Host.CHANNELS,
+                 compression=Compression.DEFAULT_METHOD, compression_level=Compression.DEFAULT_LEVEL, dedup=False,
+                 sessions=None):
         Thread.__init__(self)
-        Host.__init__(self)
+        Host.__init__(self, block_size, strong_hash, use_cache, chunk_size, workers, channel_count, compression,
+                      compression_level, dedup)
         self.shared_folder = shared_folder
         self.socket = server_socket
         self.sync_mode = sync_mode
+        self.sessions = {} if sessions is None else sessions
+
+    def open_channels(self):
+        '''
+        Offers the data channels to the client and waits for the extra connections it opens
+        '''
+        session = secrets.token_hex(16)
+        channel_sockets = Queue()
+        self.sessions[session] = channel_sockets
+        try:
+            self.send_message(str(self.channel_count) + " " + session)
+            for x in range(int(self.receive_message()) - 1):
+                self.channels.append(self.new_channel(channel_sockets.get(timeout=self.CHANNEL_TIMEOUT)))
+        except Empty:
+            raise IOError("Data channel did not connect")
+        finally:
+            del self.sessions[session]
+
+    def join_session(self, session):
+        '''
+        Hands the connection to the session it is a data channel of
+        '''
+        channel_sockets = self.sessions.get(session)
+        if channel_sockets is None:
+            print("Unknown session of a data channel")
+            self.socket.close()
+            return
+        channel_sockets.put(self.socket)
 
     def total_sync(self, fm):
         '''
         Sync the offline content with the client
         '''
         if self.sync_mode == self.SyncMode.SERVER_OVERWRITING_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_send_modified(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_CREATED):
-                self.transaction_send_created(x, fm)
+            self.serve_channels()
         elif self.sync_mode == self.SyncMode.CLIENT_OVERWRITING_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_receive_modified(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_DELETED):
-                self.transaction_remove(x, fm)
-            for x in fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True):
-                self.transaction_created_folders(x, fm)
-            for x in fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED):
-                self.transaction_receive_created(x, fm)
+            self.request_batch(fm.list_to_event(fm.modified, events.EVENT_TYPE_MODIFIED) +
+                               fm.list_to_event(fm.local_only, events.EVENT_TYPE_DELETED) +
+                               fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True) +
+                               fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED), fm)
         elif self.sync_mode == self.SyncMode.SERVER_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_send_modified(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_CREATED):
-                self.transaction_send_created(x, fm)
-            for x in fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True):
-                self.transaction_created_folders(x, fm)
-            for x in fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED):
-                self.transaction_receive_created(x, fm)
+            self.serve_channels()
+            self.request_batch(fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True) +
+                               fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED), fm)
         elif self.sync_mode == self.SyncMode.CLIENT_PRIORITY:
-            for x in fm.list_to_event(fm.matched, events.EVENT_TYPE_MODIFIED):
-                self.transaction_receive_modified(x, fm)
-            for x in fm.list_to_event(fm.local_only, events.EVENT_TYPE_CREATED):
-                self.transaction_send_created(x, fm)
-            for x in fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True):
-                self.transaction_created_folders(x, fm)
-            for x in fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED):
-                self.transaction_receive_created(x, fm)
+            self.request_batch(fm.list_to_event(fm.modified, events.EVENT_TYPE_MODIFIED) +
+                               fm.list_to_event(fm.remote_empty_folders, events.EVENT_TYPE_CREATED, True) +
+                               fm.list_to_event(fm.remote_only, events.EVENT_TYPE_CREATED), fm)
+            self.serve_channels()
 
     def run(self):
 
         event_list = []
         self.sync_mode = self.sync_mode
-        self.send_fixed_string_size(str(self.sync_mode))
+        try:
+            self.offer_protocol()
+        except (IOError, ValueError) as e:
+            print("Client protocol not supported", e)
+            self.socket.close()
+            return
+        session = self.receive_message()
+        if session:
+            self.join_session(session)
+            return
+        self.send_message(str(self.sync_mode))
+        self.send_message(str(self.hash.block_size))
+        self.offer_strong_hash()
+        self.offer_compression()
+        self.offer_dedup()
+        self.open_cache()
+        if self.dedup:
+            self.open_chunk_store()
+        self.start_workers()
+        self.open_channels()
 
-        # send file list
+        # compare the folder trees, only the differing folders are listed
         fm = FileManager(self.shared_folder)
-        self.send_object(fm.local_rel_paths)
-        fm.remote_rel_paths = self.receive_object()
-        self.send_object(fm.local_empty_folder)
-        fm.remote_empty_folders = self.receive_object()
+        if self.chunk_store is not None:
+            self.index_chunks(fm)
+        self.diff_trees(fm, True)
         fm.calc_matched_files()
+        # checksums are only exchanged for the files the quick check can not decide
+        unsure_files = fm.get_unsure_files()
+        local_checksums = self.get_local_checksums(unsure_files)
+        self.send_checksums(local_checksums)
+        fm.calc_modified_files(unsure_files, local_checksums, self.receive_checksums())
         self.total_sync(fm)
         fm.clear_exceptions()
 
@@ -105,14 +175,14 @@ class ServerConn(Thread, Host):
         msg = self.Msg.e
         while True:
             if watchdog.q.empty():
-                self.send_fixed_string_size(str(msg))
-                msg = self.receive_fixed_string_size()
+                self.send_message(str(msg))
+                msg = self.receive_message()
             else:
                 if IsReadyToSync.ready:
                     msg = self.Msg.s
                     event_list = self.filter_queue(watchdog.q, fm)
-                    self.send_fixed_string_size(str(msg))
-                    msg = self.receive_fixed_string_size()
+                    self.send_message(str(msg))
+                    msg = self.receive_message()
                     if msg == self.Msg.c:
                         if self.sync_mode == self.SyncMode.CLIENT_PRIORITY or self.sync_mode == self.SyncMode.CLIENT_OVERWRITING_PRIORITY:
                             msg = self.Msg.cs
@@ -121,8 +191,8 @@ class ServerConn(Thread, Host):
 
                 else:
                     msg = self.Msg.e
-                    self.send_fixed_string_size(str(msg))
-                    msg = self.receive_fixed_string_size()
+                    self.send_message(str(msg))
+                    msg = self.receive_message()
 
             time.sleep(1)
             if msg == self.Msg.e:
@@ -142,10 +212,10 @@ class ServerConn(Thread, Host):
                 self.send_all_data(event_list, fm)
                 self.receive_all_data(fm)
             elif msg == self.Msg.x:
-                self.socket.close()
+                self.close_channels()
             else:
                 print("Fatal exception, message incorrect", msg)
-                self.socket.close()
+                self.close_channels()
             msg = self.Msg.e
 
 
@@ -154,8 +224,19 @@ def main(args):
         args.shared_folder = args.shared_folder + os.sep
     if args.sync_mode < 0 or args.sync_mode > 3:
         raise ValueError("Sync mode can only be between 0 and 3")
+    if args.block_size < 0:
+        raise ValueError("Block size can not be negative")
+    if args.compression_level < 1 or args.compression_level > 9:
+        raise ValueError("Compression level can only be between 1 and 9")
+    if args.channels <= 0:
+        raise ValueError("Channels have to be positive")
+    if args.workers < 0:
+        raise ValueError("Workers can not be negative")
+    if args.chunk_size <= 0:
+        raise ValueError("Chunk size has to be positive")
     shared_folder = os.path.join(os.path.abspath(os.curdir), args.shared_folder)
-    s = Server(shared_folder, args.sync_mode, args.port)
+    s = Server(shared_folder, args.sync_mode, args.port, args.block_size, args.strong_hash, not args.no_cache,
+               args.chunk_size, args.workers, args.channels, args.compression, args.compression_level, args.dedup)
     s.server_start()
 
 
@@ -174,5 +255,24 @@ if __name__ == "__main__":
                         help='sync mode', default='0')
     parser.add_argument('--port', dest='port', type=int,
                         help='port number', default='50000')
+    parser.add_argument('--block-size', dest='block_size', type=int,
+                        help='delta block size in bytes, 0 picks it from the file size', default='0')
+    parser.add_argument('--block-hash', dest='strong_hash', type=str, choices=sorted(Hash.STRONG_HASHES),
+                        help='hash used to verify delta blocks', default=Hash.DEFAULT_STRONG_HASH)
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='rehash files instead of caching their checksums next to the shared folder')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        help='size in bytes of the socket reads of file data', default=Host.FILE_CHUNK_SIZE)
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='processes hashing and diffing files ahead of the transfers, 0 for none',
+                        default=Host.WORKERS)
+    parser.add_argument('--channels', dest='channels', type=int,
+                        help='connections carrying the file transfers of a client, at most', default=Host.CHANNELS)
+    parser.add_argument('--compression', dest='compression', type=str, choices=Compression.get_methods(),
+                        help='compression of the file data sent by both hosts', default=Compression.DEFAULT_METHOD)
+    parser.add_argument('--compression-level', dest='compression_level', type=int,
+                        help='compression level from 1 (fastest) to 9 (smallest)', default=Compression.DEFAULT_LEVEL)
+    parser.add_argument('--dedup', dest='dedup', action='store_true',
+                        help='send large files as content defined chunks, the receiver copies the ones it already has')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,97 @@
+import struct
+
+import numpy as np
+
+
+class SignatureIndex:
+    '''
+    Block signatures of a file used as delta_1.
+    Weak hashes and block indexes are kept in flat arrays sorted by weak hash and the strong
+    digests in one contiguous buffer in block order, so lookups are a binary search.
+    The block size is chosen per file and travels in the header. Strong digests are truncated
+    to strong_size bytes, the whole file checksum catches the rare false matches this allows
+    '''
+    HEADER = struct.Struct("!QIB")
+    WEAK_WIRE_TYPE = np.dtype("<u4")
+
+    def __init__(self, weak, strong, block_size, strong_size, digest_size=None):
+        weak = np.asarray(weak, dtype=np.uint32)
+        self.block_size = block_size
+        if digest_size is not None and digest_size != strong_size:
+            strong = np.frombuffer(strong, dtype=np.uint8).reshape(len(weak), digest_size)[:, :strong_size].tobytes()
+        self.strong_size = strong_size
+        self.strong = bytes(strong)
+        self.block_count = len(weak)
+        self.indexes = np.argsort(weak, kind="stable").astype(np.uint32)
+        self.weak = weak[self.indexes]
+
+    def __len__(self):
+        return self.block_count
+
+    def __contains__(self, weak):
+        position = int(np.searchsorted(self.weak, weak))
+        return position < self.block_count and int(self.weak[position]) == weak
+
+    def find_candidates(self, weak):
+        """
+        Returns the sorted positions of the weak hash array whose value is a block weak hash
+        """
+        if len(weak) == 0 or self.block_count == 0:
+            return np.empty(0, dtype=np.int64)
+        positions = np.searchsorted(self.weak, weak)
+        np.minimum(positions, self.block_count - 1, out=positions)
+        return np.flatnonzero(self.weak[positions] == weak)
+
+    def find_block(self, weak, strong):
+        """
+        Returns the index of the first block with the given hashes or -1 if there is none
+        """
+        strong = strong[:self.strong_size]
+        first = int(np.searchsorted(self.weak, weak, side="left"))
+        last = int(np.searchsorted(self.weak, weak, side="right"))
+        for position in range(first, last):
+            index = int(self.indexes[position])
+            if self.strong[index * self.strong_size:(index + 1) * self.strong_size] == strong:
+                return index
+        return -1
+
+    def get_header(self):
+        """
+        Returns the wire header: block count, block size and strong digest size
+        """
+        return self.HEADER.pack(self.block_count, self.block_size, self.strong_size)
+
+    def get_weak_bytes(self):
+        """
+        Returns the weak hashes in block order as little endian uint32 values
+        """
+        weak = np.empty(self.block_count, dtype=self.WEAK_WIRE_TYPE)
+        weak[self.indexes] = self.weak
+        return weak.tobytes()
+
+    def get_bytes(self):
+        """
+        Returns the wire form: header, weak hashes and truncated strong digests
+        """
+        return self.get_header() + self.get_weak_bytes() + self.strong
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Builds the signature from its wire form, raises IOError if it is malformed
+        """
+        if len(data) < cls.HEADER.size:
+            raise IOError("Truncated signature header")
+        block_count, block_size, strong_size = cls.HEADER.unpack_from(data)
+        if block_size == 0 or strong_size == 0:
+            raise IOError("Invalid signature block size " + str(block_size) + " or digest size " + str(strong_size))
+        if len(data) != cls.HEADER.size + block_count * (cls.WEAK_WIRE_TYPE.itemsize + strong_size):
+            raise IOError("Signature of " + str(len(data)) + " bytes does not match its " + str(block_count) +
+                          " blocks")
+        offset = cls.HEADER.size
+        weak = np.frombuffer(data, dtype=cls.WEAK_WIRE_TYPE, count=block_count, offset=offset)
+        offset = offset + weak.nbytes
+        return cls(weak, data[offset:], block_size, strong_size)
+
+    def get_wire_size(self):
+        return self.HEADER.size + self.block_count * (self.WEAK_WIRE_TYPE.itemsize + self.strong_size)
@@ -0,0 +1,128 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from cache import HashCache
+
+
+OLD_MTIME = 1600000000 * 10 ** 9
+
+
+@pytest.fixture
+def cache(tmp_path):
+    os.makedirs(tmp_path / "shared")
+    cache = HashCache(tmp_path / "shared")
+    yield cache
+    cache.close()
+
+
+def write(cache, rel_path, data=b"data", mtime_ns=OLD_MTIME):
+    '''
+    Writes the file and caches its checksum, returns its absolute path
+    '''
+    filename = os.path.join(cache.shared_folder, rel_path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as f:
+        f.write(data)
+    os.utime(filename, ns=(mtime_ns, mtime_ns))
+    cache.store(filename, cache.get_key(filename), "checksum " + rel_path)
+    return filename
+
+
+def test_store(cache):
+    filename = write(cache, "a.txt")
+    assert cache.get_checksum(filename) == "checksum a.txt"
+    assert cache.get_entry("a.txt") == cache.get_key(filename) + ("checksum a.txt",)
+
+
+def test_store_racy(cache):
+    # the file can still change within the same mtime
+    filename = write(cache, "a.txt", mtime_ns=time.time_ns())
+    assert cache.get_checksum(filename) is None
+    # one old enough is trusted
+    os.utime(filename, ns=(OLD_MTIME, OLD_MTIME))
+    cache.store(filename, cache.get_key(filename), "checksum")
+    assert cache.get_checksum(filename) == "checksum"
+
+
+def test_store_changed(cache):
+    filename = write(cache, "a.txt")
+    key = cache.get_key(filename)
+    with open(filename, "ab") as f:
+        f.write(b"more")
+    os.utime(filename, ns=(OLD_MTIME, OLD_MTIME))
+    cache.store(filename, key, "stale")
+    assert cache.get_entry("a.txt")[3] == "checksum a.txt"
+    cache.store(os.path.join(cache.shared_folder, "missing"), key, "stale")
+    assert cache.get_entry("missing") is None
+
+
+@pytest.mark.parametrize("change", ["size", "mtime", "inode"])
+def test_checksum_key_mismatch(cache, change):
+    filename = write(cache, "a.txt")
+    if change == "size":
+        with open(filename, "ab") as f:
+            f.write(b"more")
+        os.utime(filename, ns=(OLD_MTIME, OLD_MTIME))
+    elif change == "mtime":
+        os.utime(filename, ns=(OLD_MTIME + 1, OLD_MTIME + 1))
+    else:
+        # keep the old inode alive so that the new file gets another one
+        os.rename(filename, filename + ".old")
+        with open(filename, "wb") as f:
+            f.write(b"data")
+        os.utime(filename, ns=(OLD_MTIME, OLD_MTIME))
+    assert cache.get_checksum(filename) is None
+    # the entry itself is kept
+    assert cache.get_entry("a.txt")[3] == "checksum a.txt"
+    os.remove(filename)
+    assert cache.get_checksum(filename) is None
+
+
+def test_signature(cache):
+    filename = write(cache, "a.txt")
+    weak = np.array([1, 2 ** 32 - 1], dtype=np.uint32)
+    cache.store(filename, cache.get_key(filename), "checksum", 4096, "md5", weak, b"strong")
+    checksum, cached_weak, strong = cache.get_signature(filename, 4096, "md5")
+    assert (checksum, strong) == ("checksum", b"strong")
+    assert cached_weak.dtype == np.uint32 and cached_weak.tolist() == weak.tolist()
+    assert cache.get_signature(filename, 8192, "md5") is None
+    assert cache.get_signature(filename, 4096, "sha1") is None
+
+
+def test_move_dir(cache):
+    for rel_path in ("dir/a", "dir/sub/b", "dir2/c"):
+        write(cache, rel_path)
+    os.mkdir(os.path.join(cache.shared_folder, "new"))
+    os.rename(os.path.join(cache.shared_folder, "dir"), os.path.join(cache.shared_folder, "new/dest"))
+    cache.move("dir", "new/dest", True)
+    assert cache.get_entry("dir/a") is None and cache.get_entry("dir/sub/b") is None
+    assert cache.get_checksum(os.path.join(cache.shared_folder, "new/dest/a")) == "checksum dir/a"
+    assert cache.get_checksum(os.path.join(cache.shared_folder, "new/dest/sub/b")) == "checksum dir/sub/b"
+    # a folder sharing the prefix is not moved
+    assert cache.get_entry("dir2/c")[3] == "checksum dir2/c"
+    # the entries of a folder replaced by the move are dropped
+    write(cache, "replaced/x")
+    cache.move("dir2", "replaced", True)
+    assert cache.get_entry("replaced/x") is None
+    assert cache.get_entry("replaced/c")[3] == "checksum dir2/c"
+
+
+def test_move_file(cache):
+    write(cache, "a")
+    write(cache, "b")
+    cache.move("a", "b")
+    assert cache.get_entry("a") is None
+    assert cache.get_entry("b")[3] == "checksum a"
+
+
+def test_invalidate_dir(cache):
+    for rel_path in ("dir/a", "dir/sub/b", "dir2/c"):
+        write(cache, rel_path)
+    cache.invalidate("dir", True)
+    assert cache.get_entry("dir/a") is None and cache.get_entry("dir/sub/b") is None
+    assert cache.get_entry("dir2/c") is not None
+    cache.invalidate("dir2/c")
+    assert cache.get_entry("dir2/c") is None
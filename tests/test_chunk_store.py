@@ -0,0 +1,78 @@
+import os
+import random
+
+import pytest
+
+from chunk_store import ChunkStore
+
+
+OLD_MTIME = 1600000000 * 10 ** 9
+
+
+@pytest.fixture
+def store(tmp_path):
+    os.makedirs(tmp_path / "shared")
+    store = ChunkStore(tmp_path / "shared")
+    yield store
+    store.close()
+
+
+def add(store, rel_path, data):
+    '''
+    Writes the file and indexes its chunks, returns them
+    '''
+    path = os.path.join(store.shared_folder, rel_path)
+    with open(path, "wb") as f:
+        f.write(data)
+    # old enough for the index to trust it
+    os.utime(path, ns=(OLD_MTIME, OLD_MTIME))
+    key, checksum, chunks = ChunkStore.chunk_file(path)
+    store.add_file(rel_path, key, chunks)
+    return chunks
+
+
+def test_read(store):
+    data = random.Random(0).randbytes(2 * 1024 * 1024)
+    chunks = add(store, "a", data)
+    assert len(chunks) > 1
+    for digest, offset, length in chunks:
+        assert store.read(digest, length) == data[offset:offset + length]
+    # the length is part of the match
+    assert store.read(chunks[0][0], chunks[0][2] - 1) is None
+    assert store.read(bytes(ChunkStore.DIGEST_SIZE), chunks[0][2]) is None
+
+
+def test_read_other_file(store):
+    # the chunks of a new version are found in the old one, whatever its name
+    rng = random.Random(0)
+    old = rng.randbytes(2 * 1024 * 1024)
+    add(store, "old", old)
+    new = old[:1000000] + rng.randbytes(5000) + old[1000000:]
+    with open(os.path.join(store.shared_folder, "new"), "wb") as f:
+        f.write(new)
+    new_chunks = ChunkStore.chunk_file(os.path.join(store.shared_folder, "new"))[2]
+    found = [x for x in new_chunks if store.read(x[0], x[2]) == new[x[1]:x[1] + x[2]]]
+    assert sum(x[2] for x in found) > len(new) - 3 * 256 * 1024
+
+
+def test_read_stale(store):
+    data = random.Random(0).randbytes(2 * 1024 * 1024)
+    digest, offset, length = add(store, "a", data)[0]
+    with open(os.path.join(store.shared_folder, "a"), "r+b") as f:
+        f.write(b"changed")
+    assert store.read(digest, length) is None
+    # the stale entries of the file are dropped
+    assert store.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] == 0
+    add(store, "a", data)
+    os.remove(os.path.join(store.shared_folder, "a"))
+    assert store.read(digest, length) is None
+
+
+def test_prune(store):
+    data = random.Random(0).randbytes(2 * 1024 * 1024)
+    for rel_path in ("a", "b"):
+        add(store, rel_path, data)
+    store.prune({"b": None})
+    assert store.db.execute("SELECT rel_path FROM files").fetchall() == [("b",)]
+    rows = store.db.execute("SELECT DISTINCT rel_path FROM chunks").fetchall()
+    assert rows == [("b",)]
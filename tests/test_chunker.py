@@ -0,0 +1,49 @@
+import io
+import random
+
+import pytest
+
+from chunker import Chunker
+
+
+def get_chunks(data):
+    return list(Chunker().get_chunks(io.BytesIO(data)))
+
+
+@pytest.fixture(scope="module")
+def data():
+    return random.Random(0).randbytes(4 * 1024 * 1024)
+
+
+def test_chunks(data):
+    chunks = get_chunks(data)
+    assert b"".join(chunks) == data
+    assert all(Chunker.MIN_SIZE <= len(x) <= Chunker.MAX_SIZE for x in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= Chunker.MAX_SIZE
+    assert get_chunks(b"") == []
+    assert get_chunks(b"small") == [b"small"]
+
+
+def test_chunks_read_size(data, monkeypatch):
+    # the cuts do not depend on where the reads end
+    chunks = get_chunks(data)
+    monkeypatch.setattr(Chunker, "READ_SIZE", 100000)
+    assert get_chunks(data) == chunks
+
+
+def test_chunks_max_size():
+    chunks = get_chunks(bytes(1024 * 1024 + 1))
+    assert [len(x) for x in chunks] == [Chunker.MAX_SIZE] * 4 + [1]
+
+
+@pytest.mark.parametrize("offset", [0, 100, 1000000])
+def test_insert(data, offset):
+    # an insert only changes the chunks around it, the ones after it are shifted whole
+    inserted = data[:offset] + b"inserted bytes" + data[offset:]
+    chunks = get_chunks(data)
+    new_chunks = get_chunks(inserted)
+    assert b"".join(new_chunks) == inserted
+    changed = [x for x in new_chunks if x not in set(chunks)]
+    assert len(changed) <= 2
+    assert sum(map(len, changed)) < 3 * Chunker.MAX_SIZE
+    assert new_chunks[-len(chunks) // 2:] == chunks[-len(chunks) // 2:]
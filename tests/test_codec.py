@@ -0,0 +1,49 @@
+import os
+
+import pytest
+from watchdog import events
+
+from codec import Codec
+from file_manager import FileManager
+
+
+@pytest.fixture(params=[False, True], ids=["plain", "deflated"])
+def codec(request):
+    return Codec(compress=request.param)
+
+
+def test_events(codec):
+    event_list = [("a", None, False, events.EVENT_TYPE_CREATED),
+                  ("b/c", "b/d", False, events.EVENT_TYPE_MOVED),
+                  ("e", None, True, events.EVENT_TYPE_DELETED),
+                  ("f", "g/f", True, events.EVENT_TYPE_MOVED),
+                  ("h", "h copy", False, FileManager.EVENT_TYPE_COPIED),
+                  ("é/ü", None, False, events.EVENT_TYPE_MODIFIED)]
+    assert codec.decode_events(codec.encode_events(event_list)) == event_list
+    assert codec.decode_events(codec.encode_events([])) == []
+
+
+def test_events_corrupted(codec):
+    data = bytearray(codec.encode_events([("a", "b", False, events.EVENT_TYPE_MOVED)]))
+    with pytest.raises(IOError):
+        codec.decode_events(bytes(data[:-1]) + b"\0c")
+    data[Codec.COUNT.size] = 0x0f
+    with pytest.raises(IOError):
+        codec.decode_events(bytes(data))
+
+
+def test_checksums(codec):
+    checksums = [os.urandom(20).hex(), None, "00" * 19 + "01", os.urandom(20).hex()]
+    decoded = codec.decode_checksums(codec.encode_checksums(checksums))
+    assert decoded == [bytes(20) if x is None else bytes.fromhex(x) for x in checksums]
+    assert codec.decode_checksums(codec.encode_checksums([])) == []
+
+
+def test_listing(codec):
+    paths = ["a", "a/b", "a/b/c", "a/bc", "b", "é/x", "é/y/z", "x" * 70000, "x" * 70000 + "/y"]
+    manifest = {x: (len(x), 1600000000000000000 + len(x)) for x in paths}
+    folders = {"": os.urandom(20), "a": os.urandom(20), "é/y": os.urandom(20)}
+    (decoded_paths, sizes, mtimes), decoded_folders = codec.decode_listing(codec.encode_listing(manifest, folders))
+    assert dict(zip(decoded_paths, zip(sizes, mtimes))) == manifest
+    assert decoded_folders == folders
+    assert codec.decode_listing(codec.encode_listing({}, {})) == (([], [], []), {})
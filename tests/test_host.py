@@ -0,0 +1,319 @@
+import os
+import queue
+import random
+import socket
+import zlib
+from threading import Thread
+
+import pytest
+from watchdog import events
+
+from chunk_store import ChunkStore
+from compression import Compression
+from file_manager import FileManager
+from host import Host
+
+
+class SlowSocket:
+    '''
+    Socket whose reads return at most a few bytes, as a busy connection may
+    '''
+    def __init__(self, sock, size):
+        self.sock = sock
+        self.size = size
+
+    def recv_into(self, view):
+        return self.sock.recv_into(view[:self.size])
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def hosts(tmp_path):
+    '''
+    A receiving and a serving host connected over a socket pair, each with its own shared folder
+    '''
+    receiver, sender = Host(use_cache=False), Host(use_cache=False)
+    receiver.socket, sender.socket = socket.socketpair()
+    for host, name in ((receiver, "receiver"), (sender, "sender")):
+        (tmp_path / name).mkdir()
+        host.shared_folder = str(tmp_path / name) + "/"
+    yield receiver, sender
+    receiver.socket.close()
+    sender.socket.close()
+
+
+@pytest.fixture
+def cached_host(tmp_path):
+    '''
+    A host with a hash cache, for the local event filtering
+    '''
+    host = Host()
+    (tmp_path / "shared").mkdir()
+    host.shared_folder = str(tmp_path / "shared") + "/"
+    host.open_cache()
+    yield host
+    host.hash.cache.close()
+
+
+def spy(monkeypatch, host, name):
+    '''
+    Counts the calls of a method of the host
+    '''
+    calls = []
+    method = getattr(host, name)
+
+    def wrapper(*args):
+        calls.append(args)
+        return method(*args)
+    monkeypatch.setattr(host, name, wrapper)
+    return calls
+
+
+def sync(receiver, sender, event_list):
+    '''
+    Runs a batch of the receiver against the serving host
+    '''
+    thread = Thread(target=sender.serve_batch)
+    thread.start()
+    receiver.request_batch(event_list, FileManager(receiver.shared_folder))
+    thread.join()
+
+
+def write(host, rel_path, data):
+    with open(os.path.join(host.shared_folder, rel_path), "wb") as f:
+        f.write(data)
+
+
+def read(host, rel_path):
+    with open(os.path.join(host.shared_folder, rel_path), "rb") as f:
+        return f.read()
+
+
+def test_large_frame(hosts):
+    receiver, sender = hosts
+    payload = os.urandom(6 * 1024 * 1024 + 123)
+    thread = Thread(target=sender.send_frame, args=(Host.Op.MESSAGE, payload))
+    thread.start()
+    received = receiver.receive_frame(Host.Op.MESSAGE)
+    thread.join()
+    assert received == payload
+
+
+def test_receive_bytes_partial_reads(hosts):
+    receiver, sender = hosts
+    payload = os.urandom(100000)
+    receiver.socket = SlowSocket(receiver.socket, 7)
+    thread = Thread(target=sender.socket.sendall, args=(payload,))
+    thread.start()
+    assert receiver.receive_bytes(len(payload)) == payload
+    thread.join()
+
+
+def test_receive_bytes_closed(hosts):
+    receiver, sender = hosts
+    sender.socket.sendall(b"abc")
+    sender.socket.shutdown(socket.SHUT_WR)
+    with pytest.raises(ConnectionError):
+        receiver.receive_bytes(4)
+
+
+def test_frame_too_large(hosts, monkeypatch):
+    receiver, sender = hosts
+    monkeypatch.setattr(Host, "MAX_FRAME_SIZE", 1000)
+    sender.send_frame(Host.Op.MESSAGE, b"x" * 1001)
+    with pytest.raises(IOError):
+        receiver.receive_any_frame()
+
+
+@pytest.mark.parametrize("op, value, count", [(Host.DeltaOp.LITERAL, 1 << 63, 0),
+                                               (Host.DeltaOp.COMPRESSED, 100, 1 << 63)])
+def test_delta_op_too_large(hosts, op, value, count):
+    receiver, sender = hosts
+    write(receiver, "file", b"old content")
+    sender.send_delta_op(op, value, count)
+    with pytest.raises(IOError):
+        receiver.receive_delta_2(os.path.join(receiver.shared_folder, "file"), None, "00" * 20)
+    assert os.listdir(receiver.shared_folder) == ["file"]
+
+
+def test_compressed_chunk_too_large(hosts):
+    receiver, sender = hosts
+    sender.socket.sendall(Host.CHUNK_HEADER.pack(Host.MAX_FRAME_SIZE + 1))
+    with pytest.raises(IOError):
+        receiver.receive_compressed_file(os.path.join(receiver.shared_folder, "file"), 100)
+
+
+def test_compressed_file_size_too_large(hosts):
+    receiver, sender = hosts
+    receiver.compression = Compression("zlib")
+    data = zlib.compress(b"data")
+    sender.socket.sendall(Host.CHUNK_HEADER.pack(len(data)) + data + Host.CHUNK_HEADER.pack(0) +
+                          bytes([Host.Result.FILE]) + b"next")
+    path = os.path.join(receiver.shared_folder, "file")
+    assert receiver.receive_compressed_file(path, (1 << 64) - 1) == Host.ReturnCode.FAILURE
+    # the chunks are read to the end
+    assert receiver.receive_bytes(4) == b"next"
+
+
+def test_pack_too_large(hosts):
+    receiver, sender = hosts
+    payload = (Host.PACK_HEADER.pack(1, True) + Host.PACK_ENTRY.pack(1, Host.Result.FILE, 1 << 63, 0) +
+               zlib.compress(b"data"))
+    with pytest.raises(IOError):
+        receiver.receive_pack(None, payload, None)
+
+
+def test_delta(hosts, monkeypatch):
+    receiver, sender = hosts
+    rng = random.Random(1)
+    old = rng.randbytes(300000)
+    new = bytearray(old)
+    for _ in range(10):
+        offset = rng.randrange(len(new))
+        new[offset:offset] = rng.randbytes(rng.randint(1, 2000))
+    write(receiver, "file", old)
+    write(sender, "file", bytes(new))
+    deltas = spy(monkeypatch, sender, "send_delta2_file")
+    sync(receiver, sender, [("file", None, False, events.EVENT_TYPE_MODIFIED)])
+    assert len(deltas) == 1
+    assert read(receiver, "file") == new
+
+
+def test_pack(hosts, monkeypatch):
+    receiver, sender = hosts
+    files = {"file%d" % x: os.urandom(x * 100) for x in range(20)}
+    for rel_path, data in files.items():
+        write(sender, rel_path, data)
+    packs = spy(monkeypatch, sender, "send_pack")
+    sync(receiver, sender, [(x, None, False, events.EVENT_TYPE_CREATED) for x in files])
+    assert packs
+    for rel_path, data in files.items():
+        assert read(receiver, rel_path) == data
+
+
+@pytest.mark.parametrize("method", Compression.get_methods()[1:])
+def test_compressed_file(hosts, monkeypatch, method):
+    receiver, sender = hosts
+    receiver.compression = Compression(method)
+    sender.compression = Compression(method)
+    data = b"".join(b"line %d of a text file\n" % x for x in range(200000))
+    write(sender, "file.txt", data)
+    compressed = spy(monkeypatch, sender, "send_compressed_file")
+    sync(receiver, sender, [("file.txt", None, False, events.EVENT_TYPE_CREATED)])
+    assert len(compressed) == 1
+    assert read(receiver, "file.txt") == data
+
+
+@pytest.mark.parametrize("method", Compression.get_methods()[1:])
+def test_compressed_file_too_large(hosts, monkeypatch, method):
+    receiver, sender = hosts
+    receiver.compression = Compression(method)
+    new_decompressor = receiver.compression.new_decompressor
+    outputs = []
+
+    class Decompressor:
+        def __init__(self):
+            self.decompressor = new_decompressor()
+
+        def decompress(self, data, max_length):
+            outputs.append(self.decompressor.decompress(data, max_length))
+            return outputs[-1]
+    monkeypatch.setattr(receiver.compression, "new_decompressor", Decompressor)
+    compressor = Compression(method).new_compressor()
+    data = compressor.compress(bytes(16 * 1024 * 1024)) + compressor.flush()
+    thread = Thread(target=sender.socket.sendall, args=(Host.CHUNK_HEADER.pack(len(data)) + data +
+                                                        Host.CHUNK_HEADER.pack(0) + bytes([Host.Result.FILE]),))
+    thread.start()
+    path = os.path.join(receiver.shared_folder, "file")
+    assert receiver.receive_compressed_file(path, 1000) == Host.ReturnCode.FAILURE
+    thread.join()
+    assert not os.path.exists(path)
+    assert sum(len(x) for x in outputs) <= 1001
+
+
+# an mtime old enough for the cache to trust it
+OLD_MTIME = 1600000000 * 10 ** 9
+
+
+def filter_events(host, fm, event_list):
+    '''
+    Filters watchdog events as the event monitor queues them
+    '''
+    event_queue = queue.Queue()
+    for event in event_list:
+        event_queue.put(event)
+    return host.filter_queue(event_queue, fm)
+
+
+def test_filter_queue_received_file(cached_host):
+    host = cached_host
+    write(host, "f", b"old content")
+    fm = FileManager(host.shared_folder)
+    # the file rebuilt from a delta is moved in place, given the remote mtime and cached
+    event = ("f", None, False, events.EVENT_TYPE_MODIFIED)
+    fm.add_unique_exception(event)
+    path = os.path.join(host.shared_folder, "f")
+    temp_file = os.path.join(host.shared_folder, FileManager.TEMP_PREFIX + "f")
+    write(host, temp_file, b"new content")
+    os.replace(temp_file, path)
+    host.set_mtime(path, OLD_MTIME)
+    checksum = host.hash.compute_file_checksum(path)
+    host.cache_checksum(path, checksum)
+    assert filter_events(host, fm, [events.FileMovedEvent(temp_file, path), events.FileModifiedEvent(path)]) == []
+    assert host.hash.cache.get_entry("f")[3] == checksum
+    # renamed later through a delete and a create, found by its cached checksum
+    os.remove(path)
+    write(host, "g", b"new content")
+    deleted, created = events.FileDeletedEvent(path), events.FileCreatedEvent(os.path.join(host.shared_folder, "g"))
+    assert filter_events(host, fm, [deleted, created]) == [("f", "g", False, events.EVENT_TYPE_MOVED)]
+
+
+def test_filter_queue_delete_create(cached_host):
+    host = cached_host
+    write(host, "a", b"content")
+    write(host, "other", b"other content")
+    path = os.path.join(host.shared_folder, "a")
+    host.set_mtime(path, OLD_MTIME)
+    host.hash.get_file_checksum(path)
+    fm = FileManager(host.shared_folder)
+    os.remove(path)
+    write(host, "b", b"content")
+    event_list = [events.FileDeletedEvent(path), events.FileCreatedEvent(os.path.join(host.shared_folder, "b")),
+                  events.FileModifiedEvent(os.path.join(host.shared_folder, "other"))]
+    assert filter_events(host, fm, event_list) == [("a", "b", False, events.EVENT_TYPE_MOVED),
+                                                   ("other", None, False, events.EVENT_TYPE_MODIFIED)]
+
+
+def test_dedup(hosts, monkeypatch):
+    # the receiver builds the file from the chunks of another local file and only asks for the new ones
+    receiver, sender = hosts
+    rng = random.Random(2)
+    old = rng.randbytes(3 * 1024 * 1024)
+    new = old[:1000000] + rng.randbytes(5000) + old[1000000:2000000] + old[2500000:]
+    write(receiver, "old", old)
+    write(sender, "new", new)
+    receiver.dedup = sender.dedup = True
+    receiver.open_chunk_store()
+    key, checksum, chunks = ChunkStore.chunk_file(os.path.join(receiver.shared_folder, "old"))
+    receiver.chunk_store.add_file("old", key, chunks)
+    ranges = spy(monkeypatch, sender, "send_chunks")
+    try:
+        sync(receiver, sender, [("new", None, False, events.EVENT_TYPE_CREATED)])
+    finally:
+        receiver.chunk_store.close()
+    assert read(receiver, "new") == new
+    assert len(ranges) == 1
+    count = Host.CHUNK_COUNT.unpack_from(ranges[0][2])[0]
+    sent = sum(Host.CHUNK_RANGE.unpack_from(ranges[0][2], Host.CHUNK_COUNT.size + x * Host.CHUNK_RANGE.size)[1]
+               for x in range(count))
+    assert 5000 < sent < 3 * 256 * 1024
+
+
+def test_delta_request_malformed(hosts):
+    receiver, sender = hosts
+    write(sender, "file", b"content")
+    checksum_size = sender.hash.new_file_checksum().digest_size
+    with pytest.raises(IOError):
+        sender.serve_request(1, Host.Request.DELTA, "file", bytes(checksum_size) + b"\1\2\3")
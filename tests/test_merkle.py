@@ -0,0 +1,113 @@
+import socket
+from threading import Thread
+
+import pytest
+
+from file_manager import FileManager
+from host import Host
+from merkle import MerkleTree
+
+
+MTIME = 1600000000 * 10 ** 9
+
+MANIFEST = {
+    "top.txt": (10, MTIME),
+    "src/main.c": (20, MTIME),
+    "src/lib/util.c": (30, MTIME),
+    "src/lib/deep/er/file.h": (40, MTIME),
+    "src/lib/deep/er/other.h": (50, MTIME),
+    "docs/readme.md": (60, MTIME),
+}
+
+
+def diff(local_manifest, remote_manifest, local_empty_folders=(), remote_empty_folders=()):
+    '''
+    Runs the tree diff of two hosts, returns the file manager of the local one then the remote one
+    '''
+    managers = []
+    for manifest, empty_folders in ((local_manifest, local_empty_folders), (remote_manifest, remote_empty_folders)):
+        fm = FileManager()
+        fm.local_manifest = dict(manifest)
+        fm.local_empty_folder = list(empty_folders)
+        managers.append(fm)
+    local, remote = Host(use_cache=False), Host(use_cache=False)
+    local.socket, remote.socket = socket.socketpair()
+    thread = Thread(target=remote.diff_trees, args=(managers[1], False))
+    thread.start()
+    local.diff_trees(managers[0], True)
+    thread.join()
+    local.socket.close()
+    remote.socket.close()
+    for fm in managers:
+        fm.calc_matched_files()
+    return managers
+
+
+def test_hash_order():
+    items = list(MANIFEST.items())
+    assert MerkleTree(dict(items)).get_hash("") == MerkleTree(dict(reversed(items))).get_hash("")
+
+
+def test_hash_changes():
+    tree = MerkleTree(MANIFEST)
+    changed = MerkleTree(dict(MANIFEST, **{"src/lib/deep/er/file.h": (40, MTIME + 1)}))
+    assert changed.get_hash("") != tree.get_hash("")
+    assert changed.get_hash("src/lib/deep/er") != tree.get_hash("src/lib/deep/er")
+    assert changed.get_hash("docs") == tree.get_hash("docs")
+
+
+def test_empty_folder_hash():
+    tree = MerkleTree(MANIFEST, ["empty", "src/nothing"])
+    assert tree.get_hash("empty") == MerkleTree.EMPTY_HASH
+    assert tree.get_hash("src/nothing") == MerkleTree.EMPTY_HASH
+    assert tree.get_hash("src") != MerkleTree(MANIFEST).get_hash("src")
+
+
+def test_identical_trees():
+    local, remote = diff(MANIFEST, MANIFEST, ["empty"], ["empty"])
+    for fm in (local, remote):
+        assert fm.compared_rel_paths == []
+        assert fm.remote_rel_paths == []
+        assert fm.remote_empty_folders == []
+
+
+def test_changed_deep_file():
+    changed = dict(MANIFEST, **{"src/lib/deep/er/file.h": (41, MTIME)})
+    local, remote = diff(MANIFEST, changed)
+    for fm, other in ((local, changed), (remote, MANIFEST)):
+        # only the files of the folders on the way to the changed one are listed
+        assert sorted(fm.compared_rel_paths) == ["src/lib/deep/er/file.h", "src/lib/deep/er/other.h",
+                                                 "src/lib/util.c", "src/main.c", "top.txt"]
+        assert fm.remote_manifest == {x: other[x] for x in fm.compared_rel_paths}
+        assert fm.local_only == fm.remote_only == []
+    local.calc_modified_files([], [], [])
+    assert local.modified == ["src/lib/deep/er/file.h"]
+
+
+@pytest.mark.parametrize("subtree", ["new", "src/lib/new"])
+def test_added_subtree(subtree):
+    added = {subtree + "/a.txt": (1, MTIME), subtree + "/sub/b.txt": (2, MTIME), subtree + "/sub/c/d.txt": (3, MTIME)}
+    local, remote = diff(MANIFEST, dict(MANIFEST, **added), remote_empty_folders=[subtree + "/empty"])
+    assert local.remote_only == sorted(added)
+    assert local.local_only == []
+    assert local.remote_empty_folders == [subtree + "/empty"]
+    # the other host sees it as a subtree it is the only one to have
+    assert remote.local_only == sorted(added)
+    assert remote.remote_only == []
+    assert remote.remote_empty_folders == []
+
+
+def test_removed_subtree():
+    remaining = {x: stat for x, stat in MANIFEST.items() if not x.startswith("src/lib/")}
+    local, remote = diff(MANIFEST, remaining)
+    assert local.local_only == ["src/lib/deep/er/file.h", "src/lib/deep/er/other.h", "src/lib/util.c"]
+    assert local.remote_only == []
+    assert remote.remote_only == local.local_only
+
+
+def test_empty_folders():
+    local, remote = diff(MANIFEST, MANIFEST, ["only_local", "src/lib/deep/empty"], ["only_remote/a/b"])
+    assert sorted(remote.remote_empty_folders) == ["only_local", "src/lib/deep/empty"]
+    assert local.remote_empty_folders == ["only_remote/a/b"]
+    for fm in (local, remote):
+        assert fm.local_only == fm.remote_only == []
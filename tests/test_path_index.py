@@ -0,0 +1,87 @@
+import random
+
+from path_index import PathIndex
+
+
+def discard(model, path):
+    '''
+    The set equivalent of PathIndex.discard
+    '''
+    return set(x for x in model if x != path and not x.startswith(path + "/"))
+
+
+def move(model, src, dest):
+    '''
+    The set equivalent of PathIndex.move
+    '''
+    moved = set(dest + x[len(src):] for x in model if x == src or x.startswith(src + "/"))
+    return discard(model, src) | moved
+
+
+def check(index, model):
+    assert set(index) == model
+    assert len(index) == len(model)
+    for path in model:
+        assert path in index
+
+
+def test_add_discard():
+    paths = ["a", "a/b", "a/b/c", "a/bc", "b/c/d", "é/f"]
+    index = PathIndex(paths)
+    model = set(paths)
+    check(index, model)
+    assert "a/b/c/d" not in index and "b/c" not in index and "" not in index
+    index.discard("a/b")
+    model = discard(model, "a/b")
+    check(index, model)
+    # a prefix that is not a folder boundary removes nothing else
+    index.discard("a/bc")
+    model = discard(model, "a/bc")
+    check(index, model)
+    index.discard("missing/path")
+    check(index, model)
+    index.add("a/b/c")
+    check(index, model | {"a/b/c"})
+
+
+def test_move_folder():
+    index = PathIndex(["src/a", "src/sub/b", "src/sub/deeper/c", "srcs/d", "other/e"])
+    model = set(index)
+    index.move("src", "dest/new")
+    model = move(model, "src", "dest/new")
+    check(index, model)
+    assert "dest/new/sub/deeper/c" in index and "src/a" not in index
+    # into an existing folder, the entries are merged
+    index.move("other", "dest/new/sub")
+    model = move(model, "other", "dest/new/sub")
+    check(index, model)
+    index.move("dest/new/sub/e", "e")
+    model = move(model, "dest/new/sub/e", "e")
+    check(index, model)
+
+
+def test_random_operations():
+    rng = random.Random(0)
+    names = ["a", "b", "c", "ab"]
+
+    def random_path():
+        return "/".join(rng.choice(names) for _ in range(rng.randint(1, 4)))
+    index = PathIndex()
+    model = set()
+    for _ in range(3000):
+        operation = rng.random()
+        path = random_path()
+        if operation < 0.5:
+            index.add(path)
+            model.add(path)
+        elif operation < 0.7:
+            index.discard(path)
+            model = discard(model, path)
+        else:
+            dest = random_path()
+            # a folder can not be moved inside itself
+            if dest == path or dest.startswith(path + "/") or path.startswith(dest + "/"):
+                continue
+            index.move(path, dest)
+            model = move(model, path, dest)
+        check(index, model)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from signature import SignatureIndex
+
+
+def get_signature():
+    weak = np.array([7, 3, 7, 1], dtype=np.uint32)
+    strong = b"".join(bytes([x]) * 8 for x in range(4))
+    return SignatureIndex(weak, strong, 4096, 8)
+
+
+def test_round_trip():
+    signature = get_signature()
+    data = signature.get_bytes()
+    assert len(data) == signature.get_wire_size()
+    # as the request payload holds it, after the checksum
+    received = SignatureIndex.from_bytes(memoryview(b"checksum" + data)[8:])
+    assert received.get_bytes() == data
+    assert received.find_block(7, bytes([2]) * 8) == 2
+    assert received.find_block(3, bytes([2]) * 8) == -1
+    empty = SignatureIndex(np.empty(0, dtype=np.uint32), b"", 4096, 8)
+    assert len(SignatureIndex.from_bytes(empty.get_bytes())) == 0
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    get_signature().get_header(),
+    get_signature().get_bytes()[:-1],
+    get_signature().get_bytes() + b"\0",
+    # a count the payload is far too short for
+    SignatureIndex.HEADER.pack(1 << 60, 4096, 8) + bytes(100),
+    SignatureIndex.HEADER.pack(1, 0, 8) + bytes(12),
+    SignatureIndex.HEADER.pack(1, 4096, 0) + bytes(4),
+])
+def test_malformed(data):
+    with pytest.raises(IOError):
+        SignatureIndex.from_bytes(data)